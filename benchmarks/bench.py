@@ -0,0 +1,255 @@
+# Performance benchmarks of the read and render path of NetSeeDF.
+#
+# Synthetic NetCDF files are generated locally (grid size, time length, dtype, packing, chunk shape and compression
+# can be chosen) and the data functions, the table model and the overlay rendering are timed on them.
+# Results are written as JSON, so that runs of different versions can be compared with --compare.
+#
+# Examples:
+#   python benchmarks/bench.py
+#   python benchmarks/bench.py --grid 1440x720 --time 365 --dtype f4 --chunks 1,180,360 --compression zlib -o new.json
+#   python benchmarks/bench.py --compare old.json -o new.json
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")  # the table model and rendering run headless
+os.environ.setdefault("NETSEEDF_CACHE_SIZE_MB", "0")  # do not let the overlay cache hide the rendering time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, "src", "main", "python", "netseedf"))
+
+import numpy as np
+import netCDF4
+from netCDF4 import Dataset
+from PySide6.QtWidgets import QApplication
+from PySide6.QtCore import Qt
+
+import datautils
+import tableutils
+
+DEFAULT_CONFIGS = [
+    {"nx": 360, "ny": 180, "nt": 100, "dtype": "f4", "packed": False, "chunks": None, "compression": None},
+    {"nx": 360, "ny": 180, "nt": 100, "dtype": "f4", "packed": False, "chunks": [1, 180, 360], "compression": "zlib"},
+    {"nx": 1440, "ny": 720, "nt": 48, "dtype": "f4", "packed": False, "chunks": [1, 360, 720], "compression": "zlib"},
+    {"nx": 1440, "ny": 720, "nt": 48, "dtype": "i2", "packed": True, "chunks": [8, 180, 180], "compression": "zlib"},
+]
+
+ALL_OPERATIONS = ["identify_dims", "get_initial_data", "get_sliced_data", "slice_timeseries", "table_model", "render_overlay"]
+
+
+def config_name(config):
+    chunks = "contiguous" if config["chunks"] is None else "x".join(str(c) for c in config["chunks"])
+    return "{nx}x{ny}x{nt}_{dtype}{packed}_{chunks}_{compression}".format(
+        nx=config["nx"], ny=config["ny"], nt=config["nt"], dtype=config["dtype"],
+        packed="_packed" if config["packed"] else "", chunks=chunks, compression=config["compression"] or "none")
+
+
+# Writes a synthetic NetCDF file with a (time, lat, lon) variable 'tas' and its coordinate variables.
+# The data is generated from a fixed seed, so the same config always gives the same file.
+def make_fixture(file_path, config):
+    nx, ny, nt = config["nx"], config["ny"], config["nt"]
+    rng = np.random.default_rng(0)
+
+    with Dataset(file_path, "w", format="NETCDF4") as ncfile:
+        ncfile.createDimension("time", nt)
+        ncfile.createDimension("lat", ny)
+        ncfile.createDimension("lon", nx)
+
+        time_var = ncfile.createVariable("time", "f8", ("time",))
+        time_var.units = "hours since 2000-01-01 00:00:00"
+        time_var.calendar = "standard"
+        time_var[:] = np.arange(nt, dtype="f8")
+
+        lat_var = ncfile.createVariable("lat", "f8", ("lat",))
+        lat_var.units = "degrees_north"
+        lat_var[:] = np.linspace(-90 + 90 / ny, 90 - 90 / ny, ny)
+
+        lon_var = ncfile.createVariable("lon", "f8", ("lon",))
+        lon_var.units = "degrees_east"
+        lon_var[:] = np.linspace(-180 + 180 / nx, 180 - 180 / nx, nx)
+
+        kwargs = {}
+        if config["compression"] is not None:
+            kwargs["compression"] = config["compression"]
+        if config["chunks"] is not None:
+            kwargs["chunksizes"] = config["chunks"]
+        else:
+            kwargs["contiguous"] = config["compression"] is None
+
+        dtype = config["dtype"]
+        fill_value = netCDF4.default_fillvals[dtype]
+        var = ncfile.createVariable("tas", dtype, ("time", "lat", "lon"), fill_value=fill_value, **kwargs)
+        var.units = "K"
+        var.long_name = "Near-surface air temperature"
+        if config["packed"]:
+            var.scale_factor = 0.01
+            var.add_offset = 273.15
+
+        base = 273.15 + 30 * np.cos(np.deg2rad(lat_var[:]))[:, None] * np.ones((1, nx))
+        for t in range(nt):
+            values = base + rng.normal(0, 2, size=(ny, nx))
+            values[:ny // 20, :] = np.nan  # some missing values
+            var[t] = np.ma.masked_invalid(values)
+
+
+# Runs func repeat times and returns the durations in seconds
+def time_operation(func, repeat):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def run_config(config, fixture_dir, repeat, operations):
+    file_path = os.path.join(fixture_dir, config_name(config) + ".nc")
+    if not os.path.exists(file_path):
+        print("Generating " + file_path)
+        make_fixture(file_path, config)
+
+    var_props = datautils.identify_dims(file_path, "tas")
+    initial = datautils.get_initial_data(var_props)
+    xboundaries, yboundaries, initial_data, xdata, ydata = initial[7], initial[8], initial[9], initial[10], initial[11]
+    nt = config["nt"]
+
+    counter = itertools.count()
+
+    def next_slice():
+        return [next(counter) % nt]
+
+    def table_model():
+        model = tableutils.TableModel(initial_data.astype(str), xdata.astype(str), ydata.astype(str))
+        for row in range(min(model.rowCount(), 50)):  # cells visible in a typical window
+            for col in range(min(model.columnCount(), 20)):
+                model.data(model.index(row, col), Qt.ItemDataRole.DisplayRole)
+
+    def render():
+        import plotutils
+        min_value, max_value = float(np.nanmin(initial_data)), float(np.nanmax(initial_data))
+        extent = [float(np.min(xboundaries)), float(np.max(xboundaries)), max(float(np.min(yboundaries)), -85), min(float(np.max(yboundaries)), 85)]
+        plotutils.render_overlay(initial_data, xboundaries, yboundaries, extent, min_value, max_value, min_value, max_value, "inferno", "K")
+
+    benchmarks = {
+        "identify_dims": lambda: datautils.identify_dims(file_path, "tas"),
+        "get_initial_data": lambda: datautils.get_initial_data(var_props),
+        "get_sliced_data": lambda: datautils.get_sliced_data(var_props, next_slice()),
+        "slice_timeseries": lambda: datautils.slice_timeseries(var_props, [0], config["nx"] // 2, config["ny"] // 2, "time"),
+        "table_model": table_model,
+        "render_overlay": render,
+    }
+
+    results = []
+    for operation in operations:
+        if operation == "render_overlay":
+            op_repeat = max(1, min(repeat, 3))  # rendering is slow, a few repeats are enough
+        else:
+            op_repeat = repeat
+        durations = time_operation(benchmarks[operation], op_repeat)
+        result = {
+            "config": config_name(config),
+            "params": config,
+            "operation": operation,
+            "repeat": op_repeat,
+            "times_s": durations,
+            "min_s": min(durations),
+            "median_s": statistics.median(durations),
+            "mean_s": statistics.fmean(durations),
+        }
+        print("{:<50} {:<18} min {:9.4f} s   median {:9.4f} s".format(result["config"], operation, result["min_s"], result["median_s"]))
+        results.append(result)
+    return results
+
+
+def get_metadata():
+    commit = None
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except Exception:
+        pass
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "netCDF4": netCDF4.__version__,
+        "netcdf_lib": netCDF4.__netcdf4libversion__,
+        "hdf5_lib": netCDF4.__hdf5libversion__,
+    }
+
+
+# Prints the ratio of the median times of the current run to a previous run, matched by config and operation
+def compare_results(previous, current):
+    previous_times = {(r["config"], r["operation"]): r["median_s"] for r in previous["results"]}
+    print("\nComparison with run of {} (commit {})".format(previous["meta"].get("timestamp"), previous["meta"].get("commit")))
+    for result in current["results"]:
+        key = (result["config"], result["operation"])
+        if key in previous_times and previous_times[key] > 0:
+            ratio = result["median_s"] / previous_times[key]
+            print("{:<50} {:<18} {:9.4f} s -> {:9.4f} s   x{:.2f}".format(key[0], key[1], previous_times[key], result["median_s"], ratio))
+
+
+def parse_config(args):
+    nx, ny = (int(v) for v in args.grid.lower().split("x"))
+    chunks = None
+    if args.chunks:
+        chunks = [int(c) for c in args.chunks.split(",")]
+    return {"nx": nx, "ny": ny, "nt": args.time, "dtype": args.dtype, "packed": args.packed, "chunks": chunks,
+            "compression": args.compression}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="NetSeeDF read/render benchmarks")
+    parser.add_argument("--grid", help="grid size as NXxNY, e.g. 1440x720 (default: run the built-in set of configs)")
+    parser.add_argument("--time", type=int, default=100, help="length of the time dimension")
+    parser.add_argument("--dtype", default="f4", choices=["f4", "f8", "i2", "i4"], help="data type of the variable")
+    parser.add_argument("--packed", action="store_true", help="add scale_factor/add_offset attributes")
+    parser.add_argument("--chunks", help="chunk shape as T,Y,X (default: contiguous if not compressed)")
+    parser.add_argument("--compression", choices=["zlib", "zstd", "bzip2"], help="compression of the variable")
+    parser.add_argument("--repeat", type=int, default=5, help="repetitions of each operation")
+    parser.add_argument("--operations", nargs="+", choices=ALL_OPERATIONS, default=ALL_OPERATIONS)
+    parser.add_argument("--fixtures", help="directory to keep generated files in (default: a temporary directory)")
+    parser.add_argument("-o", "--output", help="file to write the JSON results to")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare with")
+    args = parser.parse_args()
+
+    configs = [parse_config(args)] if args.grid else DEFAULT_CONFIGS
+
+    app = QApplication.instance() or QApplication(sys.argv[:1])
+
+    results = []
+    if args.fixtures:
+        os.makedirs(args.fixtures, exist_ok=True)
+        for config in configs:
+            results += run_config(config, args.fixtures, args.repeat, args.operations)
+    else:
+        with tempfile.TemporaryDirectory(prefix="netseedf-bench-") as fixture_dir:
+            for config in configs:
+                results += run_config(config, fixture_dir, args.repeat, args.operations)
+
+    output = {"meta": get_metadata(), "results": results}
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(output, f, indent=2)
+        print("Results written to " + args.output)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare_results(json.load(f), output)
+
+
+if __name__ == "__main__":
+    main()
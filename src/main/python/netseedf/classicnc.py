@@ -0,0 +1,413 @@
+import os
+import struct
+
+import numpy as np
+import numpy.ma as ma
+
+# Reader for uncompressed NetCDF3 files (classic, 64-bit offset and 64-bit data formats), which maps the file into
+# memory instead of reading it through the netCDF C library. The header is parsed once per file version, variables
+# are exposed as numpy views of the memory map (record variables as strided views over the records), so slices and
+# point time series are zero-copy and only the pages which are actually accessed are read by the OS.
+#
+# ClassicDataset and ClassicVariable implement the parts of the netCDF4.Dataset and netCDF4.Variable interface that
+# NetSeeDF uses, indexing a variable returns a masked (and unpacked, if scale_factor/add_offset are set) array just
+# like netCDF4 does. The data of unpacked variables is still a view of the file.
+
+MAGIC_VERSIONS = {b"CDF\x01": 1, b"CDF\x02": 2, b"CDF\x05": 5}
+
+NC_DIMENSION = 0x0A
+NC_VARIABLE = 0x0B
+NC_ATTRIBUTE = 0x0C
+STREAMING = 0xFFFFFFFF
+
+NC_TYPES = {
+    1: np.dtype(">i1"),  # NC_BYTE
+    2: np.dtype("S1"),   # NC_CHAR
+    3: np.dtype(">i2"),  # NC_SHORT
+    4: np.dtype(">i4"),  # NC_INT
+    5: np.dtype(">f4"),  # NC_FLOAT
+    6: np.dtype(">f8"),  # NC_DOUBLE
+    7: np.dtype(">u1"),  # NC_UBYTE
+    8: np.dtype(">u2"),  # NC_USHORT
+    9: np.dtype(">u4"),  # NC_UINT
+    10: np.dtype(">i8"),  # NC_INT64
+    11: np.dtype(">u8"),  # NC_UINT64
+}
+
+# default fill values of the netCDF library, used for masking when a variable has no _FillValue attribute
+DEFAULT_FILL_VALUES = {
+    "i1": -127,
+    "S1": b"\x00",
+    "i2": -32767,
+    "i4": -2147483647,
+    "f4": 9.9692099683868690e+36,
+    "f8": 9.9692099683868690e+36,
+    "u1": 255,
+    "u2": 65535,
+    "u4": 4294967295,
+    "i8": -9223372036854775806,
+    "u8": 18446744073709551614,
+}
+
+MAX_CACHED_HEADERS = 64
+
+_header_cache = {}  # (path, size, mtime) -> parsed header
+
+
+def get_format_version(file_path):
+    try:
+        with open(file_path, "rb") as f:
+            magic = f.read(4)
+    except OSError:
+        return None
+    return MAGIC_VERSIONS.get(magic)
+
+
+def is_classic(file_path):
+    return get_format_version(file_path) is not None
+
+
+# Values of an attribute of a variable with the signed integer type of view, as they compare to its data viewed as
+# unsigned (see mask_and_scale)
+def as_unsigned(value, signed_dtype, unsigned_dtype):
+    return np.asarray(value).astype(signed_dtype).view(unsigned_dtype)
+
+
+# Applies _Unsigned, masks fill and missing values and values outside valid_range/valid_min/valid_max and unpacks
+# scale_factor/add_offset, like netCDF4 does by default. The data of the returned masked array is a view of the input
+# if no unpacking is needed.
+def mask_and_scale(view, attributes, fill_value):
+    fill_values = [fill_value]
+    if "missing_value" in attributes:
+        fill_values += list(np.atleast_1d(attributes["missing_value"]))
+    fill_values = [v for v in fill_values if v is not None]
+
+    valid_min, valid_max = None, None
+    if "valid_range" in attributes and len(np.atleast_1d(attributes["valid_range"])) == 2:
+        valid_min, valid_max = np.atleast_1d(attributes["valid_range"])
+    valid_min = attributes.get("valid_min", valid_min)
+    valid_max = attributes.get("valid_max", valid_max)
+
+    # signed integers flagged as unsigned, the attributes are stored with the signed type
+    if view.dtype.kind == "i" and attributes.get("_Unsigned") in ("true", "True"):
+        signed_dtype = view.dtype
+        view = view.view(view.dtype.str.replace("i", "u"))
+        fill_values = [as_unsigned(v, signed_dtype, view.dtype) for v in fill_values]
+        if valid_min is not None:
+            valid_min = as_unsigned(valid_min, signed_dtype, view.dtype)
+        if valid_max is not None:
+            valid_max = as_unsigned(valid_max, signed_dtype, view.dtype)
+
+    mask = ma.nomask
+    for fill_value in fill_values:
+        equal = view == fill_value
+        if equal.any():
+            mask = equal if mask is ma.nomask else mask | equal
+    for outside in (view < valid_min if valid_min is not None else None, view > valid_max if valid_max is not None else None):
+        if outside is not None and outside.any():
+            mask = outside if mask is ma.nomask else mask | outside
+
+    if "scale_factor" in attributes or "add_offset" in attributes:
+        data = view
+        if "scale_factor" in attributes:
+            data = data * attributes["scale_factor"]
+        if "add_offset" in attributes:
+            data = data + attributes["add_offset"]
+        return ma.masked_array(data, mask=mask)
+
+    return ma.masked_array(view, mask=mask, copy=False)
+
+
+class HeaderParser:
+    def __init__(self, data, version):
+        self.data = data
+        self.pos = 4
+        self.version = version
+
+    def read(self, fmt):
+        values = struct.unpack_from(">" + fmt, self.data, self.pos)
+        self.pos += struct.calcsize(">" + fmt)
+        return values[0]
+
+    def read_non_neg(self):  # 64-bit in the CDF5 format
+        return self.read("Q" if self.version == 5 else "I")
+
+    def read_offset(self):
+        return self.read("I" if self.version == 1 else "Q")
+
+    def read_name(self):
+        length = self.read_non_neg()
+        name = self.data[self.pos:self.pos + length].decode("utf-8")
+        self.pos += length + (-length % 4)
+        return name
+
+    def read_list_header(self, expected_tag):
+        tag = self.read("I")
+        nelems = self.read_non_neg()
+        if tag == 0:
+            return 0
+        if tag != expected_tag:
+            raise ValueError("Malformed NetCDF classic header")
+        return nelems
+
+    def read_attributes(self):
+        attributes = {}
+        for _ in range(self.read_list_header(NC_ATTRIBUTE)):
+            name = self.read_name()
+            nc_type = self.read("I")
+            nelems = self.read_non_neg()
+            dtype = NC_TYPES[nc_type]
+            nbytes = nelems * dtype.itemsize
+            raw = self.data[self.pos:self.pos + nbytes]
+            self.pos += nbytes + (-nbytes % 4)
+
+            if nc_type == 2:
+                value = raw.split(b"\x00", 1)[0].decode("utf-8", errors="replace")
+            else:
+                value = np.frombuffer(raw, dtype=dtype).astype(dtype.newbyteorder("="))
+                if nelems == 1:
+                    value = value[0]
+            attributes[name] = value
+        return attributes
+
+    def parse(self):
+        numrecs = self.read_non_neg()
+
+        dimensions = []
+        for _ in range(self.read_list_header(NC_DIMENSION)):
+            name = self.read_name()
+            size = self.read_non_neg()
+            dimensions.append((name, size))
+
+        attributes = self.read_attributes()
+
+        variables = []
+        for _ in range(self.read_list_header(NC_VARIABLE)):
+            name = self.read_name()
+            dimids = [self.read_non_neg() for _ in range(self.read_non_neg())]
+            var_attributes = self.read_attributes()
+            nc_type = self.read("I")
+            vsize = self.read_non_neg()
+            begin = self.read_offset()
+            variables.append({"name": name, "dimids": dimids, "attributes": var_attributes,
+                              "dtype": NC_TYPES[nc_type], "vsize": vsize, "begin": begin})
+
+        return numrecs, dimensions, attributes, variables
+
+
+# Parses the header of the file, the result is cached as long as the size and modification time of the file stay the same
+def read_header(file_path):
+    stat = os.stat(file_path)
+    key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    if key in _header_cache:
+        return _header_cache[key]
+
+    version = get_format_version(file_path)
+    if version is None:
+        raise ValueError("Not a NetCDF classic file: " + file_path)
+
+    # the header is usually small, read more if the first guess is not enough
+    read_size = 65536
+    while True:
+        with open(file_path, "rb") as f:
+            data = f.read(read_size)
+        try:
+            numrecs, dimensions, attributes, variables = HeaderParser(data, version).parse()
+            break
+        except (struct.error, IndexError, UnicodeDecodeError):
+            if len(data) < read_size:
+                raise ValueError("Malformed NetCDF classic header: " + file_path)
+            read_size *= 8
+
+    record_dim = None
+    for i, (name, size) in enumerate(dimensions):
+        if size == 0:
+            record_dim = i
+
+    record_vars = [v for v in variables if v["dimids"] and v["dimids"][0] == record_dim]
+
+    if len(record_vars) == 1:  # a single record variable is not padded
+        var = record_vars[0]
+        recsize = var["dtype"].itemsize * int(np.prod([dimensions[d][1] for d in var["dimids"][1:]], dtype=np.int64))
+    else:
+        recsize = sum(v["vsize"] for v in record_vars)
+
+    if record_vars and recsize > 0:
+        # while a file is being written the header can announce records which are not (completely) on disk yet
+        first_begin = min(v["begin"] for v in record_vars)
+        available = -(-(stat.st_size - first_begin) // recsize)
+        if numrecs == (0xFFFFFFFFFFFFFFFF if version == 5 else STREAMING) or numrecs > available:
+            numrecs = max(available, 0)
+
+    header = {
+        "version": version,
+        "numrecs": numrecs,
+        "recsize": recsize,
+        "record_dim": record_dim,
+        "dimensions": dimensions,
+        "attributes": attributes,
+        "variables": variables,
+    }
+    if len(_header_cache) >= MAX_CACHED_HEADERS:
+        _header_cache.pop(next(iter(_header_cache)))
+    _header_cache[key] = header
+    return header
+
+
+class ClassicDimension:
+    def __init__(self, name, size, unlimited):
+        self.name = name
+        self.size = size
+        self.unlimited = unlimited
+
+    def isunlimited(self):
+        return self.unlimited
+
+    def __len__(self):
+        return self.size
+
+    def __repr__(self):
+        if self.unlimited:
+            return "<class 'classicnc.ClassicDimension'> (unlimited): name = '{}', size = {}".format(self.name, self.size)
+        return "<class 'classicnc.ClassicDimension'>: name = '{}', size = {}".format(self.name, self.size)
+
+
+class AttributeContainer:
+    def ncattrs(self):
+        return list(self._attributes.keys())
+
+    def getncattr(self, name):
+        return self._attributes[name]
+
+    def __getattr__(self, name):
+        if name.startswith("_") and name not in ("_FillValue",):
+            raise AttributeError(name)
+        try:
+            return self._attributes[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class ClassicVariable(AttributeContainer):
+    def __init__(self, name, dimensions, attributes, array, group):
+        self.name = name
+        self.dimensions = tuple(dimensions)
+        self._attributes = attributes
+        self._array = array
+        self._group = group
+        self.shape = array.shape
+        self.ndim = array.ndim
+        self.size = array.size
+        self.dtype = array.dtype.newbyteorder("=")
+        self.datatype = self.dtype
+
+    def group(self):
+        return self._group
+
+    def chunking(self):
+        return "contiguous"
+
+    def filters(self):
+        return None
+
+    def get_fill_value(self):
+        if "_FillValue" in self._attributes:
+            return self._attributes["_FillValue"]
+        return DEFAULT_FILL_VALUES.get(self.dtype.str[1:])
+
+    # Returns the raw (not masked, not unpacked, big-endian) zero-copy view of the data
+    def get_view(self, key=()):
+        view = self._array[key]
+        if not isinstance(view, np.ndarray):
+            view = np.asarray(view)
+        return view
+
+    def __getitem__(self, key):
+        view = self.get_view(key)
+        if self.dtype.kind == "S":
+            return view
+        return mask_and_scale(view, self._attributes, self.get_fill_value())
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        lines = ["<class 'classicnc.ClassicVariable'>",
+                 "{} {}({})".format(self.dtype, self.name, ", ".join(self.dimensions))]
+        for key, value in self._attributes.items():
+            lines.append("    {}: {}".format(key, value))
+        unlimited = [d for d in self.dimensions if self._group.dimensions[d].isunlimited()]
+        lines.append("unlimited dimensions: " + ", ".join(unlimited))
+        lines.append("current shape = {}".format(self.shape))
+        return "\n".join(lines)
+
+
+class ClassicDataset(AttributeContainer):
+    def __init__(self, file_path):
+        header = read_header(file_path)
+
+        self.filepath_ = file_path
+        self.data_model = {1: "NETCDF3_CLASSIC", 2: "NETCDF3_64BIT_OFFSET", 5: "NETCDF3_64BIT_DATA"}[header["version"]]
+        self.file_format = self.data_model
+        self.path = "/"
+        self.parent = None
+        self.groups = {}
+        self._attributes = header["attributes"]
+
+        numrecs = header["numrecs"]
+        self.dimensions = {}
+        for i, (name, size) in enumerate(header["dimensions"]):
+            unlimited = i == header["record_dim"]
+            self.dimensions[name] = ClassicDimension(name, numrecs if unlimited else size, unlimited)
+
+        if os.path.getsize(file_path) > 0:
+            self._mmap = np.memmap(file_path, dtype=np.uint8, mode="r")
+        else:
+            self._mmap = np.zeros(0, dtype=np.uint8)
+
+        dim_names = [name for name, _ in header["dimensions"]]
+        self.variables = {}
+        for var in header["variables"]:
+            dims = [dim_names[d] for d in var["dimids"]]
+            shape = tuple(self.dimensions[d].size for d in dims)
+            dtype = var["dtype"]
+
+            # C order strides, a record variable advances by the size of a whole record along the record dimension
+            strides = []
+            stride = dtype.itemsize
+            for size in reversed(shape):
+                strides.insert(0, stride)
+                stride *= max(size, 1)
+            is_record = bool(var["dimids"]) and var["dimids"][0] == header["record_dim"]
+            if is_record:
+                strides[0] = header["recsize"]
+
+            try:
+                array = np.ndarray(shape, dtype=dtype, buffer=self._mmap, offset=var["begin"], strides=tuple(strides))
+            except TypeError:  # buffer too small
+                raise ValueError("Variable {} extends beyond the end of {}".format(var["name"], file_path))
+            self.variables[var["name"]] = ClassicVariable(var["name"], dims, var["attributes"], array, self)
+
+    def filepath(self):
+        return self.filepath_
+
+    def isopen(self):
+        return self._mmap is not None
+
+    # Views which were handed out stay valid, the memory map is released when the last of them is gone
+    def close(self):
+        self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __repr__(self):
+        lines = ["<class 'classicnc.ClassicDataset'>", "root group ({} data model, file format {}):".format(self.data_model, self.file_format)]
+        for key, value in self._attributes.items():
+            lines.append("    {}: {}".format(key, value))
+        lines.append("    dimensions(sizes): " + ", ".join("{}({})".format(d.name, d.size) for d in self.dimensions.values()))
+        lines.append("    variables(dimensions): " + ", ".join("{} {}({})".format(v.dtype, v.name, ", ".join(v.dimensions)) for v in self.variables.values()))
+        return "\n".join(lines)
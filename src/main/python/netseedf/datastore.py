@@ -0,0 +1,323 @@
+import os
+import time
+
+import numpy as np
+import numpy.ma as ma
+from netCDF4 import num2date
+
+import datautils
+import jobs
+import membudget
+import perf
+import resample
+
+# Process wide store of the data of open variables, shared by all windows which show the same variable (e.g. the
+# table and the map of it). Windows subscribe to a variable when they open and unsubscribe when they close, while a
+# variable has subscribers its coordinates, axes and decoded dates are kept once and every window gets read-only views
+# of the same arrays (a window which changes the data, e.g. converting units, works on a copy). Read slices are kept
+# in a cache of the memory budget (see membudget) as long as it has room for them. When the last window of a variable
+# closes its data is released.
+#
+# Windows of a variable can also be linked: when the slice of one linked window changes, the other linked windows
+# follow it (see publish_slice).
+#
+# Files which are still being written (e.g. the output of a running model) grow along their unlimited dim. When the
+# file of a variable has changed and only its slice axes grew, just the appended records of the axes are read and the
+# stored axes and decoded dates are extended, the slices read before are kept (see extend_stored). Windows which
+# follow the file call refresh every FOLLOW_INTERVAL_MS.
+#
+# Windows can show the time dim resampled to calendar periods (see resample). The groups of a period are computed once
+# per variable and the aggregated slices are kept in the same cache as the slices. A missing aggregated slice is
+# computed as a background job, which is shared by the windows of the variable and tells them with
+# on_resampled_data(error) when it is done.
+#
+# The store is only used from the GUI thread.
+
+class StoredVariable:
+    def __init__(self, key):
+        self.key = key
+        self.subscribers = []
+        self.file_state = None
+        self.initial_data = None  # datautils.read_initial_data of the whole grid, without a slice
+        self.dates = {}  # index of a sliceable dim -> decoded dates of its axis, None if it has no dates
+        self.sizes = None  # sizes of the dims of the variable when its axes were read
+        self.groups = {}  # period -> resample.get_groups of the time axis
+
+
+FOLLOW_INTERVAL_MS = 2000
+
+
+_slices = membudget.BudgetedCache("slices")  # (variable key, slice key) -> data, (..., (statistic, start, stop)) if aggregated
+_resample_jobs = {}  # key of an aggregated slice -> job computing it
+_listening = False  # whether on_job_changed listens to the jobs
+
+
+_variables = {}  # (file path, variable name) -> StoredVariable
+
+
+def get_key(var_props):
+    return os.path.abspath(var_props["file_path"]), var_props["variable_name"]
+
+
+def subscribe(var_props, subscriber):
+    key = get_key(var_props)
+    if key not in _variables:
+        _variables[key] = StoredVariable(key)
+    _variables[key].subscribers.append(subscriber)
+
+
+def unsubscribe(var_props, subscriber):
+    key = get_key(var_props)
+    stored = _variables.get(key)
+    if stored is None or subscriber not in stored.subscribers:
+        return
+    stored.subscribers.remove(subscriber)
+    if not stored.subscribers:
+        del _variables[key]
+        _slices.remove_where(lambda slice_key: slice_key[0] == key)
+        cancel_resample_jobs(key)
+        membudget.untrack(stored)
+
+
+def get_subscribers(var_props):
+    stored = _variables.get(get_key(var_props))
+    return list(stored.subscribers) if stored is not None else []
+
+
+# Returns the stored variable with data which is still valid, None if the variable has no subscribers
+def get_stored(var_props):
+    stored = _variables.get(get_key(var_props))
+    if stored is None:
+        return None
+    file_state = datautils.get_file_state(stored.key[0])
+    if file_state != stored.file_state:
+        stored.file_state = file_state
+        if not extend_stored(stored, var_props):
+            stored.initial_data = None
+            stored.sizes = None
+            stored.dates = {}
+            stored.groups = {}
+            _slices.remove_where(lambda slice_key: slice_key[0] == stored.key)
+            cancel_resample_jobs(stored.key)
+    return stored
+
+
+# Checks whether the file of the variable has changed, called periodically by windows which follow a growing file
+def refresh(var_props):
+    get_stored(var_props)
+
+
+# Extends the stored axes and dates by the records appended to the file since they were read and tells the
+# subscribers about the new sizes with on_file_grown(sizes, slicedata). Returns False if the file has changed in
+# another way (or nothing was stored yet) and the stored data has to be read again.
+def extend_stored(stored, var_props):
+    if stored.initial_data is None or stored.sizes is None:
+        return False
+    try:
+        sizes, appended = datautils.read_appended(var_props, stored.sizes)
+    except Exception:
+        return False
+    if not appended or any(sizes.get(d) != s for d, s in stored.sizes.items() if d not in appended):
+        return False
+
+    slicedata, slicecalendar, slicetunits = list(stored.initial_data[0]), stored.initial_data[1], stored.initial_data[2]
+    grown = []  # (index of the sliceable dim, its previous size)
+    for i, dim in enumerate(var_props["sliceable_dims"]):
+        if dim not in appended:
+            continue
+        grown.append((i, stored.sizes[dim]))
+        concatenate = ma.concatenate if ma.isMaskedArray(slicedata[i]) or ma.isMaskedArray(appended[dim]) else np.concatenate
+        slicedata[i] = make_read_only(concatenate([slicedata[i], appended[dim]]))
+        perf.count("appended_records", len(appended[dim]))
+        if stored.dates.get(i) is not None:
+            try:
+                stored.dates[i] = np.concatenate([stored.dates[i], num2date(appended[dim], slicetunits[i], slicecalendar[i])])
+            except Exception:
+                del stored.dates[i]  # decoded again when asked for
+    stored.initial_data[0] = slicedata
+    stored.sizes = sizes
+    stored.groups = {}
+    membudget.track(stored, "decoded times", sum(membudget.get_size(d) for d in stored.dates.values() if d is not None))
+
+    # the last record before may have been read while it was being written
+    _slices.remove_where(lambda slice_key: slice_key[0] == stored.key and
+                         any(slice_key[1][0][i] >= size - 1 for i, size in grown))
+
+    for subscriber in list(stored.subscribers):
+        subscriber.on_file_grown(dict(sizes), [read_only_view(axis) for axis in slicedata])
+    return True
+
+
+def make_read_only(data):
+    if isinstance(data, np.ndarray):
+        data.flags.writeable = False
+        mask = ma.getmask(data)
+        if mask is not ma.nomask:
+            mask.flags.writeable = False
+    return data
+
+
+def read_only_view(data):
+    if isinstance(data, np.ndarray):
+        return data.view()
+    return data
+
+
+# Same as datautils.get_initial_data, coordinates and axes are read once per variable
+def get_initial_data(var_props, read_slice=True):
+    stored = get_stored(var_props)
+    if stored is not None and stored.initial_data is not None:
+        perf.count("store_hits")
+        initial_data = stored.initial_data
+    else:
+        with perf.operation("get_initial_data", variable=var_props["variable_name"]):
+            initial_data = datautils.read_initial_data(dict(var_props, region=None), read_slice=False)
+        initial_data = list(initial_data)
+        initial_data[0] = [make_read_only(axis) for axis in initial_data[0]]
+        for i in (7, 8, 10, 11):  # boundaries and coordinates
+            initial_data[i] = make_read_only(initial_data[i])
+        if stored is not None:
+            stored.initial_data = initial_data
+            stored.sizes = dict(var_props["sizes"], **{dim: len(axis) for dim, axis in zip(var_props["sliceable_dims"], initial_data[0])})
+
+    slicedata, slicecalendar, slicetunits, timesliceindex, variable_units, variable_calendar, variable_description, xboundaries, yboundaries, _, xdata, ydata, xdataunit, ydataunit = initial_data
+    xdata, ydata, xboundaries, yboundaries = datautils.crop_to_region(var_props, read_only_view(xdata), read_only_view(ydata),
+                                                                      read_only_view(xboundaries), read_only_view(yboundaries))
+    slicedata = [read_only_view(axis) for axis in slicedata]
+
+    sliced_data = None
+    if read_slice:
+        sliced_data = get_sliced_data(var_props, [0 for _ in range(len(var_props["sliceable_dims"]))])
+
+    return slicedata, slicecalendar, slicetunits, timesliceindex, variable_units, variable_calendar, variable_description, xboundaries, yboundaries, sliced_data, xdata, ydata, xdataunit, ydataunit
+
+
+def get_slice_key(var_props, slice_indices, x_slice, y_slice):
+    def window_key(s):
+        return None if s is None else (s.start, s.stop, s.step)
+    region = var_props.get("region")
+    return (tuple(int(i) for i in slice_indices), tuple(region) if region is not None else None,
+            window_key(x_slice), window_key(y_slice))
+
+
+# Same as datautils.get_sliced_data, a slice read by one window is shared with the other windows of the variable
+def get_sliced_data(var_props, slice_indices, x_slice=None, y_slice=None):
+    stored = get_stored(var_props)
+    if stored is None:
+        return datautils.get_sliced_data(var_props, slice_indices, x_slice, y_slice)
+
+    slice_key = (stored.key, get_slice_key(var_props, slice_indices, x_slice, y_slice))
+    data = _slices.get(slice_key)
+    if data is not None:
+        perf.count("store_hits")
+    else:
+        start = time.perf_counter()
+        data = make_read_only(datautils.get_sliced_data(var_props, slice_indices, x_slice, y_slice))
+        _slices.put(slice_key, data, cost=time.perf_counter() - start)
+    return read_only_view(data)
+
+
+# Decoded dates (num2date) of the axis of the i-th sliceable dim, None if the axis has no dates. The dates are decoded
+# once per variable and shared by its windows, they count against the memory budget until the variable is closed.
+def get_slice_dates(var_props, i, slicedata, slicetunits, slicecalendar):
+    stored = get_stored(var_props)
+    if stored is not None and i in stored.dates:
+        return stored.dates[i]
+    try:
+        dates = num2date(slicedata[i], slicetunits[i], slicecalendar[i])
+    except Exception:
+        dates = None
+    if stored is not None:
+        stored.dates[i] = dates
+        membudget.track(stored, "decoded times", sum(membudget.get_size(d) for d in stored.dates.values() if d is not None))
+    return dates
+
+
+# Groups of the time axis for a period (see resample.get_groups), None if the axis has no dates. Arguments as for
+# get_slice_dates, i is the index of the time dim among the sliceable dims.
+def get_groups(var_props, period, i, slicedata, slicetunits, slicecalendar):
+    stored = get_stored(var_props)
+    if stored is not None and period in stored.groups:
+        return stored.groups[period]
+    dates = get_slice_dates(var_props, i, slicedata, slicetunits, slicecalendar)
+    groups = resample.get_groups(dates, period) if dates is not None else None
+    if stored is not None:
+        stored.groups[period] = groups
+    return groups
+
+
+# Slice of the time steps t_range (start, stop) aggregated by the statistic (see resample.aggregate_slice), the index
+# of the time dim in slice_indices is ignored. Returns None if the slice has not been computed yet, it is then
+# computed as a job named after label and the subscribers of the variable are told with on_resampled_data(state,
+# error) when it has finished, failed or was cancelled (e.g. in the jobs panel).
+def get_resampled_data(var_props, slice_indices, t_range, statistic, label):
+    stored = get_stored(var_props)
+    start, stop = int(t_range[0]), int(t_range[1])
+    t_index = var_props["sliceable_dims"].index(var_props["t_dim"])
+    indices = [stop - 1 if i == t_index else index for i, index in enumerate(slice_indices)]  # see extend_stored
+    key = (get_key(var_props), get_slice_key(var_props, indices, None, None), (statistic, start, stop))
+
+    data = _slices.get(key)
+    if data is not None:
+        perf.count("store_hits")
+        return read_only_view(data)
+    if stored is None:
+        return None
+    job = _resample_jobs.get(key)
+    if job is not None and not job.is_done():
+        return None
+
+    def on_done(job):
+        _resample_jobs.pop(key, None)
+        if job.state == jobs.FINISHED and key[0] in _variables:
+            _slices.put(key, make_read_only(job.result), cost=job.get_duration())
+        for subscriber in get_subscribers(var_props):
+            subscriber.on_resampled_data(job.state, job.error)
+
+    global _listening
+    if not _listening:
+        jobs.add_listener(on_job_changed)
+        _listening = True
+
+    job_props = dict(var_props, sizes=dict(var_props["sizes"]))  # the window may change its var_props meanwhile
+    _resample_jobs[key] = jobs.submit(label + " of " + var_props["variable_name"],
+                                      lambda job: resample.aggregate_slice(job_props, indices, (start, stop), statistic, job),
+                                      var_props["file_path"], jobs.PRIORITY_HIGH, on_done)
+    return None
+
+
+def cancel_resample_jobs(variable_key):
+    for key, job in list(_resample_jobs.items()):
+        if key[0] == variable_key:
+            jobs.cancel(job)
+
+
+# Cancelled jobs do not call on_done, the subscribers waiting for a cancelled aggregated slice are told here
+def on_job_changed(job):
+    if job.state != jobs.CANCELLED:
+        return
+    for key, resample_job in list(_resample_jobs.items()):
+        if resample_job is job:
+            del _resample_jobs[key]
+            stored = _variables.get(key[0])
+            for subscriber in list(stored.subscribers) if stored is not None else []:
+                subscriber.on_resampled_data(job.state, None)
+
+
+# Tells the other linked windows of the variable that the slice of a window has changed. Subscribers implement
+# is_slice_linked() and on_linked_slice(slice_indices).
+def publish_slice(var_props, slice_indices, sender):
+    for subscriber in get_subscribers(var_props):
+        if subscriber is not sender and subscriber.is_slice_linked():
+            subscriber.on_linked_slice(list(slice_indices))
+
+
+# Number of variables and bytes held by the store
+def get_usage():
+    nbytes = _slices.nbytes
+    for stored in _variables.values():
+        nbytes += sum(membudget.get_size(dates) for dates in stored.dates.values() if dates is not None)
+        if stored.initial_data is not None:
+            nbytes += sum(a.nbytes for a in stored.initial_data[0] if isinstance(a, np.ndarray))
+            nbytes += sum(stored.initial_data[i].nbytes for i in (7, 8, 10, 11) if isinstance(stored.initial_data[i], np.ndarray))
+    return len(_variables), nbytes
@@ -3,16 +3,155 @@ from PySide6.QtWidgets import QMenu, QApplication
 from netCDF4 import Dataset, num2date
 import numpy.ma as ma
 import numpy as np
+import os
+import threading
+import traceback
 
 import utils
-
-LON_NAMES = {"lon", "longitude", "LONGITUDE", "LON", "x", "X"}
-LAT_NAMES = {"lat", "latitude", "LATITUDE", "LAT", "y", "Y"}
+import perf
+import classicnc
+import derived
+import zarrstore
+import parallelread
+import readplanner
+
+LON_NAMES = {"lon", "longitude", "LONGITUDE", "LON", "x", "X", "rlon", "easting"}
+LAT_NAMES = {"lat", "latitude", "LATITUDE", "LAT", "y", "Y", "rlat", "northing"}
 TIME_NAMES = {"time", "Time", "T", "valid_time", "date"}
 
 
+# Storage backends as (check if a path can be opened, dataset class). The datasets implement the parts of the
+# netCDF4.Dataset interface used by NetSeeDF (variables, dimensions, groups, ncattrs/getncattr, close) and their
+# variables the parts of netCDF4.Variable (dimensions, shape, attributes, get_fill_value, chunking, indexing).
+# Uncompressed NetCDF3 files are memory mapped by classicnc, Zarr stores are read by zarrstore and derived variables
+# (expressions over other variables, see derived) are evaluated by derived.
+BACKENDS = [
+    (derived.is_derived, derived.DerivedDataset),
+    (classicnc.is_classic, classicnc.ClassicDataset),
+    (zarrstore.is_zarr, zarrstore.ZarrDataset),
+]
+
+
+# The netCDF library is not thread-safe. Files opened with it hold this lock from open_dataset until they are closed,
+# so the GUI thread and background jobs (see jobs) never call the library at the same time. Jobs which read a lot
+# open the file for every block (see read_block), so the lock is released between the blocks. Every file has to be
+# closed in a finally block on the thread which opened it, a file left open keeps the other threads waiting.
+netcdf_lock = threading.RLock()
+
+
+class LockedDataset(Dataset):
+    def __init__(self, file_path, mode="r", **kwargs):
+        netcdf_lock.acquire()
+        try:
+            super().__init__(file_path, mode, **kwargs)
+        except BaseException:
+            netcdf_lock.release()
+            raise
+        self.__dict__["_thread"] = threading.get_ident()  # not through setattr, which writes a netCDF attribute
+
+    def close(self):
+        if self.isopen():
+            try:
+                super().close()
+            finally:
+                readplanner.forget_file(self)  # its chunk caches are freed
+                netcdf_lock.release()
+
+    def __del__(self):  # a file which was not closed, the lock can only be released by the thread which holds it
+        if self.isopen() and self.__dict__.get("_thread") == threading.get_ident():
+            self.close()
+
+
+# Opens a file or store for reading with the first backend that can handle it. HDF5 based NetCDF4 files, and files a
+# backend fails to parse, are read with the netCDF4 library.
+def open_dataset(file_path):
+    for can_open, dataset_class in BACKENDS:
+        if can_open(file_path):
+            try:
+                return dataset_class(file_path)
+            except (ValueError, KeyError):
+                pass  # let the netCDF library try, it also reports errors in a more familiar way
+    return LockedDataset(file_path, "r")
+
+
+# Size and modification time of a file or store, None if it cannot be read (e.g. derived variables). Data read from a
+# file is read again when its state changes.
+def get_file_state(file_path):
+    try:
+        if zarrstore.is_zarr(file_path):
+            return zarrstore.get_store_state(file_path)
+        stat = os.stat(file_path)
+        return stat.st_size, stat.st_mtime_ns
+    except OSError:
+        return None
+
+
+# Variables in groups are addressed by their path, e.g. "group/subgroup/variable", variables in the root group by
+# their name. Group paths are "group/subgroup" and "" for the root group.
+def split_variable_path(variable_path):
+    parts = [p for p in variable_path.split("/") if p]
+    return "/".join(parts[:-1]), parts[-1]
+
+
+def get_group(ncfile, group_path):
+    group = ncfile
+    for part in [p for p in group_path.split("/") if p]:
+        group = group.groups[part]
+    return group
+
+
+def get_variable(ncfile, variable_path):
+    group_path, name = split_variable_path(variable_path)
+    return get_group(ncfile, group_path).variables[name]
+
+
+# Finds a variable by name in the group of another variable or in one of its parent groups, like dimensions are found
+# (coordinate variables of a variable in a group can be defined in a parent group). Raises KeyError if there is none.
+def find_scoped_variable(ncfile, variable_path, name):
+    group_path, _ = split_variable_path(variable_path)
+    parts = [p for p in group_path.split("/") if p]
+    while True:
+        group = get_group(ncfile, "/".join(parts))
+        if name in group.variables:
+            return group.variables[name]
+        if not parts:
+            raise KeyError(name)
+        parts = parts[:-1]
+
+
+# Text shown for a variable in the tree of files: long_name, standard_name or description
+def get_variable_description(var):
+    for attr in ("long_name", "standard_name", "description"):
+        try:
+            return str(var.getncattr(attr))
+        except Exception:
+            pass
+    return ""
+
+
+def get_variable_shape_text(var):
+    try:
+        return str(var.shape)
+    except IndexError:
+        return ""
+
+
+# Lists the subgroups and variables of a group as (kind, name, path, description, shape text), kind is "group" or
+# "variable". Only the group itself is scanned, so large hierarchies are listed one group at a time.
+def scan_group(ncfile, group_path):
+    group = get_group(ncfile, group_path)
+    prefix = group_path.strip("/") + "/" if group_path.strip("/") else ""
+
+    entries = []
+    for name in group.groups:
+        entries.append(("group", name, prefix + name, "", ""))
+    for name, var in group.variables.items():
+        entries.append(("variable", name, prefix + name, get_variable_description(var), get_variable_shape_text(var)))
+    return entries
+
+
 def get_shape_info_from_ncfile(ncfile, variable_name):
-    variable_shape = ncfile.variables[variable_name].shape
+    variable_shape = get_variable(ncfile, variable_name).shape
     num_dimensions = len(variable_shape)
 
     drop_dim_indices = []
@@ -25,9 +164,11 @@ def get_shape_info_from_ncfile(ncfile, variable_name):
     return variable_shape, num_dimensions, drop_dim_indices
 
 def get_shape_info(file_path, variable_name):
-    ncfile = Dataset(file_path, "r")
-    variable_shape, num_dimensions, drop_dim_indices = get_shape_info_from_ncfile(ncfile, variable_name)
-    ncfile.close()
+    ncfile = open_dataset(file_path)
+    try:
+        variable_shape, num_dimensions, drop_dim_indices = get_shape_info_from_ncfile(ncfile, variable_name)
+    finally:
+        ncfile.close()
 
     return variable_shape, num_dimensions, drop_dim_indices
 
@@ -67,24 +208,100 @@ def identify_dims_from_vardata(dims, shapes):
     }
 
 def identify_dims(file_path, variable_name):
-    ncfile = Dataset(file_path, "r")
-    var = ncfile.variables[variable_name]
-    dims = list(var.dimensions)
-    shapes = list(var.shape)
-
-    var_props = identify_dims_from_vardata(dims, shapes)
+    ncfile = open_dataset(file_path)
+    try:
+        var = get_variable(ncfile, variable_name)
+        dims = list(var.dimensions)
+        shapes = list(var.shape)
 
-    var_props["file_path"] = file_path
-    var_props["variable_name"] = variable_name
-    var_props["fill_value"] = var.get_fill_value()
+        var_props = identify_dims_from_vardata(dims, shapes)
 
-    ncfile.close()
+        var_props["file_path"] = file_path
+        var_props["variable_name"] = variable_name
+        var_props["fill_value"] = var.get_fill_value()
+    finally:
+        ncfile.close()
 
     return var_props
 
-def slice_timeseries(var_props, slice_indices, x_index, y_index, chosen_dim_name):
-    ncfile = Dataset(var_props["file_path"], "r")
-    vardata = ncfile.variables[var_props["variable_name"]]
+# A region limits all reads of a variable to a rectangle of the horizontal grid, var_props["region"] is
+# (x start, x stop, y start, y stop) in indices of the full grid, or None (or missing) for the whole grid. Indices
+# and slices of x and y passed to the functions below are relative to the region, like the coordinates returned by
+# get_initial_data, and are translated to the full grid here.
+def region_index(var_props, dim, index):
+    region = var_props.get("region")
+    if region is None:
+        return index if index is not None else slice(None)
+
+    start, stop = region[0:2] if dim == "x" else region[2:4]
+    if index is None:
+        return slice(start, stop)
+    if isinstance(index, slice):
+        index_start, index_stop, step = index.indices(stop - start)
+        return slice(start + index_start, start + index_stop, step)
+    return start + int(index)
+
+
+# Region (see region_index) of the cells with centers inside the lat/lon bounds, or of the cell nearest to the bounds
+# along an axis with no cell inside. Longitudes are compared in the range of the grid (0..360 or -180..180), so bounds
+# may cross 180° E on 0..360 grids and 0° E on -180..180 grids. A region is one contiguous block of cells, bounds
+# which cross the edge of the range of the grid are not supported. Raises ValueError with a message for the user if
+# the bounds do not select any cells.
+def get_region(xdata, ydata, south, west, north, east):
+    xdata = np.asarray(xdata, dtype=np.float64)
+    ydata = np.asarray(ydata, dtype=np.float64)
+    lon_min = 0 if np.nanmax(xdata) > 180 else -180
+    if south >= north:
+        raise ValueError("The selected region is empty, its south edge has to be below its north edge.")
+    if east - west >= 360:
+        west, east = lon_min, lon_min + 360
+    else:
+        west, east = (west - lon_min) % 360 + lon_min, (east - lon_min) % 360 + lon_min
+        if east == lon_min:
+            east = lon_min + 360
+    if west > east:
+        raise ValueError("The selected region crosses {0:g}° E, the edge of the longitudes of this grid, which run from {1:g}° "
+                         "to {2:g}° E. Regions have to lie within this range.".format(lon_min % 360, lon_min, lon_min + 360))
+
+    def index_range(centers, low, high):
+        inside = np.nonzero((centers >= low) & (centers <= high))[0]
+        if len(inside):
+            return int(inside[0]), int(inside[-1]) + 1
+        if high < np.nanmin(centers) or low > np.nanmax(centers):
+            return None
+        nearest = int(np.nanargmin(np.abs(centers - (low + high) / 2)))
+        return nearest, nearest + 1
+
+    x_range = index_range(xdata, west, east)
+    y_range = index_range(ydata, south, north)
+    if x_range is None or y_range is None:
+        raise ValueError("The selected region does not contain any grid points! The grid covers {0:g}° to {1:g}° E and {2:g}° "
+                         "to {3:g}° N.".format(np.nanmin(xdata), np.nanmax(xdata), np.nanmin(ydata), np.nanmax(ydata)))
+    return x_range + y_range
+
+
+# Crops coordinates and cell boundaries of the whole grid to the region of the variable
+def crop_to_region(var_props, xdata, ydata, xboundaries, yboundaries):
+    region = var_props.get("region")
+    if region is None or xdata is None or ydata is None:
+        return xdata, ydata, xboundaries, yboundaries
+
+    x_start, x_stop, y_start, y_stop = region
+    if xboundaries is not None and len(xboundaries) > len(xdata):  # n + 1 boundaries, grids of one cell have none
+        xboundaries = xboundaries[x_start:x_stop + 1]
+        yboundaries = yboundaries[y_start:y_stop + 1]
+    else:
+        xboundaries, yboundaries = xdata[x_start:x_stop], ydata[y_start:y_stop]
+    return xdata[x_start:x_stop], ydata[y_start:y_stop], xboundaries, yboundaries
+
+
+def slice_timeseries(var_props, slice_indices, x_index, y_index, chosen_dim_name, job=None):
+    with perf.operation("slice_timeseries", variable=var_props["variable_name"]):
+        return read_timeseries(var_props, slice_indices, x_index, y_index, chosen_dim_name, job)
+
+
+def read_timeseries(var_props, slice_indices, x_index, y_index, chosen_dim_name, job=None):
+    shape, itemsize, chunk_shape = get_variable_layout(var_props)
 
     # build slices covering all dims in var order
     slices = []
@@ -92,9 +309,9 @@ def slice_timeseries(var_props, slice_indices, x_index, y_index, chosen_dim_name
         d = var_props["all_dims"][i]
         if d not in var_props["drop_dims"]:
             if d == var_props["x_dim"]:
-                slices.append(x_index)
+                slices.append(region_index(var_props, "x", x_index))
             elif d == var_props["y_dim"]:
-                slices.append(y_index)
+                slices.append(region_index(var_props, "y", y_index))
             elif d == chosen_dim_name:
                 slices.append(slice(None))
             else:
@@ -102,13 +319,57 @@ def slice_timeseries(var_props, slice_indices, x_index, y_index, chosen_dim_name
         else:
             slices.append(0)
 
-    timeseries = vardata[tuple(slices)]
-
-    ncfile.close()
-
-    return timeseries
-
-def slice_data(var_props, slice_indices, vardata):
+    # the series is read in pieces, each with the file opened only for the piece (see read_block)
+    axis = list(var_props["all_dims"]).index(chosen_dim_name)
+    pieces = get_series_pieces(shape, itemsize, chunk_shape, axis, 1)
+    timeseries = []
+    for piece_start, piece_stop in pieces:
+        slices[axis] = slice(piece_start, piece_stop)
+        with perf.span("read"):
+            timeseries.append(read_block(var_props, tuple(slices)))
+        perf.count("bytes_read", timeseries[-1].nbytes)
+        if job is not None:
+            job.set_progress(piece_stop / max(1, shape[axis]))
+
+    return ma.concatenate(timeseries)
+
+
+SERIES_BLOCK_BYTES = 16 * 1024 * 1024  # chunk data decompressed by one piece of a time series
+
+
+# Time series are read in pieces of whole chunks along the series dim (axis) which decompress about SERIES_BLOCK_BYTES,
+# each with the file opened only for the piece. Reading the series of a point touches every chunk along the axis, the
+# lock of the netCDF library (see netcdf_lock) is released between the pieces so the GUI thread can read in between.
+# cells is the number of values read at every index of the axis, a piece decompresses at least the chunks containing
+# them. Blocks of other reads along an axis (e.g. of a region or a section) are sized the same way with their own
+# block_bytes. Returns the ranges (start, stop) of the pieces from start to the end of the axis.
+def get_series_pieces(shape, itemsize, chunk_shape, axis, cells, start=0, block_bytes=None):
+    step_bytes = cells * itemsize
+    chunk_length = 1
+    if chunk_shape is not None:
+        chunk_length = chunk_shape[axis]
+        step_bytes = max(step_bytes, int(np.prod(chunk_shape, dtype=np.int64)) * itemsize // chunk_length)
+    piece_length = (block_bytes or SERIES_BLOCK_BYTES) // max(1, step_bytes)
+    piece_length = max(chunk_length, piece_length // chunk_length * chunk_length)
+    edges = [start] + list(range((start // piece_length + 1) * piece_length, shape[axis], piece_length)) + [shape[axis]]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+# Reads a hyperslab of a variable. Large reads of compressed NetCDF4 variables are split and read in parallel by
+# worker processes, if that fails (or for smaller reads) the variable is read following the plan of readplanner.
+def read_hyperslab(var_props, vardata, key):
+    if parallelread.should_read_in_parallel(vardata, key):
+        try:
+            with perf.span("parallel read"):
+                return parallelread.read(var_props["file_path"], var_props["variable_name"], vardata, key)
+        except Exception:
+            traceback.print_exc()
+    return readplanner.read(vardata, key)
+
+
+# Reads the 2D slice of a variable at slice_indices. x_slice and y_slice select a window and/or a stride of the
+# horizontal dims, by default the whole grid is read.
+def slice_data(var_props, slice_indices, vardata, x_slice=None, y_slice=None):
     if vardata.shape == (1,):
         return vardata[:]
 
@@ -117,105 +378,366 @@ def slice_data(var_props, slice_indices, vardata):
     for i in range(len(var_props["all_dims"])): # I am so sorry to anyone reading this
         d = var_props["all_dims"][i]
         if d not in var_props["drop_dims"]:
-            if d == var_props["x_dim"] or d == var_props["y_dim"]:
-                slices.append(slice(None))
+            if d == var_props["x_dim"]:
+                slices.append(region_index(var_props, "x", x_slice))
+            elif d == var_props["y_dim"]:
+                slices.append(region_index(var_props, "y", y_slice))
             else:
                 if d not in var_props["sliceable_dims"] or var_props["can_slice"]:
                     slices.append(slice_indices[i])
         else:
             slices.append(0)
 
-    plotdata = vardata[tuple(slices)]
+    with perf.span("read"):
+        plotdata = read_hyperslab(var_props, vardata, tuple(slices))
+    perf.count("bytes_read", plotdata.nbytes)
 
     # mask the data with the fill value from netcdf file
-    return ma.masked_equal(plotdata, var_props["fill_value"])
+    with perf.span("mask"):
+        return ma.masked_equal(plotdata, var_props["fill_value"])
 
 
-def get_initial_data(var_props):
-    ncfile = Dataset(var_props["file_path"], "r")
+# read_slice=False skips reading the first slice (returned as None), for callers which read it at a lower resolution
+def get_initial_data(var_props, read_slice=True):
+    with perf.operation("get_initial_data", variable=var_props["variable_name"]):
+        return read_initial_data(var_props, read_slice)
 
-    vardata = ncfile.variables[var_props["variable_name"]]
-
-    xdata, ydata = None, None
-    try:
-        xdata = ncfile.variables[var_props["x_dim"]][:]
-        ydata = ncfile.variables[var_props["y_dim"]][:]
-    except:
-        pass
-
-    xdataunit = None
-    try:
-        xdataunit = ncfile.variables[var_props["x_dim"]].units
-    except Exception:
-        pass
 
-    ydataunit = None
+def read_initial_data(var_props, read_slice=True):
+    with perf.span("open"):
+        ncfile = open_dataset(var_props["file_path"])
     try:
-        ydataunit = ncfile.variables[var_props["y_dim"]].units
-    except Exception:
-        pass
+        vardata = get_variable(ncfile, var_props["variable_name"])
 
-    slicedata = []
-    slicecalendar = []
-    slicetunits = []
-    timesliceindex = 0
+        xdata, ydata = None, None
+        with perf.span("coordinates"):
+            try:
+                xdata = find_scoped_variable(ncfile, var_props["variable_name"], var_props["x_dim"])[:]
+                ydata = find_scoped_variable(ncfile, var_props["variable_name"], var_props["y_dim"])[:]
+            except:
+                pass
 
-    if var_props["can_slice"]:
-        for i in range(len(var_props["sliceable_dims"])):
-            slice_dim = var_props["sliceable_dims"][i]
-            slice_variable = ncfile.variables[slice_dim]
+        xdataunit = None
+        try:
+            xdataunit = find_scoped_variable(ncfile, var_props["variable_name"], var_props["x_dim"]).units
+        except Exception:
+            pass
+
+        ydataunit = None
+        try:
+            ydataunit = find_scoped_variable(ncfile, var_props["variable_name"], var_props["y_dim"]).units
+        except Exception:
+            pass
+
+        slicedata = []
+        slicecalendar = []
+        slicetunits = []
+        timesliceindex = 0
+
+        if var_props["can_slice"]:
+            for i in range(len(var_props["sliceable_dims"])):
+                slice_dim = var_props["sliceable_dims"][i]
+                slice_variable = find_scoped_variable(ncfile, var_props["variable_name"], slice_dim)
+
+                with perf.span("slice axes"):
+                    slicedata.append(slice_variable[:])
+
+                calendar = None
+                try:
+                    calendar = slice_variable.calendar
+                except Exception:
+                    pass
+                slicecalendar.append(calendar)
+
+                tunits = None
+                try:
+                    tunits = slice_variable.units
+                except Exception:
+                    pass
+                slicetunits.append(tunits)
+
+                if slice_dim == var_props["t_dim"]:
+                    timesliceindex = i
+
+        variable_units = None
+        try:
+            variable_units = vardata.units
+        except Exception:
+            pass
+
+        variable_calendar = None
+        try:
+            variable_calendar = vardata.calendar
+        except Exception:
+            pass
+
+        variable_description = None
+        try:
+            variable_description = vardata.description
+        except Exception:
+            pass
+
+        if xdata is not None and ydata is not None:
+            with perf.span("boundaries"):
+                xboundaries, yboundaries = utils.grid_boundaries_from_centers(xdata, ydata)
+        else:
+            xboundaries, yboundaries = None, None
 
-            slicedata.append(slice_variable[:])
+        xdata, ydata, xboundaries, yboundaries = crop_to_region(var_props, xdata, ydata, xboundaries, yboundaries)
 
-            calendar = None
-            try:
-                calendar = slice_variable.calendar
-            except Exception:
-                pass
-            slicecalendar.append(calendar)
+        sliced_data = None
+        if read_slice:
+            sliced_data = slice_data(var_props, [0 for _ in range(len(var_props["sliceable_dims"]))], vardata)
+    finally:
+        ncfile.close()
 
-            tunits = None
-            try:
-                tunits = slice_variable.units
-            except Exception:
-                pass
-            slicetunits.append(tunits)
+    return slicedata, slicecalendar, slicetunits, timesliceindex, variable_units, variable_calendar, variable_description, xboundaries, yboundaries, sliced_data, xdata, ydata, xdataunit, ydataunit
 
-            if slice_dim == var_props["t_dim"]:
-                timesliceindex = i
 
-    variable_units = None
+# Current sizes of the dims of a variable and the records of the slice axes which were appended to a file that is
+# still being written: sliceable dim -> values of its coordinate variable from old_sizes[dim] on, for the dims which
+# grew. Only the new records are read.
+def read_appended(var_props, old_sizes):
+    with perf.operation("read_appended", variable=var_props["variable_name"]):
+        ncfile = open_dataset(var_props["file_path"])
+        try:
+            vardata = get_variable(ncfile, var_props["variable_name"])
+            sizes = dict(zip(vardata.dimensions, vardata.shape))
+            appended = {}
+            for dim in var_props["sliceable_dims"]:
+                if sizes.get(dim, 0) > old_sizes[dim]:
+                    with perf.span("slice axes"):
+                        appended[dim] = find_scoped_variable(ncfile, var_props["variable_name"], dim)[old_sizes[dim]:sizes[dim]]
+        finally:
+            ncfile.close()
+    return sizes, appended
+
+
+def get_sliced_data(var_props, slice_indices, x_slice=None, y_slice=None):
+    with perf.operation("get_sliced_data", variable=var_props["variable_name"]):
+        with perf.span("open"):
+            ncfile = open_dataset(var_props["file_path"])
+        try:
+            vardata = get_variable(ncfile, var_props["variable_name"])
+            sliced_data = slice_data(var_props, slice_indices, vardata, x_slice, y_slice)
+        finally:
+            ncfile.close()
+        return sliced_data
+
+
+# Value of the slice at one grid point
+def get_point_value(var_props, slice_indices, x_index, y_index):
+    with perf.operation("get_point_value", variable=var_props["variable_name"]):
+        with perf.span("open"):
+            ncfile = open_dataset(var_props["file_path"])
+        try:
+            vardata = get_variable(ncfile, var_props["variable_name"])
+            point_data = slice_data(var_props, slice_indices, vardata, slice(x_index, x_index + 1), slice(y_index, y_index + 1))
+        finally:
+            ncfile.close()
+        return point_data.reshape(-1)[0]
+
+
+# Level of detail reads. A map of a large grid shows far fewer pixels than the grid has cells, so only about one cell
+# per screen pixel is read: every stride-th cell of the window (a strided hyperslab read) or the mean of each
+# stride x stride block of cells. The same stride is used for x and y, so the cells keep their shape.
+
+LOD_METHODS = ("stride", "mean")
+LOD_BLOCK_CELLS = 4 * 1024 * 1024  # cells read at once for block means, bounds the memory used for a huge window
+
+
+# Smallest stride at which a window of nx by ny cells fits into max_x by max_y cells
+def get_lod_stride(nx, ny, max_x, max_y):
+    return max(1, int(np.ceil(nx / max(max_x, 1))), int(np.ceil(ny / max(max_y, 1))))
+
+
+# Index ranges (start, stop) of the cells with centers inside [west, east] and [south, north], extended by one cell on
+# each side, or None if no cell is inside
+def get_index_window(xdata, ydata, west, east, south, north):
+    x_inside = np.nonzero((xdata >= west) & (xdata <= east))[0]
+    y_inside = np.nonzero((ydata >= south) & (ydata <= north))[0]
+    if len(x_inside) == 0 or len(y_inside) == 0:
+        return None
+    x_range = (max(0, int(x_inside[0]) - 1), min(len(xdata), int(x_inside[-1]) + 2))
+    y_range = (max(0, int(y_inside[0]) - 1), min(len(ydata), int(y_inside[-1]) + 2))
+    return x_range, y_range
+
+
+# Means of the stride x stride blocks of 2D data (y, x), masked cells are left out, blocks without data are masked.
+# Blocks at the upper edges can be smaller.
+def block_mean(data, stride):
+    valid = ~ma.getmaskarray(data)
+    values = np.where(valid, ma.getdata(data), 0).astype(np.float64)
+    y_starts = np.arange(0, data.shape[0], stride)
+    x_starts = np.arange(0, data.shape[1], stride)
+
+    sums = np.add.reduceat(np.add.reduceat(values, y_starts, axis=0), x_starts, axis=1)
+    counts = np.add.reduceat(np.add.reduceat(valid.astype(np.int64), y_starts, axis=0), x_starts, axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return ma.masked_where(counts == 0, sums / np.maximum(counts, 1))
+
+
+def block_mean_centers(centers, stride):
+    centers = np.asarray(centers, dtype=np.float64)
+    starts = np.arange(0, len(centers), stride)
+    return np.add.reduceat(centers, starts) / np.diff(np.append(starts, len(centers)))
+
+
+# Reads the window x_range, y_range ((start, stop) indices) of a slice at a reduced resolution.
+# Returns the data and the x and y coordinates of its cell centers.
+def get_lod_data(var_props, slice_indices, xdata, ydata, x_range, y_range, stride, method="stride"):
+    with perf.operation("get_lod_data", variable=var_props["variable_name"], stride=stride, method=method):
+        with perf.span("open"):
+            ncfile = open_dataset(var_props["file_path"])
+        try:
+            vardata = get_variable(ncfile, var_props["variable_name"])
+
+            x_start, x_stop = x_range
+            y_start, y_stop = y_range
+
+            if method == "mean" and stride > 1:
+                # read bands of whole blocks of rows, so only one band is in memory at full resolution
+                band_rows = stride * max(1, LOD_BLOCK_CELLS // max(1, (x_stop - x_start) * stride))
+                bands = []
+                for band_start in range(y_start, y_stop, band_rows):
+                    band = slice_data(var_props, slice_indices, vardata, slice(x_start, x_stop), slice(band_start, min(band_start + band_rows, y_stop)))
+                    with perf.span("block mean"):
+                        bands.append(block_mean(band, stride))
+                lod_data = ma.concatenate(bands, axis=0)
+                xcenters = block_mean_centers(xdata[x_start:x_stop], stride)
+                ycenters = block_mean_centers(ydata[y_start:y_stop], stride)
+            else:
+                lod_data = slice_data(var_props, slice_indices, vardata, slice(x_start, x_stop, stride), slice(y_start, y_stop, stride))
+                xcenters = np.asarray(xdata[x_start:x_stop:stride])
+                ycenters = np.asarray(ydata[y_start:y_stop:stride])
+        finally:
+            ncfile.close()
+        return lod_data, xcenters, ycenters
+
+# Same as get_lod_data for a slice which is already in memory (e.g. an aggregated slice, see resample)
+def get_lod_of_slice(data, xdata, ydata, x_range, y_range, stride, method="stride"):
+    x_start, x_stop = x_range
+    y_start, y_stop = y_range
+    window = data[y_start:y_stop, x_start:x_stop]
+    if method == "mean" and stride > 1:
+        with perf.span("block mean"):
+            return block_mean(window, stride), block_mean_centers(xdata[x_start:x_stop], stride), block_mean_centers(ydata[y_start:y_stop], stride)
+    return window[::stride, ::stride], np.asarray(xdata[x_start:x_stop:stride]), np.asarray(ydata[y_start:y_stop:stride])
+
+# Sections: a 2D section of a variable along any two of its dims (e.g. time x longitude for a Hovmöller diagram or
+# latitude x level), with each other dim either fixed at an index or averaged. The section is read in one pass along
+# the longest of the section and averaged dims, in blocks of whole chunks, so a section through a long time axis is
+# built without reading slice by slice and without holding more than one block in memory.
+
+SECTION_BLOCK_BYTES = 64 * 1024 * 1024  # size of one block read of a section
+
+
+# Chunk size of a variable along each dim, None for contiguous variables
+def get_chunk_shape(vardata):
     try:
-        variable_units = vardata.units
+        chunking = vardata.chunking()
     except Exception:
-        pass
+        return None
+    if chunking is None or chunking == "contiguous" or not chunking:
+        return None
+    return [int(c) for c in chunking]
 
-    variable_calendar = None
-    try:
-        variable_calendar = vardata.calendar
-    except Exception:
-        pass
 
-    variable_description = None
+# Shape, item size and chunk shape (see get_chunk_shape) of a variable, which size the blocks of reads in pieces (see
+# get_series_pieces). The file is opened only to look them up.
+def get_variable_layout(var_props):
+    with perf.span("open"):
+        ncfile = open_dataset(var_props["file_path"])
     try:
-        variable_description = vardata.description
-    except Exception:
-        pass
+        vardata = get_variable(ncfile, var_props["variable_name"])
+        return list(vardata.shape), np.dtype(vardata.dtype).itemsize, get_chunk_shape(vardata)
+    finally:
+        ncfile.close()
 
-    if xdata is not None and ydata is not None:
-        xboundaries, yboundaries = utils.grid_boundaries_from_centers(xdata, ydata)
-    else:
-        xboundaries, yboundaries = None, None
 
-    sliced_data = slice_data(var_props, [0 for _ in range(len(var_props["sliceable_dims"]))], vardata)
+# Reads var[key] of a variable, with the file open only for this read
+def read_block(var_props, key):
+    ncfile = open_dataset(var_props["file_path"])
+    try:
+        return read_hyperslab(var_props, get_variable(ncfile, var_props["variable_name"]), key)
+    finally:
+        ncfile.close()
+
+
+# Reads the section with row_dim along the rows and col_dim along the columns. fixed_indices maps other dims to the
+# index they are fixed at (0 if missing), dims in mean_dims are averaged over. Returns a masked float array. Run as a
+# job (see jobs), the progress is reported to the job after every block and the read stops if it is cancelled.
+def get_section(var_props, row_dim, col_dim, fixed_indices, mean_dims, job=None):
+    with perf.operation("get_section", variable=var_props["variable_name"], rows=row_dim, columns=col_dim):
+        shape, itemsize, chunk_shape = get_variable_layout(var_props)
+        return read_section(var_props, shape, itemsize, chunk_shape, row_dim, col_dim, fixed_indices, mean_dims, job)
+
+
+# The section is read in blocks, each with the file opened only for the block (see read_block)
+def read_section(var_props, shape, itemsize, chunk_shape, row_dim, col_dim, fixed_indices, mean_dims, job=None):
+    dims = list(var_props["all_dims"])
+    read_dims = [d for d in dims if d in (row_dim, col_dim) or d in mean_dims]
+
+    # blocks along the stream dim are whole multiples of its chunk size and hold about SECTION_BLOCK_BYTES
+    stream_dim = max(read_dims, key=lambda d: shape[dims.index(d)])
+    stream_axis = dims.index(stream_dim)
+    cells_per_index = int(np.prod([shape[dims.index(d)] for d in read_dims if d != stream_dim], dtype=np.int64))
+    blocks = get_series_pieces(shape, itemsize, chunk_shape, stream_axis, cells_per_index, block_bytes=SECTION_BLOCK_BYTES)
+
+    sums = np.zeros((shape[dims.index(row_dim)], shape[dims.index(col_dim)]), dtype=np.float64)
+    counts = np.zeros(sums.shape, dtype=np.int64)
+    for block_start, block_stop in blocks:
+        key = []
+        for i, d in enumerate(dims):
+            if i == stream_axis:
+                key.append(slice(block_start, block_stop))
+            elif d in read_dims:
+                key.append(slice(None))
+            else:
+                key.append(int(fixed_indices.get(d, 0)))
+
+        with perf.span("read"):
+            block = read_block(var_props, tuple(key))
+        perf.count("bytes_read", block.nbytes)
+
+        with perf.span("reduce"):
+            block = ma.masked_invalid(ma.masked_equal(block, var_props["fill_value"]))
+            mean_axes = tuple(read_dims.index(d) for d in read_dims if d in mean_dims)
+            block_sums = ma.getdata(block.filled(0).sum(axis=mean_axes, dtype=np.float64))
+            block_counts = ma.count(block, axis=mean_axes) if mean_axes else (~ma.getmaskarray(block)).astype(np.int64)
+            if dims.index(row_dim) > dims.index(col_dim):
+                block_sums, block_counts = block_sums.T, block_counts.T
+
+            if stream_dim == row_dim:
+                sums[block_start:block_stop] += block_sums
+                counts[block_start:block_stop] += block_counts
+            elif stream_dim == col_dim:
+                sums[:, block_start:block_stop] += block_sums
+                counts[:, block_start:block_stop] += block_counts
+            else:
+                sums += block_sums
+                counts += block_counts
 
-    ncfile.close()
+        if job is not None:
+            job.set_progress(block_stop / shape[stream_axis])
 
-    return slicedata, slicecalendar, slicetunits, timesliceindex, variable_units, variable_calendar, variable_description, xboundaries, yboundaries, sliced_data, xdata, ydata, xdataunit, ydataunit
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return ma.masked_where(counts == 0, sums / np.maximum(counts, 1))
 
-def get_sliced_data(var_props, slice_indices):
-    ncfile = Dataset(var_props["file_path"], "r")
-    vardata = ncfile.variables[var_props["variable_name"]]
-    sliced_data = slice_data(var_props, slice_indices, vardata)
-    ncfile.close()
-    return sliced_data
\ No newline at end of file
+
+# Labels of the indices of a dim: dates for time axes, values of the coordinate variable or the indices themselves
+def get_dimension_labels(var_props, dim):
+    size = var_props["sizes"][dim]
+    ncfile = open_dataset(var_props["file_path"])
+    try:
+        coordinate = find_scoped_variable(ncfile, var_props["variable_name"], dim)
+        values = coordinate[:]
+        try:
+            calendar = getattr(coordinate, "calendar", "standard")
+            return [str(d) for d in num2date(values, coordinate.units, calendar)]
+        except Exception:
+            return ["{0:g}".format(v) if isinstance(v, (float, np.floating)) else str(v) for v in np.asarray(values).tolist()]
+    except Exception:
+        return [str(i) for i in range(size)]
+    finally:
+        ncfile.close()
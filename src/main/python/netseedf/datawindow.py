@@ -1,15 +1,20 @@
 from pathlib import Path
 
-from PySide6.QtCore import Qt
-from PySide6.QtGui import QCursor
+from PySide6.QtCore import Qt, QTimer
+from PySide6.QtGui import QCursor, QKeySequence, QShortcut
 from PySide6.QtWidgets import QCheckBox, QTableWidget, QVBoxLayout, QWidget, QLabel, \
-    QHBoxLayout, QSpinBox, QPushButton, QTableView, QMessageBox, QMenu, QApplication
+    QHBoxLayout, QSpinBox, QPushButton, QTableView, QMessageBox, QMenu, QApplication, QComboBox
 from netCDF4 import Dataset, num2date
 import numpy as np
 
 import utils
 import datautils
+import datastore
+import jobs
+import resample
 import tableutils
+import membudget
+import perf
 
 # Window which shows a table of the data for the chosen variable and some info about the variable.
 # Displayed when 'Show data' button is clicked.
@@ -20,7 +25,10 @@ class DataWindow(QWidget):
         self.setWindowTitle(var_props["file_path"] + " - NetSeeDF")
         self.setMinimumSize(700, 600)
 
-        slicedata, slicecalendar, slicetunits, timesliceindex, variable_units, variable_calendar, variable_description, xboundaries, yboundaries, initial_data, xdata, ydata, xdataunit, ydataunit = datautils.get_initial_data(var_props)
+        self.var_props = var_props
+        self.slice_spinners = []  # on_file_grown can be called while the initial data is read
+        datastore.subscribe(var_props, self)  # shares data with the other windows of the variable
+        slicedata, slicecalendar, slicetunits, timesliceindex, variable_units, variable_calendar, variable_description, xboundaries, yboundaries, initial_data, xdata, ydata, xdataunit, ydataunit = datastore.get_initial_data(var_props)
 
         self.var_props = var_props
         self.variable_units = variable_units
@@ -44,6 +52,10 @@ class DataWindow(QWidget):
         var_label = QLabel("Variable: \t" + var_props["variable_name"], wordWrap=True)
         layout.addWidget(var_label)
 
+        if var_props.get("region_bounds") is not None:
+            region_label = QLabel("Region: \t\t{0:g}° to {2:g}° N, {1:g}° to {3:g}° E".format(*var_props["region_bounds"]), wordWrap=True)
+            layout.addWidget(region_label)
+
         if variable_description is not None:
             desc_label = QLabel("Description: \t" + variable_description, wordWrap=True)
             layout.addWidget(desc_label)
@@ -68,6 +80,7 @@ class DataWindow(QWidget):
         self.slice_spinners = []
         self.slice_date_labels = []
         self.slice_dates_list = []
+        self.slice_size_labels = []
 
         if var_props["can_slice"]:
             for i in range(len(var_props["sliceable_dims"])):
@@ -81,32 +94,91 @@ class DataWindow(QWidget):
                 slice_spinner.setMinimum(1)
                 slice_spinner.setMaximum(var_props["sizes"][slice_dim])  # set max index to size of the axis corresponding to the slicing variable
                 slice_spinner.setValue(1)
-                slice_spinner.valueChanged.connect(self.update_table)
+                slice_spinner.valueChanged.connect(self.on_slice_changed)
                 slice_selector_layout.addWidget(slice_spinner)
-                slice_selector_layout.addWidget(QLabel(" of " + str(var_props["sizes"][slice_dim])))
+                slice_size_label = QLabel(" of " + str(var_props["sizes"][slice_dim]))
+                slice_selector_layout.addWidget(slice_size_label)
+                self.slice_size_labels.append(slice_size_label)
                 self.slice_spinners.append(slice_spinner)
 
-                try:
-                    slice_dates = num2date(slicedata[i], slicetunits[i], slicecalendar[i])
-                    self.slice_dates_list.append(slice_dates)
+                slice_dates = datastore.get_slice_dates(var_props, i, slicedata, slicetunits, slicecalendar)
+                self.slice_dates_list.append(slice_dates)
+                if slice_dates is not None:
                     slice_date_label = QLabel(" =  " + str(slice_dates[0]))
                     self.slice_date_labels.append(slice_date_label)
                     slice_selector_layout.addWidget(self.slice_date_labels[i])
-                except Exception:
-                    self.slice_dates_list.append(None)
+                else:
                     self.slice_date_labels.append(None)
 
                 layout.addWidget(slice_selector_widget)
 
+        # the time dim can be resampled to calendar periods (see resample), the spinner then steps through the groups
+        self.t_index = None
+        self.resampling = None  # (period, statistic)
+        self.groups = None  # bounds and labels of the groups of the time steps, while resampling
+        self.waiting_for_resample = False
+        if self.slice_spinners and var_props["can_plot"] and var_props["t_dim"] in var_props["sliceable_dims"]:
+            self.t_index = var_props["sliceable_dims"].index(var_props["t_dim"])
+        if self.t_index is not None and self.slice_dates_list[self.t_index] is not None:
+            resample_widget = QWidget()
+            resample_layout = QHBoxLayout()
+            resample_layout.setAlignment(Qt.AlignmentFlag.AlignLeft)
+            resample_widget.setLayout(resample_layout)
+            resample_layout.addWidget(QLabel("resample " + var_props["t_dim"] + ": "))
+            self.period_combo = QComboBox()
+            self.period_combo.addItem("no", None)
+            for period in resample.PERIODS:
+                self.period_combo.addItem(resample.PERIOD_NAMES[period], period)
+            self.period_combo.currentIndexChanged.connect(self.on_resampling_changed)
+            resample_layout.addWidget(self.period_combo)
+            self.statistic_combo = QComboBox()
+            self.statistic_combo.addItems(resample.STATISTICS)
+            self.statistic_combo.setEnabled(False)
+            self.statistic_combo.currentIndexChanged.connect(self.on_resampling_changed)
+            resample_layout.addWidget(self.statistic_combo)
+            layout.addWidget(resample_widget)
+
+        self.link_checkbox = None
+        self.follow_file_checkbox = None
+        if self.slice_spinners:
+            link_widget = QWidget()
+            link_layout = QHBoxLayout()
+            link_layout.setAlignment(Qt.AlignmentFlag.AlignLeft)
+            link_widget.setLayout(link_layout)
+            self.link_checkbox = QCheckBox()
+            link_layout.addWidget(self.link_checkbox)
+            link_layout.addWidget(QLabel("link slice with other windows of this variable"))
+            layout.addWidget(link_widget)
+
+            # follow mode for files which are still being written (see datastore.refresh)
+            follow_widget = QWidget()
+            follow_layout = QHBoxLayout()
+            follow_layout.setAlignment(Qt.AlignmentFlag.AlignLeft)
+            follow_widget.setLayout(follow_layout)
+            self.follow_file_checkbox = QCheckBox()
+            self.follow_file_checkbox.checkStateChanged.connect(self.on_follow_file_toggled)
+            follow_layout.addWidget(self.follow_file_checkbox)
+            follow_layout.addWidget(QLabel("follow file as it grows"))
+            self.newest_checkbox = QCheckBox()
+            self.newest_checkbox.setEnabled(False)
+            follow_layout.addWidget(self.newest_checkbox)
+            follow_layout.addWidget(QLabel("show newest step"))
+            layout.addWidget(follow_widget)
+        self.follow_file_timer = QTimer(self)
+        self.follow_file_timer.setInterval(datastore.FOLLOW_INTERVAL_MS)
+        self.follow_file_timer.timeout.connect(lambda: datastore.refresh(self.var_props))
+
         # data table
         data_table = QTableView(self)
         data_table.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
         data_table.setContextMenuPolicy(Qt.ContextMenuPolicy.CustomContextMenu)
         data_table.customContextMenuRequested.connect(self.show_context_menu)
-        data_table.setSelectionMode(QTableWidget.SelectionMode.SingleSelection)
+        data_table.setSelectionMode(QTableWidget.SelectionMode.ExtendedSelection)  # rectangles, more with ctrl
         data_table.verticalHeader().setDefaultAlignment(Qt.AlignmentFlag.AlignCenter)
         data_table.horizontalHeader().setDefaultAlignment(Qt.AlignmentFlag.AlignCenter)
         self.data_table = data_table
+        copy_shortcut = QShortcut(QKeySequence.StandardKey.Copy, data_table)
+        copy_shortcut.activated.connect(self.copy_selection)
 
         # axis options container
         labels_selector = QWidget()
@@ -144,7 +216,7 @@ class DataWindow(QWidget):
             else:
                 ylabels = ydata.astype(str)
 
-        self.model = tableutils.TableModel(initial_data.astype(str), xlabels, ylabels)
+        self.model = tableutils.TableModel(initial_data, xlabels, ylabels)
         self.data_table.setModel(self.model)
 
         if xdata is not None and ydata is not None:
@@ -173,17 +245,11 @@ class DataWindow(QWidget):
                 dlg.exec()
                 return
 
-            str_data = conv_data.astype(str)
+            table_data = conv_data
         else:
-            str_data = normal_data.astype(str)
-
-        if str_data.shape == ():
-            str_data = str_data.reshape((1,1))
+            table_data = normal_data
 
-        if len(str_data.shape) == 1:
-            str_data = str_data.reshape((str_data.shape[0], 1))
-
-        self.model.set_data(str_data)
+        self.set_table_data(table_data)
 
         self.data_table.resizeColumnsToContents()
 
@@ -195,23 +261,203 @@ class DataWindow(QWidget):
             slice_indices.append(slice_index)
         return slice_indices
 
-    def update_table(self):
+    # Slice indices with the first time step of the shown group while resampling, as shared with linked windows
+    def get_linked_indices(self):
         slice_indices = self.get_selected_indices()
+        if self.groups is not None:
+            slice_indices[self.t_index] = int(self.groups[0][slice_indices[self.t_index]])
+        return slice_indices
 
-        for i in range(len(self.var_props["sliceable_dims"])):
-            # update text next to slice index spinners
+    def on_slice_changed(self):
+        self.update_table()
+        if self.is_slice_linked():
+            datastore.publish_slice(self.var_props, self.get_linked_indices(), self)
+
+    def is_slice_linked(self):
+        return self.link_checkbox is not None and self.link_checkbox.isChecked()
+
+    # Shows the slice of another linked window of the variable
+    def on_linked_slice(self, slice_indices):
+        if self.groups is not None:
+            slice_indices[self.t_index] = resample.find_group(self.groups[0], slice_indices[self.t_index])
+        if slice_indices == self.get_selected_indices():
+            return
+        for spinner, slice_index in zip(self.slice_spinners, slice_indices):
+            spinner.blockSignals(True)
+            spinner.setValue(slice_index + 1)
+            spinner.blockSignals(False)
+        self.update_table()
+
+    def on_resampling_changed(self):
+        period = self.period_combo.currentData()
+        t_step = self.get_linked_indices()[self.t_index]
+        self.resampling = (period, self.statistic_combo.currentText()) if period is not None else None
+        self.statistic_combo.setEnabled(period is not None)
+        self.update_t_range()
+        spinner = self.slice_spinners[self.t_index]
+        spinner.blockSignals(True)
+        spinner.setValue((resample.find_group(self.groups[0], t_step) if self.groups is not None else t_step) + 1)
+        spinner.blockSignals(False)
+        self.update_table()
+
+    # Range of the time spinner, the time steps or the groups of the resampling period
+    def update_t_range(self):
+        if self.resampling is None:
+            self.groups = None
+            size = self.var_props["sizes"][self.var_props["t_dim"]]
+        else:
+            self.groups = datastore.get_groups(self.var_props, self.resampling[0], self.t_index, self.slicedata, self.slicetunits, self.slicecalendar)
+            size = len(self.groups[1])
+        spinner = self.slice_spinners[self.t_index]
+        spinner.blockSignals(True)
+        spinner.setMaximum(size)
+        spinner.blockSignals(False)
+        self.slice_size_labels[self.t_index].setText(" of " + str(size))
+
+    # Called by the datastore when an aggregated slice has been computed
+    def on_resampled_data(self, state, error):
+        if not self.waiting_for_resample:
+            return
+        self.waiting_for_resample = False
+        if state == jobs.CANCELLED:
+            label = self.slice_date_labels[self.t_index]
+            label.setText(label.text().replace(" (computing...)", " (cancelled)"))
+            return
+        if error:
+            dlg = QMessageBox(self)
+            dlg.setWindowTitle("NetSeeDF message")
+            dlg.setText("There was an error while resampling the data!\n" + error)
+            dlg.exec()
+            return
+        self.update_table()
+
+    def on_follow_file_toggled(self):
+        following = self.follow_file_checkbox.isChecked()
+        self.newest_checkbox.setEnabled(following)
+        if following:
+            self.follow_file_timer.start()
+            datastore.refresh(self.var_props)
+        else:
+            self.follow_file_timer.stop()
+
+    # Extends the slice ranges to the records appended to the file (see datastore.extend_stored)
+    def on_file_grown(self, sizes, slicedata):
+        dims = self.var_props["sliceable_dims"]
+        grown = [i for i in range(len(self.slice_spinners)) if sizes[dims[i]] != self.var_props["sizes"][dims[i]]]
+        self.var_props["sizes"].update(sizes)
+        self.slicedata = slicedata
+        for i in grown:
+            size = sizes[dims[i]]
+            self.slice_spinners[i].setMaximum(size)
+            self.slice_size_labels[i].setText(" of " + str(size))
             if self.slice_dates_list[i] is not None:
-                self.slice_date_labels[i].setText(" =  " + str(self.slice_dates_list[i][slice_indices[i]]))
+                self.slice_dates_list[i] = datastore.get_slice_dates(self.var_props, i, slicedata, self.slicetunits, self.slicecalendar)
+            if i == self.t_index and self.groups is not None:
+                self.update_t_range()
+        if grown and self.follow_file_checkbox.isChecked() and self.newest_checkbox.isChecked():
+            QTimer.singleShot(0, lambda: self.show_newest(grown))
+
+    def show_newest(self, grown):
+        for i in grown:
+            self.slice_spinners[i].blockSignals(True)
+            self.slice_spinners[i].setValue(self.slice_spinners[i].maximum())
+            self.slice_spinners[i].blockSignals(False)
+        self.on_slice_changed()
+
+    def closeEvent(self, event):
+        self.follow_file_timer.stop()
+        datastore.unsubscribe(self.var_props, self)
+        membudget.untrack(self)
+        super().closeEvent(event)
+
+    def update_table(self):
+        with perf.operation("update_table", variable=self.var_props["variable_name"]):
+            slice_indices = self.get_selected_indices()
+
+            for i in range(len(self.var_props["sliceable_dims"])):
+                # update text next to slice index spinners
+                if i == self.t_index and self.groups is not None:
+                    self.slice_date_labels[i].setText(" =  " + resample.describe(*self.resampling) + " " + self.groups[1][slice_indices[i]])
+                elif self.slice_dates_list[i] is not None:
+                    self.slice_date_labels[i].setText(" =  " + str(self.slice_dates_list[i][slice_indices[i]]))
+
+            sliced_data = self.get_selected_data(slice_indices)
+            if sliced_data is None:  # the aggregated slice is being computed, see on_resampled_data
+                self.slice_date_labels[self.t_index].setText(self.slice_date_labels[self.t_index].text() + " (computing...)")
+                return
+
+            with perf.span("model update"):
+                self.set_table_data(sliced_data)
+
+    # Shows the data in the table. Copies made by the window (e.g. converted to °C or dates) count against the memory
+    # budget, the data shared by the datastore (read-only) is counted there.
+    def set_table_data(self, data):
+        data = np.asanyarray(data)
+        membudget.track(self, "table data", membudget.get_size(data) if data.flags.writeable else 0)
+        self.model.set_data(tableutils.as_table(data))
+
+    # Blocks of the table data in the selected ranges, from the top of the table. Ranges which span the same rows (or
+    # the same columns) are joined side by side (or on top of each other), like the cells are shown.
+    def get_selection_blocks(self):
+        ranges = sorted(((r.top(), r.bottom() + 1, r.left(), r.right() + 1) for r in self.data_table.selectionModel().selection()),
+                        key=lambda r: (r[0], r[2]))
+        if not ranges:
+            index = self.data_table.currentIndex()
+            if not index.isValid():
+                return []
+            ranges = [(index.row(), index.row() + 1, index.column(), index.column() + 1)]
+
+        data = self.model.current_data
+        if all(r[0:2] == ranges[0][0:2] for r in ranges):
+            return [np.ma.concatenate([data[r[0]:r[1], r[2]:r[3]] for r in ranges], axis=1)]
+        ranges.sort(key=lambda r: (r[2], r[0]))
+        if all(r[2:4] == ranges[0][2:4] for r in ranges):
+            return [np.ma.concatenate([data[r[0]:r[1], r[2]:r[3]] for r in ranges], axis=0)]
+        ranges.sort(key=lambda r: (r[0], r[2]))
+        return [data[r[0]:r[1], r[2]:r[3]] for r in ranges]
+
+    # Copies the selected cells as tab-separated text, formatted in the background (see tableutils.format_blocks)
+    def copy_selection(self):
+        blocks = self.get_selection_blocks()
+        if not blocks:
+            return
+
+        def format_selection(job):
+            with perf.operation("copy_selection", cells=sum(block.size for block in blocks)):
+                pieces = []
+                for text, progress in tableutils.format_blocks(blocks, "\t"):
+                    pieces.append(text)
+                    job.set_progress(progress, "formatting")
+                return "".join(pieces)
+
+        def on_done(job):
+            if job.state == jobs.FINISHED:
+                QApplication.clipboard().setText(job.result)
+            else:
+                utils.show_job_error(job)
 
-        sliced_data = self.get_selected_data(slice_indices)
+        jobs.submit("Copy " + str(sum(block.size for block in blocks)) + " cells", format_selection, None, jobs.PRIORITY_HIGH, on_done)
 
-        self.model.set_data(sliced_data.astype(str))
+    def export_selection(self):
+        blocks = self.get_selection_blocks()
+        if blocks:
+            suggested_filename = self.var_props["variable_name"].replace("/", "_") + "_selection"
+            utils.show_dialog_and_save(self, blocks, suggested_filename)
 
+    # Data of the slice, None while an aggregated slice is being computed
     def get_selected_data(self, slice_indices=None):
         if slice_indices is None:
             slice_indices = self.get_selected_indices()
 
-        sliced_data = datautils.get_sliced_data(self.var_props, slice_indices)
+        if self.groups is not None:
+            group = slice_indices[self.t_index]
+            label = resample.describe(*self.resampling).capitalize() + " " + self.groups[1][group]
+            sliced_data = datastore.get_resampled_data(self.var_props, slice_indices, self.groups[0][group:group + 2], self.resampling[1], label)
+            self.waiting_for_resample = sliced_data is None
+            if sliced_data is None:
+                return None
+        else:
+            sliced_data = datastore.get_sliced_data(self.var_props, slice_indices)
 
         if self.variable_units is not None:
             if self.variable_units == "K":
@@ -238,46 +484,62 @@ class DataWindow(QWidget):
         if index.isValid():
             menu = QMenu()
             copy_action = menu.addAction("Copy")
+            export_selection_action = menu.addAction("Export selection")
             action = menu.exec(QCursor.pos())
             if action == copy_action:
-                value = index.data()
-                QApplication.clipboard().setText(str(value))
+                self.copy_selection()
+            elif action == export_selection_action:
+                self.export_selection()
 
     def show_context_menu_slice(self, point):
         index = self.data_table.indexAt(point)
         if index.isValid():
             menu = QMenu()
             copy_action = menu.addAction("Copy")
+            export_selection_action = menu.addAction("Export selection")
             export_action = menu.addAction("Export timeseries")
             action = menu.exec(QCursor.pos())
             if action == copy_action:
-                value = index.data()
-                QApplication.clipboard().setText(str(value))
+                self.copy_selection()
+            elif action == export_selection_action:
+                self.export_selection()
             elif action == export_action:
-                timeseries = datautils.slice_timeseries(self.var_props, self.get_selected_indices(), index.column(), index.row(), self.var_props[
-                    "t_dim"])  # we assume that data should be sliced along the first identified time dimension
-
-                if self.variable_units is not None:
-                    if self.variable_units == "K":
-                        if self.temp_convert_checkbox.isChecked():
-                            try:
-                                timeseries = timeseries - 273.15
-                            except Exception:
-                                pass
-
+                selected_indices = self.get_selected_indices()
+                column, row = index.column(), index.row()
+                convert_temperature = self.variable_units == "K" and self.temp_convert_checkbox.isChecked()
                 tunits = self.slicetunits[self.timesliceindex]
                 tcalendar = self.slicecalendar[self.timesliceindex]
                 tdata = self.slicedata[self.timesliceindex]
+                groups, resampling = self.groups, self.resampling
 
-                if tunits is not None and tcalendar is not None:
-                    datetimes = num2date(tdata, tunits, tcalendar)
-                else:
-                    datetimes = tdata
+                # runs as a background job, the checkbox and spinners are read above in the GUI thread
+                def read_timeseries(job):
+                    job.set_progress(0, "reading")
+                    timeseries = datautils.slice_timeseries(self.var_props, selected_indices, column, row, self.var_props[
+                        "t_dim"], job)  # we assume that data should be sliced along the first identified time dimension
 
-                suggested_filename = self.var_props["variable_name"] + "_" + self.var_props["t_dim"]
+                    if convert_temperature:
+                        try:
+                            timeseries = timeseries - 273.15
+                        except Exception:
+                            pass
 
-                utils.show_dialog_and_save(self, np.array([datetimes, timeseries]).T, suggested_filename,
-                                           False)  # TODO: last dir stuff
+                    if groups is not None:  # the series of the groups of the resampling period
+                        aggregated = resample.aggregate_series(timeseries, groups[0], resampling[1])
+                        return np.array([groups[1][:len(aggregated)], aggregated.filled(np.nan)], dtype=object).T
+
+                    if tunits is not None and tcalendar is not None:
+                        datetimes = num2date(tdata, tunits, tcalendar)
+                    else:
+                        datetimes = tdata
+                    return np.array([datetimes, timeseries]).T
+
+                suggested_filename = self.var_props["variable_name"].replace("/", "_") + "_" + self.var_props["t_dim"]
+                if resampling is not None:
+                    suggested_filename += "_" + resample.describe(*resampling).replace(" ", "_")
+
+                utils.show_dialog_and_save(self, read_timeseries, suggested_filename,
+                                           False, self.var_props["file_path"])  # TODO: last dir stuff
 
     def show_context_menu(self, point):
         if self.var_props["can_slice"]:
@@ -286,7 +548,13 @@ class DataWindow(QWidget):
             self.show_context_menu_noslice(point)
 
     def export_3d(self):
-        suggested_filename = self.var_props["variable_name"]
+        data = self.get_selected_data()
+        if data is None:  # the aggregated slice is being computed
+            return
+        suggested_filename = self.var_props["variable_name"].replace("/", "_")
         for i in range(len(self.var_props["sliceable_dims"])):
-            suggested_filename = suggested_filename + "_" + self.var_props["sliceable_dims"][i] + str(self.slice_spinners[i].value())
-        utils.show_dialog_and_save(self, self.get_selected_data(), suggested_filename)
+            if i == self.t_index and self.groups is not None:
+                suggested_filename += "_" + resample.describe(*self.resampling).replace(" ", "_") + "_" + self.groups[1][self.slice_spinners[i].value() - 1]
+            else:
+                suggested_filename = suggested_filename + "_" + self.var_props["sliceable_dims"][i] + str(self.slice_spinners[i].value())
+        utils.show_dialog_and_save(self, data, suggested_filename)
@@ -0,0 +1,344 @@
+import ast
+import os
+
+import numpy as np
+import numpy.ma as ma
+
+import readplanner
+from zarrstore import normalize_key
+
+# Derived variables, defined by an expression over variables of the open files, e.g. wind speed
+# "sqrt(u**2 + v**2)", an anomaly "tas - tas_clim" or the difference of two runs "tas_a - tas_b". The symbols of the
+# expression are bound to variables (file path, variable path) when the variable is defined.
+#
+# All derived variables are shown as the variables of one virtual file, DERIVED_PATH, which is opened through the
+# storage backends of datautils like a NetCDF file, so the tables, maps, sections and exports read them like real
+# variables. Only the requested hyperslab is evaluated, in blocks of about EVAL_BLOCK_BYTES, so no temporaries of the
+# size of the whole variable are created.
+#
+# The operands of an expression must lie on the same grid: the dims of every operand are a subset of the dims of the
+# operand with the most dims (the reference), with the same sizes. Operands with fewer dims are broadcast, e.g. a
+# climatology (lat, lon) subtracted from a variable (time, lat, lon). The derived variable has the dims, coordinate
+# variables and grid mapping of the reference.
+#
+# datautils lists this module among its storage backends, so datautils is imported where it is used, not at the top.
+
+DERIVED_PATH = "derived:"
+EVAL_BLOCK_BYTES = 32 * 1024 * 1024
+FILL_VALUE = 9.969209968386869e36  # default NetCDF fill value of doubles
+
+FUNCTIONS = {
+    "sqrt": np.sqrt, "abs": np.abs, "exp": np.exp, "log": np.log, "log10": np.log10,
+    "sin": np.sin, "cos": np.cos, "tan": np.tan, "arctan2": np.arctan2, "hypot": np.hypot,
+    "deg2rad": np.deg2rad, "rad2deg": np.rad2deg, "minimum": np.minimum, "maximum": np.maximum, "where": np.where,
+}
+ALLOWED_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Call, ast.Name, ast.Load, ast.Constant,
+                 ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow, ast.USub, ast.UAdd,
+                 ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.Eq, ast.NotEq)
+
+_definitions = {}  # name -> DerivedDefinition, in order of definition
+
+
+class DerivedDefinition:
+    def __init__(self, name, expression, operands, dimensions, shape, reference, attributes):
+        self.name = name
+        self.expression = expression
+        self.code = compile(ast.parse(expression, mode="eval"), "<" + name + ">", "eval")
+        self.operands = operands  # symbol -> (file path, variable path)
+        self.dimensions = dimensions
+        self.shape = shape
+        self.reference = reference  # symbol of the operand with the most dims
+        self.attributes = attributes
+
+
+def is_derived(file_path):
+    return file_path == DERIVED_PATH
+
+
+# Names used as operands in an expression. Raises ValueError if the expression is not valid or uses anything else
+# than numbers, arithmetic, comparisons and the FUNCTIONS.
+def get_symbols(expression):
+    try:
+        tree = ast.parse(expression, mode="eval")
+    except SyntaxError as e:
+        raise ValueError("The expression is not valid: " + str(e.msg))
+
+    symbols = []
+    for node in ast.walk(tree):
+        if not isinstance(node, ALLOWED_NODES):
+            raise ValueError("The expression can only use numbers, variables, arithmetic and the functions " + ", ".join(FUNCTIONS))
+        if isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in FUNCTIONS or node.keywords:
+                raise ValueError("Unknown function in the expression, available are " + ", ".join(FUNCTIONS))
+        elif isinstance(node, ast.Name) and node.id not in FUNCTIONS and node.id not in symbols:
+            symbols.append(node.id)
+        elif isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+            raise ValueError("Only numbers can be used as constants in the expression")
+    return symbols
+
+
+def get_definitions():
+    return list(_definitions.values())
+
+
+# Defines a derived variable. operands maps the symbols of the expression to (file path, variable path).
+# Raises ValueError if the definition is not valid.
+def define(name, expression, operands, units=None):
+    import datautils
+
+    if not name.isidentifier():
+        raise ValueError("The name of a derived variable can only contain letters, digits and underscores")
+    if name in _definitions or name in get_coordinate_sources():
+        raise ValueError("A derived variable named " + name + " already exists")
+    symbols = get_symbols(expression)
+    if not symbols:
+        raise ValueError("The expression does not use any variables")
+    missing = [s for s in symbols if s not in operands]
+    if missing:
+        raise ValueError("No variable chosen for " + ", ".join(missing))
+
+    operand_dims = {}
+    reference_attributes = {}
+    for symbol in symbols:
+        file_path, variable_path = operands[symbol]
+        ncfile = datautils.open_dataset(file_path)
+        try:
+            var = datautils.get_variable(ncfile, variable_path)
+            operand_dims[symbol] = dict(zip(var.dimensions, var.shape))
+            if np.dtype(var.dtype).kind not in "iuf":
+                raise ValueError(variable_path + " is not a numeric variable")
+            reference_attributes[symbol] = {a: var.getncattr(a) for a in ("grid_mapping", "coordinates") if a in var.ncattrs()}
+        finally:
+            ncfile.close()
+
+    reference = max(symbols, key=lambda s: len(operand_dims[s]))
+    reference_dims = operand_dims[reference]
+    for symbol in symbols:
+        for dim, size in operand_dims[symbol].items():
+            if reference_dims.get(dim) != size:
+                raise ValueError("The grids of " + reference + " and " + symbol + " do not match (dimension " + dim + ")")
+        if [d for d in reference_dims if d in operand_dims[symbol]] != list(operand_dims[symbol]):
+            raise ValueError("The dimensions of " + symbol + " are not in the same order as those of " + reference)
+
+    # the coordinate variables are shared by all derived variables, their sizes have to agree
+    for dim, size in reference_dims.items():
+        for definition in _definitions.values():
+            if dim in definition.dimensions and definition.shape[definition.dimensions.index(dim)] != size:
+                raise ValueError("The dimension " + dim + " has a different size in the derived variable " + definition.name)
+
+    attributes = dict(reference_attributes[reference])
+    attributes["long_name"] = expression
+    if units:
+        attributes["units"] = units
+    _definitions[name] = DerivedDefinition(name, expression, {s: tuple(operands[s]) for s in symbols},
+                                           list(reference_dims.keys()), list(reference_dims.values()), reference, attributes)
+
+
+def remove(name):
+    _definitions.pop(name, None)
+
+
+# Variables of the source files shown next to the derived variables: coordinate variables of their dims and the
+# grid mapping and auxiliary coordinates of their references, name -> (file path, path of the reference variable),
+# they are found like the coordinates of the reference (see datautils.find_scoped_variable)
+def get_coordinate_sources():
+    sources = {}
+    for definition in _definitions.values():
+        names = list(definition.dimensions)
+        names += definition.attributes.get("coordinates", "").split()
+        names += definition.attributes.get("grid_mapping", "").split()
+        for name in names:
+            if name not in sources and name not in _definitions:
+                sources[name] = definition.operands[definition.reference]
+    return sources
+
+
+class DerivedAttributes:
+    def ncattrs(self):
+        return list(self._attributes.keys())
+
+    def getncattr(self, name):
+        return self._attributes[name]
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        try:
+            return self._attributes[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class DerivedDimension:
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+
+    def isunlimited(self):
+        return False
+
+    def __len__(self):
+        return self.size
+
+
+class DerivedVariable(DerivedAttributes):
+    def __init__(self, definition, dataset):
+        self.name = definition.name
+        self.definition = definition
+        self._dataset = dataset
+        self._attributes = dict(definition.attributes)
+        self._attributes["_FillValue"] = FILL_VALUE
+        self.dimensions = tuple(definition.dimensions)
+        self.shape = tuple(definition.shape)
+        self.ndim = len(self.shape)
+        self.size = int(np.prod(self.shape, dtype=np.int64))
+        self.dtype = np.dtype(np.float64)
+        self.datatype = self.dtype
+
+    def group(self):
+        return self._dataset
+
+    def chunking(self):
+        return "contiguous"
+
+    def filters(self):
+        return None
+
+    def get_fill_value(self):
+        return FILL_VALUE
+
+    # Reads the part of an operand for a selection of the derived variable, as floats with NaN for missing values,
+    # with axes of length 1 for the dims the operand does not have
+    def read_operand(self, symbol, key):
+        var = self._dataset.get_source_variable(*self.definition.operands[symbol])
+        operand_key = tuple(key[self.dimensions.index(d)] for d in var.dimensions)
+        data = readplanner.read(var, operand_key)
+        data = ma.masked_equal(data, var.get_fill_value()) if var.get_fill_value() is not None else ma.asarray(data)
+        values = ma.filled(data.astype(np.float64), np.nan)
+
+        shape = []
+        operand_axes = iter(values.shape)
+        for d, k in zip(self.dimensions, key):
+            if isinstance(k, slice):
+                shape.append(next(operand_axes) if d in var.dimensions else 1)
+        return values.reshape(shape)
+
+    def evaluate(self, key, out_shape):
+        namespace = dict(FUNCTIONS)
+        for symbol in self.definition.operands:
+            namespace[symbol] = self.read_operand(symbol, key)
+        with np.errstate(all="ignore"):
+            result = eval(self.definition.code, {"__builtins__": {}}, namespace)
+        return np.broadcast_to(np.asarray(result, dtype=np.float64), out_shape)
+
+    # Evaluates the expression for the selection, in blocks along the outermost selected dim
+    def __getitem__(self, key):
+        key = normalize_key(key, self.ndim)
+        if key is None:
+            raise IndexError("Derived variables only support integer and slice indexing")
+        key = tuple(int(k) if isinstance(k, (int, np.integer)) else k for k in key)
+        out_shape = tuple(len(range(*k.indices(size))) for k, size in zip(key, self.shape) if isinstance(k, slice))
+
+        cells = int(np.prod(out_shape, dtype=np.int64))
+        block_dim = next((i for i, k in enumerate(key) if isinstance(k, slice)), None)
+        bytes_per_cell = 8 * (len(self.definition.operands) + 1)
+        if block_dim is None or cells * bytes_per_cell <= EVAL_BLOCK_BYTES:
+            values = self.evaluate(key, out_shape)
+        else:
+            values = np.empty(out_shape, dtype=np.float64)
+            start, stop, step = key[block_dim].indices(self.shape[block_dim])
+            indices = range(start, stop, step)
+            block_length = max(1, int(EVAL_BLOCK_BYTES // (cells // len(indices) * bytes_per_cell)))
+            for lo in range(0, len(indices), block_length):
+                block = indices[lo:lo + block_length]
+                block_key = key[:block_dim] + (slice(block.start, block.stop, block.step),) + key[block_dim + 1:]
+                block_shape = (len(block),) + out_shape[1:]
+                values[lo:lo + len(block)] = self.evaluate(block_key, block_shape)
+        return ma.masked_invalid(values, copy=False)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        lines = ["<class 'derived.DerivedVariable'>",
+                 "float64 {}({})".format(self.name, ", ".join(self.dimensions)),
+                 "    expression: {}".format(self.definition.expression)]
+        for symbol, (file_path, variable_path) in self.definition.operands.items():
+            lines.append("    {} = {} in {}".format(symbol, variable_path, file_path))
+        for key in self.ncattrs():
+            lines.append("    {}: {}".format(key, self._attributes[key]))
+        lines.append("current shape = {}".format(self.shape))
+        return "\n".join(lines)
+
+
+# The virtual file of all derived variables. The source files are opened when they are first read and closed with
+# the dataset.
+class DerivedDataset(DerivedAttributes):
+    def __init__(self, file_path):
+        import datautils
+
+        self.filepath_ = file_path
+        self.name = "/"
+        self.path = "/"
+        self.parent = None
+        self.data_model = "DERIVED"
+        self.file_format = "DERIVED"
+        self._attributes = {"title": "Derived variables"}
+        self._sources = {}  # file path -> opened dataset
+        self.groups = {}
+
+        self.variables = {}
+        self.dimensions = {}
+        for definition in _definitions.values():
+            self.variables[definition.name] = DerivedVariable(definition, self)
+            for dim, size in zip(definition.dimensions, definition.shape):
+                self.dimensions.setdefault(dim, DerivedDimension(dim, size))
+        try:
+            for name, (source_path, reference_path) in get_coordinate_sources().items():
+                try:
+                    self.variables[name] = datautils.find_scoped_variable(self.get_source(source_path), reference_path, name)
+                except (KeyError, OSError):
+                    pass  # dims without coordinate variables
+        except BaseException:
+            self.close()  # the sources opened so far
+            raise
+
+    def get_source(self, file_path):
+        import datautils
+
+        if file_path not in self._sources:
+            self._sources[file_path] = datautils.open_dataset(file_path)
+        return self._sources[file_path]
+
+    def get_source_variable(self, file_path, variable_path):
+        import datautils
+
+        return datautils.get_variable(self.get_source(file_path), variable_path)
+
+    def filepath(self):
+        return self.filepath_
+
+    def isopen(self):
+        return True
+
+    def close(self):
+        for source in self._sources.values():
+            source.close()
+        self._sources = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __repr__(self):
+        lines = ["<class 'derived.DerivedDataset'>", "Derived variables:"]
+        for definition in _definitions.values():
+            lines.append("    {} = {}".format(definition.name, definition.expression))
+        return "\n".join(lines)
+
+
+# Display name of a file path, the virtual file of derived variables has no file name
+def get_display_name(file_path):
+    return "Derived variables" if is_derived(file_path) else os.path.basename(file_path)
@@ -0,0 +1,86 @@
+from PySide6.QtWidgets import QDialog, QVBoxLayout, QFormLayout, QLineEdit, QLabel, QComboBox, QDialogButtonBox, \
+    QMessageBox, QWidget
+
+import derived
+
+# Dialog which defines a derived variable: a name, an expression and, for every symbol of the expression, the
+# variable of an open file it stands for. variables is a list of (file path, variable path, variable name) of the
+# variables of all open files.
+class DerivedDialog(QDialog):
+    def __init__(self, parent, variables, preferred_file=None):
+        super().__init__(parent)
+
+        self.variables = variables
+        self.preferred_file = preferred_file
+        self.symbol_combos = {}
+
+        self.setWindowTitle("New derived variable - NetSeeDF")
+        self.setMinimumWidth(550)
+
+        layout = QVBoxLayout()
+        form = QFormLayout()
+        self.name_edit = QLineEdit()
+        self.name_edit.setPlaceholderText("e.g. wind_speed")
+        form.addRow("Name:", self.name_edit)
+        self.expression_edit = QLineEdit()
+        self.expression_edit.setPlaceholderText("e.g. sqrt(u**2 + v**2)")
+        self.expression_edit.textChanged.connect(self.update_symbols)
+        form.addRow("Expression:", self.expression_edit)
+        self.units_edit = QLineEdit()
+        form.addRow("Units (optional):", self.units_edit)
+        layout.addLayout(form)
+
+        layout.addWidget(QLabel("Functions: " + ", ".join(derived.FUNCTIONS), wordWrap=True))
+
+        self.symbols_widget = QWidget()
+        self.symbols_layout = QFormLayout()
+        self.symbols_widget.setLayout(self.symbols_layout)
+        layout.addWidget(self.symbols_widget)
+        self.error_label = QLabel(wordWrap=True)
+        layout.addWidget(self.error_label)
+
+        buttons = QDialogButtonBox(QDialogButtonBox.StandardButton.Ok | QDialogButtonBox.StandardButton.Cancel)
+        buttons.accepted.connect(self.on_accept)
+        buttons.rejected.connect(self.reject)
+        layout.addWidget(buttons)
+
+        self.setLayout(layout)
+
+    # Shows a choice of variables for every symbol of the expression, variables with the name of the symbol first
+    def update_symbols(self):
+        try:
+            symbols = derived.get_symbols(self.expression_edit.text())
+            self.error_label.setText("")
+        except ValueError as e:
+            self.error_label.setText(str(e))
+            return
+
+        previous = {s: c.currentIndex() for s, c in self.symbol_combos.items()}
+        while self.symbols_layout.rowCount():
+            self.symbols_layout.removeRow(0)
+        self.symbol_combos = {}
+
+        for symbol in symbols:
+            combo = QComboBox()
+            ranked = sorted(self.variables, key=lambda v: (v[2] != symbol, v[0] != self.preferred_file, v[0], v[1]))
+            for file_path, variable_path, _ in ranked:
+                combo.addItem(variable_path + "  (" + derived.get_display_name(file_path) + ")", (file_path, variable_path))
+            if symbol in previous and previous[symbol] >= 0:
+                combo.setCurrentIndex(previous[symbol])
+            self.symbol_combos[symbol] = combo
+            self.symbols_layout.addRow(symbol + " =", combo)
+
+    def on_accept(self):
+        operands = {s: c.currentData() for s, c in self.symbol_combos.items() if c.currentData() is not None}
+        try:
+            derived.define(self.name_edit.text().strip(), self.expression_edit.text(), operands, self.units_edit.text().strip() or None)
+        except (ValueError, OSError, KeyError) as e:
+            dlg = QMessageBox(self)
+            dlg.setWindowTitle("NetSeeDF message")
+            dlg.setText("The derived variable could not be defined!\n" + str(e))
+            dlg.exec()
+            return
+        self.accept()
+
+    def get_name(self):
+        return self.name_edit.text().strip()
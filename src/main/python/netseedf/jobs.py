@@ -0,0 +1,227 @@
+import os
+import time
+import traceback
+
+from PySide6.QtCore import QObject, QRunnable, QThreadPool, Signal, Slot
+
+import perf
+
+# Background jobs for long running operations (exports, time series extraction, sections and reductions over whole
+# variables), so that the windows stay responsive while they run. A job is a function which gets the Job as its only
+# argument, it runs in a bounded pool of worker threads and reports its progress with job.set_progress, which also
+# ends the job if it has been cancelled. Jobs are started in order of priority (then in order of submission), with at
+# most MAX_JOBS_PER_FILE jobs of the same file running at once. When a job ends, its on_done callback is called in the
+# GUI thread with the job (not for cancelled jobs). A job which was cancelled while it ran ends as cancelled, also if
+# its function returned or failed before it noticed.
+#
+# Reads of the netCDF library are serialised by datautils.netcdf_lock, jobs which read a lot should read block by
+# block (datautils.read_block) so that the GUI thread can read in between.
+#
+# NETSEEDF_JOB_THREADS   number of worker threads (default: number of cores, up to 4)
+
+PRIORITY_LOW = 0  # e.g. exports of whole variables
+PRIORITY_NORMAL = 1
+PRIORITY_HIGH = 2  # results the user waits for in a window, e.g. a section
+MAX_JOBS_PER_FILE = 1
+MAX_FINISHED_JOBS = 50  # finished jobs kept in the jobs panel
+PROGRESS_INTERVAL = 0.2  # seconds between progress updates sent to the GUI thread
+
+QUEUED = "queued"
+RUNNING = "running"
+FINISHED = "finished"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, name, function, file_path, priority, on_done, sequence):
+        self.name = name
+        self.function = function
+        self.file_path = os.path.abspath(file_path) if file_path else None
+        self.priority = priority
+        self.on_done = on_done
+        self.sequence = sequence
+        self.state = QUEUED
+        self.progress = 0.0
+        self.message = ""
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.cancel_requested = False
+        self.last_notified = 0.0
+
+    # Called by the job function, fraction is between 0 and 1. Raises JobCancelled if the job has been cancelled.
+    def set_progress(self, fraction, message=None):
+        self.progress = min(1.0, max(0.0, float(fraction)))
+        if message is not None:
+            self.message = message
+        now = time.perf_counter()
+        if now - self.last_notified >= PROGRESS_INTERVAL:
+            self.last_notified = now
+            _scheduler.job_changed.emit(self)
+        if self.cancel_requested:
+            raise JobCancelled()
+
+    def is_done(self):
+        return self.state in (FINISHED, FAILED, CANCELLED)
+
+    def get_duration(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+
+class JobRunnable(QRunnable):
+    def __init__(self, job):
+        super().__init__()
+        self.job = job
+
+    def run(self):
+        job = self.job
+        job.started = time.time()
+        job.state = RUNNING
+        _scheduler.job_changed.emit(job)
+        try:
+            if job.cancel_requested:
+                raise JobCancelled()
+            job.result = job.function(job)
+            job.progress = 1.0
+            job.state = FINISHED
+        except JobCancelled:
+            job.state = CANCELLED
+        except Exception as e:
+            traceback.print_exc()
+            job.error = str(e) or type(e).__name__
+            job.state = FAILED
+        job.finished = time.time()
+        perf.count("jobs_" + job.state)
+        _scheduler.job_ended.emit(job)
+
+
+# Lives in the GUI thread, the signals of the worker threads are delivered to it there
+class JobScheduler(QObject):
+    job_changed = Signal(object)
+    job_ended = Signal(object)
+
+    def __init__(self):
+        super().__init__()
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(get_thread_count())
+        self.jobs = []  # all jobs, in order of submission
+        self.queue = []
+        self.running = 0
+        self.running_per_file = {}
+        self.listeners = []
+        self.sequence = 0
+        self.job_changed.connect(self.on_job_changed)
+        self.job_ended.connect(self.on_job_ended)
+
+    def submit(self, name, function, file_path=None, priority=PRIORITY_NORMAL, on_done=None):
+        self.sequence += 1
+        job = Job(name, function, file_path, priority, on_done, self.sequence)
+        self.jobs.append(job)
+        self.queue.append(job)
+        self.dispatch()
+        self.notify(job)
+        return job
+
+    # Starts queued jobs while worker threads are free and their file is below its limit
+    def dispatch(self):
+        self.queue.sort(key=lambda job: (-job.priority, job.sequence))
+        for job in list(self.queue):
+            if self.running >= self.pool.maxThreadCount():
+                break
+            if job.file_path is not None and self.running_per_file.get(job.file_path, 0) >= MAX_JOBS_PER_FILE:
+                continue
+            self.queue.remove(job)
+            self.running += 1
+            if job.file_path is not None:
+                self.running_per_file[job.file_path] = self.running_per_file.get(job.file_path, 0) + 1
+            self.pool.start(JobRunnable(job), job.priority)
+
+    def cancel(self, job):
+        job.cancel_requested = True
+        job.on_done = None
+        if job in self.queue:
+            self.queue.remove(job)
+            job.state = CANCELLED
+            job.finished = time.time()
+            self.notify(job)
+
+    @Slot(object)
+    def on_job_changed(self, job):
+        self.notify(job)
+
+    @Slot(object)
+    def on_job_ended(self, job):
+        if job.cancel_requested and job.state != CANCELLED:  # cancelled after its last set_progress, see cancel
+            job.state = CANCELLED
+        self.running -= 1
+        if job.file_path is not None:
+            self.running_per_file[job.file_path] -= 1
+            if not self.running_per_file[job.file_path]:
+                del self.running_per_file[job.file_path]
+        on_done, job.on_done = job.on_done, None
+        if on_done is not None and job.state != CANCELLED:
+            on_done(job)
+        self.notify(job)
+
+        done = [j for j in self.jobs if j.is_done()]
+        for old in done[:max(0, len(done) - MAX_FINISHED_JOBS)]:
+            self.jobs.remove(old)
+        self.dispatch()
+
+    def notify(self, job):
+        for listener in list(self.listeners):
+            listener(job)
+
+
+def get_thread_count():
+    try:
+        return max(1, int(os.environ.get("NETSEEDF_JOB_THREADS", min(4, os.cpu_count() or 1))))
+    except ValueError:
+        return 1
+
+
+_scheduler = None
+
+
+def get_scheduler():
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = JobScheduler()
+    return _scheduler
+
+
+# Runs function(job) in the background, see the top of the module. Called from the GUI thread.
+def submit(name, function, file_path=None, priority=PRIORITY_NORMAL, on_done=None):
+    return get_scheduler().submit(name, function, file_path, priority, on_done)
+
+
+def cancel(job):
+    get_scheduler().cancel(job)
+
+
+def get_jobs():
+    return list(get_scheduler().jobs)
+
+
+def get_running_count():
+    return sum(1 for job in get_scheduler().jobs if not job.is_done())
+
+
+# listener(job) is called in the GUI thread whenever a job is submitted, makes progress or ends
+def add_listener(listener):
+    get_scheduler().listeners.append(listener)
+
+
+def remove_listener(listener):
+    listeners = get_scheduler().listeners
+    if listener in listeners:
+        listeners.remove(listener)
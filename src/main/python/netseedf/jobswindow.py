@@ -0,0 +1,93 @@
+from PySide6.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QTreeWidget, QTreeWidgetItem, QPushButton
+
+import jobs
+
+
+# Window which lists the running, queued and finished background jobs (see jobs). Jobs can be cancelled from here.
+# Shown with the 'Jobs' button in the status bar of the main window.
+class JobsWindow(QWidget):
+    def __init__(self):
+        super().__init__()
+
+        self.setWindowTitle("Jobs - NetSeeDF")
+        self.setMinimumSize(650, 300)
+
+        self.items = {}  # job -> tree item
+
+        layout = QVBoxLayout()
+
+        tree = QTreeWidget()
+        tree.setColumnCount(5)
+        tree.setHeaderLabels(["Job", "State", "Progress", "Time [s]", "Details"])
+        tree.setRootIsDecorated(False)
+        tree.setColumnWidth(0, 250)
+        tree.setColumnWidth(1, 80)
+        tree.setColumnWidth(2, 70)
+        tree.setColumnWidth(3, 70)
+        tree.currentItemChanged.connect(self.update_buttons)
+        self.tree = tree
+        layout.addWidget(tree)
+
+        buttons_widget = QWidget()
+        buttons_layout = QHBoxLayout()
+        buttons_widget.setLayout(buttons_layout)
+        cancel_button = QPushButton("Cancel job")
+        cancel_button.clicked.connect(self.cancel_selected)
+        cancel_button.setEnabled(False)
+        self.cancel_button = cancel_button
+        clear_button = QPushButton("Clear finished")
+        clear_button.clicked.connect(self.clear_finished)
+        buttons_layout.addStretch()
+        buttons_layout.addWidget(cancel_button)
+        buttons_layout.addWidget(clear_button)
+        layout.addWidget(buttons_widget)
+
+        self.setLayout(layout)
+
+        jobs.add_listener(self.update_job)
+        for job in jobs.get_jobs():
+            self.update_job(job)
+
+    def closeEvent(self, event):
+        jobs.remove_listener(self.update_job)
+        event.accept()
+
+    def update_job(self, job):
+        item = self.items.get(job)
+        if item is None:
+            item = QTreeWidgetItem()
+            self.items[job] = item
+            self.tree.insertTopLevelItem(0, item)
+
+        details = job.error if job.error else job.message or (job.file_path or "")
+        item.setText(0, job.name)
+        item.setText(1, job.state)
+        item.setText(2, "{:.0f} %".format(job.progress * 100) if job.state != jobs.QUEUED else "")
+        item.setText(3, "{:.1f}".format(job.get_duration()) if job.started is not None else "")
+        item.setText(4, details)
+        item.setToolTip(4, details)
+        self.update_buttons()
+
+    def get_selected_job(self):
+        current = self.tree.currentItem()
+        for job, item in self.items.items():
+            if item is current:
+                return job
+        return None
+
+    def update_buttons(self):
+        job = self.get_selected_job()
+        self.cancel_button.setEnabled(job is not None and not job.is_done())
+
+    def cancel_selected(self):
+        job = self.get_selected_job()
+        if job is not None:
+            jobs.cancel(job)
+            self.update_buttons()
+
+    def clear_finished(self):
+        for job, item in list(self.items.items()):
+            if job.is_done():
+                self.tree.takeTopLevelItem(self.tree.indexOfTopLevelItem(item))
+                del self.items[job]
+        self.update_buttons()
@@ -1,10 +1,24 @@
 import sys
+import time
+
+STARTUP_T0 = time.perf_counter()  # taken before the heavy imports, used for the startup timing report
+
+import importlib
+import json
+import multiprocessing
+import threading
 import traceback
 
 from fbs_runtime.application_context import cached_property
 from fbs_runtime.application_context.PySide6 import ApplicationContext
 
 import datautils
+import derived
+import jobs
+import membudget
+import reproject
+import utils
+import zarrstore
 
 
 def excepthook(type, value, tback):
@@ -20,16 +34,86 @@ if sys.platform == "linux":
     os.environ["QTWEBENGINE_CHROMIUM_FLAGS"]="--disable-gpu" # plot window does not run on linux otherwise
 
 from pathlib import Path
-from netCDF4 import Dataset
 from PySide6.QtWidgets import QApplication, QMainWindow, QMessageBox, QPlainTextEdit, QHBoxLayout, \
-    QPushButton, QWidget, QTreeWidget, QTreeWidgetItem, QFileDialog, QGridLayout
-from PySide6.QtCore import Qt
+    QPushButton, QWidget, QTreeView, QFileDialog, QGridLayout, QLineEdit, QLabel, QVBoxLayout, QSpinBox
+from PySide6.QtCore import Qt, QCoreApplication, QTimer, Signal
+from PySide6.QtGui import QKeySequence, QShortcut
 
 from datawindow import DataWindow
-from plotwindow import PlotWindow
+from deriveddialog import DerivedDialog
+from jobswindow import JobsWindow
+from perfwindow import PerfWindow
+from searchindex import SearchIndex, prepare_file
+from treemodel import VariableTreeModel
+
+# the plotting subsystem (cartopy, matplotlib, QtWebEngine, folium, jinja2) is imported lazily, see load_plotwindow()
+STARTUP_IMPORTS_DONE = time.perf_counter()
+
+# Libraries of the plotting subsystem which do not touch Qt and can be imported off the GUI thread. Qt modules (e.g.
+# QtWebEngineWidgets) and pyplot, which picks a GUI backend, are only imported on the GUI thread.
+PREWARM_MODULES = ("jinja2", "folium", "matplotlib.colors", "matplotlib.cm", "pyproj", "shapely.geometry", "cartopy.crs")
+
+
+# Returns the plotwindow module, importing it on first use
+def load_plotwindow():
+    import plotwindow
+    return plotwindow
+
+
+# Imports the libraries of PREWARM_MODULES in a background thread, so that the first 'Show map' click does not have to
+# wait for them. on_loaded is called from that thread once they are imported, it should import the rest of the
+# plotting subsystem (load_plotwindow) on the GUI thread, e.g. through a queued signal. Can be disabled by setting
+# the NETSEEDF_NO_PREWARM environment variable.
+def prewarm_plotwindow(on_loaded=None):
+    if os.environ.get("NETSEEDF_NO_PREWARM"):
+        return
+
+    def run():
+        start = time.perf_counter()
+        try:
+            for name in PREWARM_MODULES:
+                importlib.import_module(name)
+        except Exception:
+            traceback.print_exc()
+            return
+        print("NetSeeDF: plotting libraries pre-warmed in {:.3f} s".format(time.perf_counter() - start))
+        if on_loaded is not None:
+            on_loaded()
+
+    threading.Thread(target=run, name="netseedf-prewarm", daemon=True).start()
+
+
+# Prints the time from process start to the end of imports, to the main window being created and to its first paint.
+# If the NETSEEDF_STARTUP_REPORT environment variable is set, the report is also appended as a line of JSON to the file
+# it points to (useful for the frozen build, where there is no console).
+def report_startup_timing(appcontext, window_created, first_paint):
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "frozen": bool(getattr(sys, "frozen", False)),
+        "version": None,
+        "import_s": round(STARTUP_IMPORTS_DONE - STARTUP_T0, 4),
+        "window_s": round(window_created - STARTUP_T0, 4),
+        "first_paint_s": round(first_paint - STARTUP_T0, 4),
+    }
+    try:
+        report["version"] = appcontext.build_settings["version"]
+    except Exception:
+        pass
+
+    print("NetSeeDF startup: imports {import_s:.3f} s, window {window_s:.3f} s, first paint {first_paint_s:.3f} s".format(**report))
+
+    report_path = os.environ.get("NETSEEDF_STARTUP_REPORT")
+    if report_path:
+        try:
+            with open(report_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(report) + "\n")
+        except OSError:
+            traceback.print_exc()
 
 
 class MainWindow(QMainWindow):
+    plotting_loaded = Signal()
+
     def __init__(self, appcontext):
         super().__init__()
 
@@ -40,21 +124,70 @@ class MainWindow(QMainWindow):
 
         self.file_paths = []
         self.firsttreeitem = True
-        self.file_paths_dict = {}
-        self.open_windows = []
+        self.window_created = None
+        self.first_paint_done = False
+        self.perf_window = None
+
+        perf_shortcut = QShortcut(QKeySequence(Qt.Key.Key_F12), self)
+        perf_shortcut.setContext(Qt.ShortcutContext.ApplicationShortcut)
+        perf_shortcut.activated.connect(self.toggle_perf_window)
+
+        # once the plotting libraries are imported in the background, the plotting subsystem and a map view for the
+        # first map window are loaded on the GUI thread (the signal is emitted from the pre-warming thread, so queued)
+        self.plotting_loaded.connect(self.prewarm_map_view, Qt.ConnectionType.QueuedConnection)
 
         file_button = QPushButton("Open NetCDF file")
         file_button.clicked.connect(self.open_file)
-
-        tree = QTreeWidget()
-        tree.setColumnCount(2)
-        tree.setHeaderLabels(["Name", "Description", "Shape"])
+        zarr_button = QPushButton("Open Zarr store")
+        zarr_button.clicked.connect(self.open_zarr)
+
+        open_buttons_widget = QWidget()
+        open_buttons_layout = QHBoxLayout()
+        open_buttons_widget.setLayout(open_buttons_layout)
+        open_buttons_layout.addWidget(file_button)
+        open_buttons_layout.addWidget(zarr_button)
+        derived_button = QPushButton("New derived variable")
+        derived_button.clicked.connect(self.new_derived_variable)
+        open_buttons_layout.addWidget(derived_button)
+
+        tree_model = VariableTreeModel(self)
+        self.tree_model = tree_model
+        tree = QTreeView()
+        tree.setModel(tree_model)
+        tree.setUniformRowHeights(True)
         tree.setStyleSheet("QTreeView::item:selected { background-color:#007acc; color:white;}")
-        tree.currentItemChanged.connect(self.on_selection_change)
+        tree.selectionModel().currentChanged.connect(self.on_selection_change)
         tree.setColumnWidth(0, 200)
         tree.setColumnWidth(1, 120)
         self.tree = tree
 
+        # search of variables in all open files, filters the tree
+        self.search_index = SearchIndex()
+        search_edit = QLineEdit()
+        search_edit.setPlaceholderText("Search variables (name, long name, units, dimensions)")
+        search_edit.setClearButtonEnabled(True)
+        self.search_edit = search_edit
+        search_label = QLabel()
+        self.search_label = search_label
+        search_timer = QTimer(self)
+        search_timer.setSingleShot(True)
+        search_timer.setInterval(150)  # search once typing pauses
+        search_timer.timeout.connect(self.run_search)
+        search_edit.textChanged.connect(search_timer.start)
+
+        tree_widget = QWidget()
+        tree_layout = QVBoxLayout()
+        tree_layout.setContentsMargins(0, 0, 0, 0)
+        tree_widget.setLayout(tree_layout)
+        search_widget = QWidget()
+        search_layout = QHBoxLayout()
+        search_layout.setContentsMargins(0, 0, 0, 0)
+        search_widget.setLayout(search_layout)
+        search_layout.addWidget(search_edit)
+        search_layout.addWidget(search_label)
+        tree_layout.addWidget(search_widget)
+        tree_layout.addWidget(tree)
+
         data_button = QPushButton("Show data")
         data_button.clicked.connect(self.show_data)
         data_button.setEnabled(False)
@@ -63,12 +196,22 @@ class MainWindow(QMainWindow):
         plot_button.clicked.connect(self.show_map)
         plot_button.setEnabled(False)
         self.plot_button = plot_button
+        section_button = QPushButton("Show section")
+        section_button.clicked.connect(self.show_section)
+        section_button.setEnabled(False)
+        self.section_button = section_button
+        regional_button = QPushButton("Regional means")
+        regional_button.clicked.connect(self.show_regional)
+        regional_button.setEnabled(False)
+        self.regional_button = regional_button
 
         buttons_widget = QWidget()
         buttons_layout = QHBoxLayout()
         buttons_widget.setLayout(buttons_layout)
         buttons_layout.addWidget(data_button)
         buttons_layout.addWidget(plot_button)
+        buttons_layout.addWidget(section_button)
+        buttons_layout.addWidget(regional_button)
 
         text_area = QPlainTextEdit()
         text_area.setPlaceholderText("Open a file to view its contents")
@@ -80,17 +223,92 @@ class MainWindow(QMainWindow):
         main_widget = QWidget()
         main_layout = QGridLayout()
         main_widget.setLayout(main_layout)
-        main_layout.addWidget(file_button, 0, 0)
-        main_layout.addWidget(tree, 1, 0)
+        main_layout.addWidget(open_buttons_widget, 0, 0)
+        main_layout.addWidget(tree_widget, 1, 0)
         main_layout.addWidget(buttons_widget, 0, 1)
         main_layout.addWidget(text_area, 1, 1)
         self.setCentralWidget(main_widget)
 
+        # memory used by the caches and open windows, and the memory budget (see membudget)
+        memory_label = QLabel()
+        self.memory_label = memory_label
+        budget_spinner = QSpinBox()
+        budget_spinner.setRange(membudget.MIN_BUDGET_MB, 1024 * 1024)
+        budget_spinner.setSingleStep(256)
+        budget_spinner.setSuffix(" MB")
+        budget_spinner.setValue(membudget.get_budget() // (1024 * 1024))
+        budget_spinner.valueChanged.connect(self.on_budget_changed)
+        self.statusBar().addPermanentWidget(memory_label)
+        self.statusBar().addPermanentWidget(QLabel("memory budget:"))
+        self.statusBar().addPermanentWidget(budget_spinner)
+        jobs_button = QPushButton("Jobs")
+        jobs_button.clicked.connect(self.show_jobs)
+        self.jobs_button = jobs_button
+        self.statusBar().addPermanentWidget(jobs_button)
+        jobs.add_listener(self.update_jobs_button)
+        memory_timer = QTimer(self)
+        memory_timer.setInterval(1000)
+        memory_timer.timeout.connect(self.update_memory_label)
+        memory_timer.start()
+        self.update_memory_label()
+
+        self.window_created = time.perf_counter()
+
+    # Reports the startup timing after the first paint and starts pre-warming the plotting subsystem once the window is idle
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if not self.first_paint_done:
+            self.first_paint_done = True
+            report_startup_timing(self.appcontext, self.window_created, time.perf_counter())
+            QTimer.singleShot(0, lambda: prewarm_plotwindow(self.plotting_loaded.emit))
+
+    # Imports the rest of the plotting subsystem on the GUI thread once its libraries are pre-warmed, and loads a view
+    # with the map page into the pool of map views (see mappage)
+    def prewarm_map_view(self):
+        start = time.perf_counter()
+        try:
+            load_plotwindow()
+        except Exception:
+            traceback.print_exc()
+            return
+        print("NetSeeDF: plotting subsystem loaded in {:.3f} s".format(time.perf_counter() - start))
+        import mappage
+        mappage.fill_pool(self.appcontext)
+
     # Closes all windows when the MainWindow is closed.
     def closeEvent(self, event):
         QApplication.closeAllWindows()
         event.accept()
 
+    # Shows the memory used by the caches and open windows, the tooltip breaks it down by cache
+    def update_memory_label(self):
+        mb = 1024 * 1024
+        self.memory_label.setText("Memory: {:.0f} MB in caches, {:.0f} MB in windows".format(
+            membudget.get_cached_bytes() / mb, membudget.get_tracked_bytes() / mb))
+        self.memory_label.setToolTip("\n".join("{}: {} entries, {:.1f} MB".format(name, entries, nbytes / mb)
+                                               for name, entries, nbytes in membudget.get_usage()))
+
+    def on_budget_changed(self, value):
+        membudget.set_budget(value * 1024 * 1024)
+        self.update_memory_label()
+
+    # Shows the number of background jobs which are queued or running on the 'Jobs' button
+    def update_jobs_button(self, job):
+        count = jobs.get_running_count()
+        self.jobs_button.setText("Jobs ({})".format(count) if count else "Jobs")
+
+    def show_jobs(self):
+        utils.keep_window(JobsWindow())
+
+    # Shows or hides the performance panel, called when F12 is pressed
+    def toggle_perf_window(self):
+        if self.perf_window is not None and self.perf_window.isVisible():
+            self.perf_window.close()
+            self.perf_window = None
+        else:
+            self.perf_window = PerfWindow()
+            self.perf_window.show()
+
     # Show a file dialog and add the selected file to the tree of files and the variables they contain
     # Called when 'Open NetCDF file' button is clicked
     def open_file(self):
@@ -101,128 +319,210 @@ class MainWindow(QMainWindow):
         )
 
         if file_path:
-            if file_path in self.file_paths:
+            self.add_file(file_path)
+
+    # Show a directory dialog and add the selected Zarr store to the tree of files
+    # Called when 'Open Zarr store' button is clicked
+    def open_zarr(self):
+        store_path = QFileDialog.getExistingDirectory(self, "Open Zarr store", str(Path.home()))
+
+        if store_path:
+            store_path = store_path.rstrip("/\\")
+            if not zarrstore.is_zarr(store_path):
                 dlg = QMessageBox(self)
                 dlg.setWindowTitle("NetSeeDF message")
-                dlg.setText("This file is already open!")
+                dlg.setText("The selected directory is not a Zarr store!")
                 dlg.exec()
                 return
+            self.add_file(store_path)
 
-            basename = os.path.basename(file_path)
-            self.file_paths.append(file_path)
-            self.file_paths_dict[basename] = file_path
-
-            ncfile = Dataset(file_path, "r")
+    # Adds a NetCDF file or Zarr store to the tree of files and the variables they contain
+    def add_file(self, file_path):
+        if file_path in self.file_paths:
+            dlg = QMessageBox(self)
+            dlg.setWindowTitle("NetSeeDF message")
+            dlg.setText("This file is already open!")
+            dlg.exec()
+            return
 
-            item = QTreeWidgetItem([basename])
+        self.search_edit.clear()  # the new file is shown in the full tree
+        index = self.tree_model.add_file(file_path)  # groups and variables are listed when they are expanded
+        self.file_paths.append(file_path)
 
-            for var in ncfile.variables:
-                longname = ""
-                try:
-                    longname = ncfile.variables[var].long_name
-                except Exception:
-                    try:
-                        longname = ncfile.variables[var].standard_name
-                    except Exception:
-                        try:
-                            longname = ncfile.variables[var].description
-                        except Exception:
-                            pass
+        self.tree.expand(index)
+        self.tree.setCurrentIndex(index)
 
-                shapeofdata = ""
-                try:
-                    shapeofdata = str(ncfile.variables[var].shape)
-                except IndexError:
-                    pass
-                child = QTreeWidgetItem([var, longname, shapeofdata])
-                item.addChild(child)
+        QTimer.singleShot(0, lambda: self.index_file(file_path))  # index all variables once the tree is shown
 
-            # print(ncfile.groups)
+    # Defines a derived variable from the variables of the open files, derived variables are listed in the tree as
+    # the variables of a virtual file
+    def new_derived_variable(self):
+        variables = [(e.file_path, e.path, e.name) for e in self.search_index.entries]
+        variables += [(derived.DERIVED_PATH, d.name, d.name) for d in derived.get_definitions()]
+        if not variables:
+            dlg = QMessageBox(self)
+            dlg.setWindowTitle("NetSeeDF message")
+            dlg.setText("Open a file first, derived variables are calculated from the variables of open files.")
+            dlg.exec()
+            return
 
-            # for children in walktree(ncfile):
-            #    for child in children:
-            #        print(child)
+        current = self.tree_model.node(self.tree.currentIndex())
+        dialog = DerivedDialog(self, variables, current.file_path)
+        if not dialog.exec():
+            return
 
-            ncfile.close()
+        self.search_edit.clear()
+        if derived.DERIVED_PATH in self.file_paths:
+            index = self.tree_model.reload_file(derived.DERIVED_PATH)
+        else:
+            index = self.tree_model.add_file(derived.DERIVED_PATH, derived.get_display_name(derived.DERIVED_PATH))
+            self.file_paths.append(derived.DERIVED_PATH)
+        self.tree.expand(index)
+
+    # Adds the variables of a file to the search index, the file is scanned in a job (all groups of a large file take a
+    # while) and its variables are added once it is done
+    def index_file(self, file_path):
+        jobs.submit("Index " + os.path.basename(file_path), lambda job: prepare_file(file_path, job), file_path,
+                    jobs.PRIORITY_LOW, self.on_file_indexed)
+
+    def on_file_indexed(self, job):
+        if job.state != jobs.FINISHED:
+            return  # the file can still be browsed, its variables are just not found by the search
+        self.search_index.add_entries(*job.result)
+        if self.search_edit.text().strip():
+            self.run_search()
+
+    # Filters the tree to the variables matching the text in the search box
+    def run_search(self):
+        query = self.search_edit.text().strip()
+        if not query:
+            self.tree_model.set_filter(None)
+            self.search_label.setText("")
+            self.search_label.setToolTip("")
+            return
 
-            self.tree.addTopLevelItem(item)
-            self.tree.expandItem(item)
-            self.tree.setCurrentItem(item)
+        entries, truncated = self.search_index.search(query)
+        self.tree_model.set_filter(entries)
+        self.tree.expandAll()
+        if truncated:
+            self.search_label.setText("first " + str(len(entries)) + " shown")
+            self.search_label.setToolTip("More variables match the search, type a longer query to narrow it down.")
+        else:
+            self.search_label.setText(str(len(entries)) + " found")
+            self.search_label.setToolTip("")
 
     # Get currently selected item in the tree view and the number of dimensions of the variable
     def get_info_about_selected(self):
-        current_item = self.tree.currentItem()
-        variable_name = current_item.data(0, Qt.ItemDataRole.DisplayRole)
-        file_name = current_item.parent().data(0, Qt.ItemDataRole.DisplayRole)
-        file_path = self.file_paths_dict[file_name]
-        return datautils.identify_dims(file_path, variable_name)
+        node = self.tree_model.node(self.tree.currentIndex())
+        return datautils.identify_dims(node.file_path, node.path)
 
 
     # Displays a table of the data for the selected variable in a new window
     def show_data(self):
         var_props = self.get_info_about_selected()
 
-        dataw = DataWindow(var_props)
-
-        dataw.show()
-        self.open_windows.append(dataw)
+        utils.keep_window(DataWindow(var_props))
 
     # Plot the data for the selected variable in a new window
     def show_map(self):
         var_props = self.get_info_about_selected()
 
-        if var_props["x_dim"] == "x" and var_props["y_dim"] == "y":
+        # projected and curvilinear grids are reprojected, which needs a grid mapping or 2D latitude and longitude
+        if reproject.needs_reprojection(var_props) and not reproject.can_reproject(var_props):
             dlg = QMessageBox(self)
             dlg.setWindowTitle("NetSeeDF message")
             dlg.setText("NetSeeDF does not support this type of coordinate system yet!")
             dlg.exec()
             return
 
-        plotw = PlotWindow(self.appcontext, var_props)
-        plotw.show()
-        self.open_windows.append(plotw)
+        QApplication.setOverrideCursor(Qt.CursorShape.WaitCursor)  # on the first map the plotting subsystem might still be loading
+        try:
+            plotwindow = load_plotwindow()
+        finally:
+            QApplication.restoreOverrideCursor()
+
+        utils.keep_window(plotwindow.PlotWindow(self.appcontext, var_props))
+
+    # Shows a section of the selected variable along two of its dims in a new window
+    def show_section(self):
+        var_props = self.get_info_about_selected()
+
+        QApplication.setOverrideCursor(Qt.CursorShape.WaitCursor)  # the section window uses the plotting subsystem
+        try:
+            import sectionwindow
+        finally:
+            QApplication.restoreOverrideCursor()
+
+        utils.keep_window(sectionwindow.SectionWindow(var_props))
+
+    # Shows the area weighted mean time series of regions of the selected variable in a new window. Variables of the
+    # open files which have the shape of its grid are offered as masks.
+    def show_regional(self):
+        var_props = self.get_info_about_selected()
+        grid_shape = (var_props["sizes"][var_props["y_dim"]], var_props["sizes"][var_props["x_dim"]])
+        mask_variables = [(e.file_path, e.path) for e in self.search_index.entries
+                          if e.shape in (str(grid_shape), str(grid_shape[::-1]))]
+
+        QApplication.setOverrideCursor(Qt.CursorShape.WaitCursor)  # the regional window uses the plotting subsystem
+        try:
+            import regionalwindow
+        finally:
+            QApplication.restoreOverrideCursor()
+
+        utils.keep_window(regionalwindow.RegionalWindow(var_props, mask_variables))
 
     # Called when the user select a new row in the tree view of files and variables
     # File info or variable info is displayed in the text area
     def on_selection_change(self, current, previous):
-        selection_name = current.data(0, Qt.ItemDataRole.DisplayRole)
-        parent = current.parent()
-
-        if parent is None:  # file is selected
-            ncfile = Dataset(self.file_paths_dict[selection_name], "r")
+        node = self.tree_model.node(current)
+        if node.kind == "root":  # nothing selected, e.g. after the tree was filtered
+            self.plot_button.setEnabled(False)
+            self.data_button.setEnabled(False)
+            self.section_button.setEnabled(False)
+            self.regional_button.setEnabled(False)
+            return
 
-            dimensiontext = "dimension \t size\n ----------------------\n"
-            for key, value in ncfile.dimensions.items():
-                dimensiontext += key + "\t" + str(value.size) + "\n"
+        if node.kind in ("file", "group"):  # file or group is selected
+            ncfile = datautils.open_dataset(node.file_path)
+            try:
+                group = datautils.get_group(ncfile, node.path)
 
-            attrtext = ""
-            for key in ncfile.ncattrs():
-                value = ncfile.getncattr(str(key))
-                attrtext += str(key) + "\t" + str(value) + "\n"
+                dimensiontext = "dimension \t size\n ----------------------\n"
+                for key, value in group.dimensions.items():
+                    dimensiontext += key + "\t" + str(value.size) + "\n"
 
-            ncfile.close()
+                attrtext = ""
+                for key in group.ncattrs():
+                    value = group.getncattr(str(key))
+                    attrtext += str(key) + "\t" + str(value) + "\n"
+            finally:
+                ncfile.close()
 
+            title = node.name if node.kind == "file" else node.path
             self.text_area.setPlainText(
-                selection_name + "\n\nDIMENSIONS\n" + dimensiontext + "\n\nATTRIBUTES\n" + attrtext)
+                title + "\n\nDIMENSIONS\n" + dimensiontext + "\n\nATTRIBUTES\n" + attrtext)
             self.plot_button.setEnabled(False)
             self.data_button.setEnabled(False)
+            self.section_button.setEnabled(False)
+            self.regional_button.setEnabled(False)
 
         else:  # variable is selected
-            parent_name = parent.data(0, Qt.ItemDataRole.DisplayRole)  # get the name of the file containing the selected variable
-
-            ncfile = Dataset(self.file_paths_dict[parent_name], "r")
-            var = ncfile.variables[selection_name]
-            dims = list(var.dimensions)
-            shapes = list(var.shape)
+            ncfile = datautils.open_dataset(node.file_path)
+            try:
+                var = datautils.get_variable(ncfile, node.path)
+                dims = list(var.dimensions)
+                shapes = list(var.shape)
 
-            self.text_area.setPlainText(str(var)) # set text about variable
-
-            ncfile.close()
+                self.text_area.setPlainText(str(var)) # set text about variable
+            finally:
+                ncfile.close()
 
             var_props = datautils.identify_dims_from_vardata(dims, shapes)
 
             self.plot_button.setEnabled(var_props["can_plot"]) # only enable plot button, if we have identified x and y dimensions
             self.data_button.setEnabled(bool(len(var_props["all_dims"]) > 0))
+            self.section_button.setEnabled(len(var_props["all_dims"]) - len(var_props["drop_dims"]) >= 2)
+            self.regional_button.setEnabled(var_props["can_plot"] and var_props["t_dim"] in var_props["sliceable_dims"])
 
 
 class AppContext(ApplicationContext):
@@ -234,15 +534,11 @@ class AppContext(ApplicationContext):
     def main_window(self):
         return MainWindow(self)
 
-    @cached_property
-    def webchanneljs(self):
-        webchannelcodepath = self.get_resource("qwebchannel.js")
-        with open(webchannelcodepath) as f:
-            webchanneljs = f.read()
-        return webchanneljs
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # parallel reads use worker processes, which also start from the frozen executable
+
     try:  # Set taskbar icon on Windows
         from ctypes import windll  # Only exists on Windows.
         myappid = 'org.rokuk.netseedf'
@@ -250,6 +546,13 @@ if __name__ == "__main__":
     except ImportError:
         pass
 
+    # QtWebEngine is imported after the QApplication is created, which requires sharing OpenGL contexts
+    QCoreApplication.setAttribute(Qt.ApplicationAttribute.AA_ShareOpenGLContexts)
+
+    # the map page is served from the netseedf:// scheme, which has to be registered before the QApplication is created
+    import mappage
+    mappage.register_scheme()
+
     appctxt = AppContext()
     exit_code = appctxt.run()
     sys.exit(exit_code)
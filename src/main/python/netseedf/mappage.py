@@ -0,0 +1,192 @@
+import os
+
+from PySide6.QtCore import QBuffer, QByteArray, QIODevice, QObject, QTimer, QUrl, Slot
+from PySide6.QtWebEngineCore import QWebEngineProfile, QWebEngineUrlRequestJob, QWebEngineUrlScheme, \
+    QWebEngineUrlSchemeHandler
+
+import perf
+import tiles
+
+# The map of the plot windows is the same page for every window: Leaflet with its plugins, the web channel and the
+# handlers of map events. It is rendered once and served together with its scripts and styles from the netseedf://
+# scheme, so the scripts are loaded by the browser instead of being inlined into the html of every window. POOL_SIZE
+# views with the page already loaded are kept ready and handed to new plot windows, which only add their overlay
+# (show_overlay in the page) and attach their backend to the bridge of the page. With a local basemap (see tiles) its
+# tiles are served from the scheme as well.
+#
+# The scheme has to be registered before the QApplication is created (see register_scheme), QtWebEngineWidgets and
+# the plotting subsystem are only imported when the first view is created.
+
+SCHEME = b"netseedf"
+ASSET_URL = "netseedf://app/"
+PAGE_URL = ASSET_URL + "map.html"
+POOL_SIZE = 1  # views kept ready, one more is loaded whenever a view is taken
+POOL_REFILL_DELAY_MS = 1000  # the next view is loaded once the window which took one has loaded its map
+ASSET_TYPES = {".js": b"application/javascript", ".css": b"text/css", ".html": b"text/html"}
+
+_appcontext = None
+_handler = None
+_page_html = None
+_pool = []
+
+
+def register_scheme():
+    scheme = QWebEngineUrlScheme(SCHEME)
+    scheme.setSyntax(QWebEngineUrlScheme.Syntax.Host)
+    scheme.setFlags(QWebEngineUrlScheme.Flag.SecureScheme | QWebEngineUrlScheme.Flag.LocalAccessAllowed |
+                    QWebEngineUrlScheme.Flag.CorsEnabled)
+    QWebEngineUrlScheme.registerScheme(scheme)
+
+
+# Serves the map page and the bundled scripts and styles (qwebchannel.js and offline_folium/*) from the resources
+class SchemeHandler(QWebEngineUrlSchemeHandler):
+    def requestStarted(self, job):
+        path = job.requestUrl().path().lstrip("/")
+        content_type = ASSET_TYPES.get(os.path.splitext(path)[1])
+        if path.startswith("tiles/"):
+            try:
+                z, x, y = (int(part) for part in path.split("/")[1:])
+                tile = tiles.get_tile(z, x, y)
+            except ValueError:
+                tile = None
+            if tile is None:
+                job.fail(QWebEngineUrlRequestJob.Error.UrlNotFound)
+                return
+            data, content_type = tile
+        elif path == "map.html":
+            data = get_page_html().encode("utf-8")
+        else:
+            directory, name = os.path.split(path)
+            if directory not in ("", "offline_folium") or os.path.splitext(name)[1] not in ASSET_TYPES:
+                job.fail(QWebEngineUrlRequestJob.Error.UrlNotFound)
+                return
+            try:
+                with open(_appcontext.get_resource(os.path.join(directory, name)), "rb") as f:
+                    data = f.read()
+            except OSError:
+                job.fail(QWebEngineUrlRequestJob.Error.UrlNotFound)
+                return
+
+        buffer = QBuffer(job)  # deleted with the job
+        buffer.setData(QByteArray(data))
+        buffer.open(QIODevice.OpenModeFlag.ReadOnly)
+        job.reply(content_type, buffer)
+
+
+# Forwards the calls of the page to the backend of the window the view was handed to, calls before that are dropped.
+# The bridge is registered in the web channel before the page loads, as objects registered later are not seen by it.
+class MapBridge(QObject):
+    def __init__(self):
+        super().__init__()
+        self.backend = None
+
+    @Slot(float, float)
+    def on_map_click(self, lat, lon):
+        if self.backend is not None:
+            self.backend.on_map_click(lat, lon)
+
+    @Slot(float, float)
+    def on_map_hover(self, lat, lon):
+        if self.backend is not None:
+            self.backend.on_map_hover(lat, lon)
+
+    @Slot(float, float, float, float, int, int)
+    def on_view_changed(self, south, west, north, east, width, height):
+        if self.backend is not None:
+            self.backend.on_view_changed(south, west, north, east, width, height)
+
+    @Slot(float, float, float, float)
+    def on_region_drawn(self, south, west, north, east):
+        if self.backend is not None:
+            self.backend.on_region_drawn(south, west, north, east)
+
+    @Slot()
+    def on_export_requested(self):
+        if self.backend is not None:
+            self.backend.on_export_requested()
+
+
+# A web view with the map page, scripts run before the page has loaded are queued until it has
+class MapView:
+    def __init__(self):
+        from PySide6.QtWebChannel import QWebChannel
+        from PySide6.QtWebEngineWidgets import QWebEngineView
+
+        self.loaded = False
+        self.pending = []
+        self.view = QWebEngineView()
+        self.bridge = MapBridge()
+        self.channel = QWebChannel(self.view)
+        self.channel.registerObject("backend", self.bridge)
+        self.view.page().setWebChannel(self.channel)
+        self.view.loadFinished.connect(self.on_load_finished)
+        self.view.load(QUrl(PAGE_URL))
+
+    def on_load_finished(self, ok):
+        self.loaded = True
+        pending, self.pending = self.pending, []
+        for code in pending:
+            self.view.page().runJavaScript(code)
+
+    def run_js(self, code):
+        if self.loaded:
+            self.view.page().runJavaScript(code)
+        else:
+            self.pending.append(code)
+
+
+# Html of the map page, rendered by folium on first use
+def get_page_html():
+    global _page_html
+    if _page_html is None:
+        with perf.operation("render_map_page"):
+            import folium
+            import offline
+            from plotutils import WebChannelJS, MapPageJS
+
+            offline.setup_folium()
+            tile_source = tiles.get_source()
+            if tile_source is None:
+                page_map = folium.Map(location=[0, 0], zoom_start=1)
+            else:
+                page_map = folium.Map(location=[0, 0], zoom_start=1, tiles=None)
+                folium.TileLayer(ASSET_URL + tiles.TILE_URL_PATH, attr=tile_source.attribution, min_zoom=tile_source.min_zoom,
+                                 max_native_zoom=tile_source.max_zoom, max_zoom=max(tile_source.max_zoom, tiles.DEFAULT_MAX_ZOOM),
+                                 name="basemap").add_to(page_map)
+            page_map._name = "folium"
+            page_map._id = "1"
+            page_map.get_root().html.add_child(folium.Element('<script src="' + ASSET_URL + 'qwebchannel.js"></script>'))
+            page_map.add_child(WebChannelJS())
+            page_map.add_child(MapPageJS())
+            _page_html = page_map.get_root().render()
+    return _page_html
+
+
+def install_handler(appcontext):
+    global _appcontext, _handler
+    _appcontext = appcontext
+    if _handler is None:
+        _handler = SchemeHandler()
+        QWebEngineProfile.defaultProfile().installUrlSchemeHandler(SCHEME, _handler)
+
+
+# Loads views until POOL_SIZE are ready
+def fill_pool(appcontext):
+    install_handler(appcontext)
+    get_page_html()
+    while len(_pool) < POOL_SIZE:
+        _pool.append(MapView())
+
+
+# Returns a view with the map page (loaded or loading) for a new window and loads the next one a little later
+def take_view(appcontext):
+    install_handler(appcontext)
+    if _pool:
+        perf.count("map_view_pool_hits")
+        map_view = _pool.pop(0)
+    else:
+        perf.count("map_view_pool_misses")
+        get_page_html()
+        map_view = MapView()
+    QTimer.singleShot(POOL_REFILL_DELAY_MS, lambda: fill_pool(appcontext))
+    return map_view
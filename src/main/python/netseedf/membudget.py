@@ -0,0 +1,240 @@
+import heapq
+import os
+import threading
+
+import numpy as np
+
+import perf
+
+# Process wide memory budget shared by all in-memory caches (slices, time series columns, decoded times, warp maps,
+# rendered images, ...). Every cache is a BudgetedCache, and when the entries of all caches together with the memory
+# held by open windows (see track) exceed the budget, cache entries are evicted across all caches.
+#
+# Eviction is cost-aware LRU (GreedyDual-Size): every entry has a priority of clock + cost / size, where cost is the
+# time it took to produce the entry. The entry with the lowest priority is evicted and the clock advances to its
+# priority, so entries which were not used for a while lose their advantage. Entries which are cheap to produce per
+# byte (e.g. a large slice of an uncompressed file) go before expensive ones (e.g. a warp map or a slice averaged over
+# a large region); with equal costs this is plain LRU. Memory held by windows is counted but never evicted, it is
+# released when the window closes.
+#
+# The entries are found in order of priority through a heap of (priority, sequence, cache, key), which gets a new item
+# every time an entry is used. Items of entries which were used again or removed since are skipped when they come up.
+#
+# NETSEEDF_MEMORY_MB   memory budget in megabytes (default: a quarter of the physical memory, at least
+#                      MIN_BUDGET_MB and at most MAX_DEFAULT_BUDGET_MB), can be changed in the main window
+
+MIN_BUDGET_MB = 256
+MAX_DEFAULT_BUDGET_MB = 4096
+FALLBACK_BUDGET_MB = 1024  # when the physical memory is not known
+DEFAULT_COST = 1e-9  # seconds per byte of entries without a measured cost (1 s per GB)
+
+_lock = threading.RLock()
+_caches = []
+_tracked = {}  # id of the owner -> {name: bytes}
+_heap = []  # (priority, sequence, cache, key) of the entries, see push
+_clock = 0.0
+_sequence = 0  # breaks ties of priorities in order of use
+_budget = None
+
+
+class Entry:
+    def __init__(self, value, nbytes, cost):
+        self.value = value
+        self.nbytes = nbytes
+        self.cost = cost
+        self.priority = 0.0
+        self.sequence = 0
+
+    def touch(self):
+        global _sequence
+        _sequence += 1
+        self.priority = _clock + self.cost / max(1, self.nbytes)
+        self.sequence = _sequence
+
+
+# Adds an entry which was just touched to the heap. Sequences are unique, so an item is still valid if the entry stored
+# under its key has its sequence. The heap is rebuilt from the entries when most of its items are no longer valid.
+def push(cache, key, entry):
+    global _heap
+    heapq.heappush(_heap, (entry.priority, entry.sequence, cache, key))
+    if len(_heap) > 1024 and len(_heap) > 4 * sum(len(c.entries) for c in _caches):
+        _heap = [(e.priority, e.sequence, c, k) for c in _caches for k, e in c.entries.items()]
+        heapq.heapify(_heap)
+
+
+# A cache of values whose size counts against the memory budget. A value can be evicted whenever another value is
+# put into any cache, get() then returns the default and the value has to be produced again.
+class BudgetedCache:
+    def __init__(self, name):
+        self.name = name
+        self.entries = {}
+        self.nbytes = 0
+        with _lock:
+            _caches.append(self)
+
+    def get(self, key, default=None):
+        with _lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            entry.touch()
+            push(self, key, entry)
+            return entry.value
+
+    def __contains__(self, key):
+        with _lock:
+            return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def keys(self):
+        with _lock:
+            return list(self.entries)
+
+    # Stores a value of nbytes (the size of numpy arrays and bytes is determined if not given), cost is the time in
+    # seconds it took to produce the value
+    def put(self, key, value, nbytes=None, cost=None):
+        if nbytes is None:
+            nbytes = get_size(value)
+        if cost is None:
+            cost = nbytes * DEFAULT_COST
+        with _lock:
+            self.remove_entry(key)
+            entry = Entry(value, int(nbytes), float(cost))
+            entry.touch()
+            self.entries[key] = entry
+            push(self, key, entry)
+            self.nbytes += entry.nbytes
+            enforce(keep=entry)
+        return value
+
+    def pop(self, key, default=None):
+        with _lock:
+            entry = self.remove_entry(key)
+            return entry.value if entry is not None else default
+
+    def remove_entry(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry.nbytes
+        return entry
+
+    # Removes the entries whose key matches, e.g. all entries of a closed variable
+    def remove_where(self, matches):
+        with _lock:
+            for key in [key for key in self.entries if matches(key)]:
+                self.remove_entry(key)
+
+    def clear(self):
+        with _lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+
+# Size in bytes of numpy arrays (including the mask of masked arrays), bytes and tuples or lists of them
+def get_size(value):
+    if isinstance(value, np.ndarray):
+        nbytes = value.nbytes
+        mask = np.ma.getmask(value)
+        if mask is not np.ma.nomask:
+            nbytes += mask.nbytes
+        if value.dtype == object:
+            nbytes += value.size * 64  # the objects themselves, e.g. decoded dates
+        return nbytes
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    if isinstance(value, (tuple, list)):
+        return sum(get_size(v) for v in value)
+    return 64
+
+
+def get_default_budget():
+    try:
+        return int(float(os.environ["NETSEEDF_MEMORY_MB"]) * 1024 * 1024)
+    except (KeyError, ValueError):
+        pass
+    try:
+        physical = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+        budget_mb = min(MAX_DEFAULT_BUDGET_MB, max(MIN_BUDGET_MB, physical // 4 // (1024 * 1024)))
+    except (AttributeError, ValueError, OSError):
+        budget_mb = FALLBACK_BUDGET_MB
+    return int(budget_mb * 1024 * 1024)
+
+
+def get_budget():
+    global _budget
+    if _budget is None:
+        _budget = get_default_budget()
+    return _budget
+
+
+def set_budget(nbytes):
+    global _budget
+    with _lock:
+        _budget = int(nbytes)
+        enforce()
+
+
+# Counts memory held by an owner (e.g. the formatted cells of a table window) against the budget, under a name so
+# that the owner can update it. Released with untrack when the owner closes.
+def track(owner, name, nbytes):
+    with _lock:
+        _tracked.setdefault(id(owner), {})[name] = int(nbytes)
+        enforce()
+
+
+def untrack(owner):
+    with _lock:
+        _tracked.pop(id(owner), None)
+
+
+def get_cached_bytes():
+    with _lock:
+        return sum(cache.nbytes for cache in _caches)
+
+
+def get_tracked_bytes():
+    with _lock:
+        return sum(sum(held.values()) for held in _tracked.values())
+
+
+def get_used_bytes():
+    return get_cached_bytes() + get_tracked_bytes()
+
+
+# List of (cache name, number of entries, bytes) of all caches
+def get_usage():
+    with _lock:
+        return [(cache.name, len(cache.entries), cache.nbytes) for cache in _caches]
+
+
+# Evicts the entries with the lowest priority until the used memory fits into the budget. The entry keep (the one just
+# stored) is evicted last, so a value larger than the budget is returned to its caller but not kept.
+def enforce(keep=None):
+    global _clock
+    with _lock:
+        budget = get_budget()
+        used = get_used_bytes()
+        kept = None
+        while used > budget:
+            if not _heap:  # only the new entry is left, it does not fit
+                if kept is not None:
+                    kept[2].remove_entry(kept[3])
+                    kept = None
+                break
+            item = heapq.heappop(_heap)
+            priority, sequence, cache, key = item
+            entry = cache.entries.get(key)
+            if entry is None or entry.sequence != sequence:
+                continue  # removed or used again since
+            if entry is keep:
+                kept = item
+                continue
+            cache.remove_entry(key)
+            _clock = max(_clock, entry.priority)
+            used -= entry.nbytes
+            perf.count("memory_evictions")
+            perf.count("memory_evicted_bytes", entry.nbytes)
+        if kept is not None:
+            heapq.heappush(_heap, kept)
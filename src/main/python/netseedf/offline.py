@@ -2,14 +2,15 @@ from branca.element import Element, CssLink
 from jinja2 import Template
 import os
 
+import mappage
+
+# Folium links its scripts and styles from CDNs. For offline use they are bundled in the resources (see
+# downloadfolium.py) and the links point to the netseedf:// scheme, which serves them from there (see mappage).
+
 
 class Link(Element):
-    def get_code(self):
-        if self.code is None:
-            with open(appcontext.get_resource(self.url), "r", encoding="utf-8") as f:
-                contents = f.read()
-            self.code = contents
-        return self.code
+    def get_url(self):
+        return mappage.ASSET_URL + self.url.replace(os.sep, "/")
 
     def to_dict(self, depth=-1, **kwargs):
         out = super(Link, self).to_dict(depth=-1, **kwargs)
@@ -19,27 +20,21 @@ class Link(Element):
 
 class JavascriptLink(Link):
 
-    _template = Template("<script>{{this.get_code()}}</script>")
+    _template = Template('<script src="{{this.get_url()}}"></script>')
 
     def __init__(self, url, download=False):
         super(JavascriptLink, self).__init__()
         self._name = "JavascriptLink"
         self.url = url
-        self.code = None
 
 
 class CssLink(Link):
-    _template = Template("<style>{{this.get_code()}}</style>")
+    _template = Template('<link rel="stylesheet" href="{{this.get_url()}}"/>')
 
     def __init__(self, url, download=False):
         super(CssLink, self).__init__()
         self._name = "CssLink"
         self.url = url
-        self.code = None
-
-def set_appcontext(appctxt):
-    global appcontext
-    appcontext = appctxt
 
 def setup_folium():
     import folium
@@ -56,4 +51,4 @@ def setup_folium():
     folium.Map.default_css = folium.folium._default_css
 
     folium.elements.JavascriptLink = JavascriptLink
-    folium.elements.CssLink = CssLink
\ No newline at end of file
+    folium.elements.CssLink = CssLink
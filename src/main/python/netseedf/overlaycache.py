@@ -0,0 +1,225 @@
+import hashlib
+import json
+import os
+import struct
+import tempfile
+
+from PySide6.QtCore import QStandardPaths
+
+import datautils
+import membudget
+import perf
+
+# Persistent on-disk cache of rendered map overlays and colorbars, shared between sessions and app instances.
+# Every entry is a single file named by the hash of its key, so writing it (temp file + rename) is atomic and
+# several NetSeeDF instances can use the same cache directory. Entries are evicted in least recently used order
+# (the modification time of a file is updated on every hit) once the size limit is exceeded. Recently used images are
+# also kept in memory, as long as the memory budget has room for them (see membudget).
+#
+# Every entry also holds the value range of the rendered data, so that an autoscaled overlay (cached under an autoscale
+# flag instead of its scale) can be shown together with its scale without reading the data.
+#
+# NETSEEDF_CACHE_DIR       cache directory (default: the platform cache location), e.g. a shared directory
+# NETSEEDF_CACHE_SIZE_MB   size limit of the overlay cache in megabytes (default 500, 0 disables the cache)
+
+CACHE_FORMAT_VERSION = 2  # increase when the rendering changes, so that old images are not reused
+DEFAULT_SIZE_LIMIT_MB = 500
+ENTRY_SUFFIX = ".ovl"
+ENTRY_MAGIC = b"NSDF"
+HEADER_FORMAT = "<Qdd"  # length of the image, min and max value, after the magic
+HEADER_SIZE = len(ENTRY_MAGIC) + struct.calcsize(HEADER_FORMAT)
+
+_cache_dir = None
+_total_size = None  # approximate size of the cache directory, None until it has been scanned
+_images = membudget.BudgetedCache("rendered images")  # key -> (image png bytes, colorbar png bytes, min, max)
+
+
+def get_cache_root():
+    cache_root = os.environ.get("NETSEEDF_CACHE_DIR")
+    if not cache_root:
+        cache_root = QStandardPaths.writableLocation(QStandardPaths.StandardLocation.CacheLocation)
+    if not cache_root:
+        cache_root = os.path.join(tempfile.gettempdir(), "netseedf-cache")
+    return cache_root
+
+
+def get_size_limit():
+    try:
+        return int(float(os.environ.get("NETSEEDF_CACHE_SIZE_MB", DEFAULT_SIZE_LIMIT_MB)) * 1024 * 1024)
+    except ValueError:
+        return DEFAULT_SIZE_LIMIT_MB * 1024 * 1024
+
+
+def get_cache_dir():
+    global _cache_dir
+    if _cache_dir is None:
+        _cache_dir = os.path.join(get_cache_root(), "overlays")
+        os.makedirs(_cache_dir, exist_ok=True)
+    return _cache_dir
+
+
+def is_enabled():
+    return get_size_limit() > 0
+
+
+# Builds the key of a rendered overlay. Size and modification time of the file (see datautils.get_file_state) are part
+# of the key, so entries of a file which has been changed are never used again (they are evicted eventually). lod
+# identifies overlays of reduced resolution data or of a part of the grid (a json serialisable list), None for the
+# whole grid at full resolution.
+# The region of the variable (see datautils.region_index) is part of the key, as lod windows are relative to it.
+# resampling is (period, statistic) for overlays of aggregated slices (see resample), the index of the time dim in
+# slice_indices is then the index of the group. vmin and vmax are None for overlays scaled to the value range of the data.
+def make_key(var_props, slice_indices, vmin, vmax, cmap_name, converted, lod=None, resampling=None):
+    file_path = os.path.abspath(var_props["file_path"])
+    file_state = datautils.get_file_state(file_path)
+    if file_state is None:
+        return None
+    size, mtime = file_state
+
+    key = [
+        CACHE_FORMAT_VERSION,
+        file_path,
+        size,
+        mtime,
+        var_props["variable_name"],
+        [int(i) for i in slice_indices],
+        "auto" if vmin is None else repr(float(vmin)),
+        "auto" if vmax is None else repr(float(vmax)),
+        cmap_name,
+        bool(converted),
+    ]
+    if lod is not None:
+        key.append(lod)
+    if var_props.get("region") is not None:
+        key.append(["region", [int(i) for i in var_props["region"]]])
+    if resampling is not None:
+        key.append(["resample", list(resampling)])
+    return hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()
+
+
+def get_entry_path(key):
+    return os.path.join(get_cache_dir(), key[:2], key + ENTRY_SUFFIX)
+
+
+# Returns (image png bytes, colorbar png bytes, min value, max value) for the key or None if it is not cached
+def get(key):
+    if key is None:
+        return None
+    cached = _images.get(key)
+    if cached is not None:
+        perf.count("overlay_memory_hit")
+        return cached
+    if not is_enabled():
+        return None
+
+    entry_path = get_entry_path(key)
+    try:
+        with open(entry_path, "rb") as f:
+            contents = f.read()
+    except OSError:
+        perf.count("overlay_cache_miss")
+        return None
+
+    if len(contents) < HEADER_SIZE or contents[:4] != ENTRY_MAGIC:
+        return None
+    image_length, min_value, max_value = struct.unpack(HEADER_FORMAT, contents[4:HEADER_SIZE])
+    if HEADER_SIZE + image_length > len(contents):
+        return None
+
+    try:
+        os.utime(entry_path)  # mark as recently used
+    except OSError:
+        pass
+    perf.count("overlay_cache_hit")
+
+    image_end = HEADER_SIZE + image_length
+    return _images.put(key, (contents[HEADER_SIZE:image_end], contents[image_end:], min_value, max_value))
+
+
+# Stores the images of the key with the value range of the rendered data, cost is the time in seconds it took to
+# render them
+def put(key, image, colorbar, min_value, max_value, cost=None):
+    global _total_size
+    if key is None:
+        return
+    _images.put(key, (image, colorbar, float(min_value), float(max_value)), cost=cost)
+    if not is_enabled():
+        return
+
+    entry_path = get_entry_path(key)
+    entry_dir = os.path.dirname(entry_path)
+    contents = ENTRY_MAGIC + struct.pack(HEADER_FORMAT, len(image), min_value, max_value) + image + colorbar
+
+    try:
+        os.makedirs(entry_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=entry_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(contents)
+            os.replace(tmp_path, entry_path)  # atomic, other instances see either the whole entry or none
+        except Exception:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+    except OSError:
+        return
+
+    if _total_size is None:
+        _total_size = scan_size()
+    else:
+        _total_size += len(contents)
+
+    if _total_size > get_size_limit():
+        evict()
+
+
+def list_entries():
+    entries = []
+    for root, _, files in os.walk(get_cache_dir()):
+        for name in files:
+            if not name.endswith(ENTRY_SUFFIX):
+                continue
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:  # removed by another instance in the meantime
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+    return entries
+
+
+def scan_size():
+    return sum(size for _, size, _ in list_entries())
+
+
+# Removes least recently used entries until the cache uses at most 90 % of the size limit.
+# The directory is rescanned, since other instances might have added or removed entries.
+def evict():
+    global _total_size
+    entries = sorted(list_entries())
+    total = sum(size for _, size, _ in entries)
+    target = get_size_limit() * 0.9
+
+    for _, size, path in entries:
+        if total <= target:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass  # already removed by another instance
+        total -= size
+
+    _total_size = total
+
+
+def clear():
+    global _total_size
+    _images.clear()
+    for _, _, path in list_entries():
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    _total_size = 0
@@ -0,0 +1,230 @@
+import atexit
+import multiprocessing
+import os
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import numpy.ma as ma
+
+import readplanner
+from zarrstore import split_index, normalize_key
+
+# Parallel reading of large compressed hyperslabs of NetCDF4 variables. The netCDF library is not thread-safe, so the
+# hyperslab is split along chunk boundaries and the pieces are read (and decompressed) in worker processes, which keep
+# their own file handles open. The workers write their pieces directly into a shared memory block which becomes the
+# data of the returned array, so the assembled slice is not copied again, and the masks of their pieces into a second
+# block. Cells which no piece has written stay masked, NaNs in the data are returned like netCDF4 returns them.
+#
+# NETSEEDF_READ_PROCESSES   number of worker processes (default: number of cores, up to 8), 0 or 1 disables parallel reads
+# NETSEEDF_PARALLEL_MIN_MB  minimum size of a read to be done in parallel in megabytes (default 32)
+
+COMPRESSION_FILTERS = ("zlib", "szip", "zstd", "bzip2", "blosc")
+WORKER_CACHE_BYTES = 64 * 1024 * 1024  # enlarged chunk caches of a worker process, see readplanner
+
+_executor = None
+_worker_files = {}  # file handles of a worker process, path -> (mtime, Dataset)
+
+
+def get_process_count():
+    try:
+        return int(os.environ.get("NETSEEDF_READ_PROCESSES", min(8, os.cpu_count() or 1)))
+    except ValueError:
+        return 1
+
+
+def get_min_bytes():
+    try:
+        return float(os.environ.get("NETSEEDF_PARALLEL_MIN_MB", 32)) * 1024 * 1024
+    except ValueError:
+        return 32 * 1024 * 1024
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        # spawn instead of fork, forking a process with running Qt threads is not safe
+        _executor = ProcessPoolExecutor(max_workers=get_process_count(), mp_context=multiprocessing.get_context("spawn"),
+                                        initializer=init_worker)
+    return _executor
+
+
+# Runs in every worker process when it starts, the workers keep their files open, so their chunk caches are limited
+def init_worker():
+    readplanner.set_cache_budget(WORKER_CACHE_BYTES)
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+atexit.register(shutdown)
+
+
+# The data type of what netCDF4 returns for the variable, which differs from the stored type for packed variables
+def get_output_dtype(var):
+    dtype = np.dtype(var.dtype)
+    attrs = var.ncattrs()
+    if "scale_factor" in attrs or "add_offset" in attrs:
+        types = [dtype]
+        for attr in ("scale_factor", "add_offset"):
+            if attr in attrs:
+                types.append(np.asarray(var.getncattr(attr)).dtype)
+        dtype = np.result_type(*types)
+    return dtype
+
+
+def is_compressed(var):
+    try:
+        filters = var.filters()
+    except Exception:
+        return False
+    return bool(filters) and any(filters.get(f) for f in COMPRESSION_FILTERS)
+
+
+# Splits the selection along chunk boundaries of the dimension which spans the most chunks, into about two pieces per
+# worker process. Returns a list of (selection of the piece, index of the piece in the output) or None if the
+# selection cannot be split.
+def plan_pieces(key, shape, chunks, n_processes):
+    parts_per_dim = [split_index(k, size, chunk) for k, size, chunk in zip(key, shape, chunks)]
+
+    split_dim = None
+    for i, parts in enumerate(parts_per_dim):
+        if isinstance(key[i], slice) and len(parts) > 1:
+            if split_dim is None or len(parts) > len(parts_per_dim[split_dim]):
+                split_dim = i
+    if split_dim is None:
+        return None
+
+    parts = parts_per_dim[split_dim]
+    n_pieces = min(len(parts), 2 * n_processes)
+    bounds = np.linspace(0, len(parts), n_pieces + 1).round().astype(int)
+
+    step = key[split_dim].indices(shape[split_dim])[2]
+    out_index_prefix = [slice(None) for k in key[:split_dim] if isinstance(k, slice)]
+    pieces = []
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        if lo == hi:
+            continue
+        first_src, first_dst = parts[lo]
+        last_src, last_dst = parts[hi - 1]
+        src = slice(first_src.start, last_src.stop, step)
+        dst = slice(first_dst.start, last_dst.stop)
+        piece_key = key[:split_dim] + (src,) + key[split_dim + 1:]
+        pieces.append((piece_key, tuple(out_index_prefix + [dst])))
+    return pieces
+
+
+def get_output_shape(key, shape):
+    return tuple(len(range(*k.indices(size))) for k, size in zip(key, shape) if isinstance(k, slice))
+
+
+def should_read_in_parallel(var, key):
+    if get_process_count() < 2 or type(var).__module__.split(".")[0] != "netCDF4":
+        return False
+    key = normalize_key(key, len(var.shape))
+    if key is None or not is_compressed(var):
+        return False
+    chunking = var.chunking()
+    if chunking == "contiguous" or chunking is None:
+        return False
+    nbytes = int(np.prod(get_output_shape(key, var.shape), dtype=np.int64)) * get_output_dtype(var).itemsize
+    return nbytes >= get_min_bytes()
+
+
+class DetachedSharedMemory(shared_memory.SharedMemory):
+    # The block is closed when the array which views it is garbage collected (see create_shared_array), not together
+    # with this object, while the array is in use
+    def __del__(self):
+        pass
+
+
+# Array in a new shared memory block, which is closed (the mapping and its file descriptor released) with the array.
+# Views of the array keep it alive. Returns the array and the block.
+def create_shared_array(shape, dtype):
+    shm = DetachedSharedMemory(create=True, size=max(int(np.prod(shape, dtype=np.int64)) * dtype.itemsize, 1))
+    array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    weakref.finalize(array, shm.close)
+    return array, shm
+
+
+def open_shared_memory(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # Python < 3.13, the block is registered again with the (shared) resource tracker, which is harmless
+        return shared_memory.SharedMemory(name=name)
+
+
+def get_worker_variable(file_path, variable_name):
+    from netCDF4 import Dataset
+
+    mtime = os.stat(file_path).st_mtime_ns
+    cached = _worker_files.get(file_path)
+    if cached is None or cached[0] != mtime:
+        if cached is not None:
+            cached[1].close()
+        _worker_files[file_path] = (mtime, Dataset(file_path, "r"))
+
+    ncfile = _worker_files[file_path][1]
+    parts = [p for p in variable_name.split("/") if p]
+    group = ncfile
+    for part in parts[:-1]:
+        group = group.groups[part]
+    return group.variables[parts[-1]]
+
+
+# Runs in a worker process, reads one piece and writes it and its mask into the shared output blocks
+def read_piece(file_path, variable_name, key, shm_name, mask_name, out_shape, dtype_str, dst, fill_value):
+    var = get_worker_variable(file_path, variable_name)
+    data = readplanner.read(var, key)
+
+    shm = open_shared_memory(shm_name)
+    mask_shm = open_shared_memory(mask_name)
+    try:
+        out = np.ndarray(out_shape, dtype=np.dtype(dtype_str), buffer=shm.buf)
+        out[dst] = ma.filled(data, fill_value)
+        mask = np.ndarray(out_shape, dtype=bool, buffer=mask_shm.buf)
+        mask[dst] = ma.getmaskarray(data)
+        del out, mask
+    finally:
+        shm.close()
+        mask_shm.close()
+
+
+# Reads var[key] using the worker processes, returns a masked array like netCDF4 does
+def read(file_path, variable_name, var, key):
+    key = normalize_key(key, len(var.shape))
+    pieces = plan_pieces(key, var.shape, var.chunking(), get_process_count())
+    if not pieces or len(pieces) < 2:
+        return var[key]
+
+    out_shape = get_output_shape(key, var.shape)
+    dtype = get_output_dtype(var)
+    if dtype.kind == "f":
+        fill_value = np.nan
+    else:
+        fill_value = var.get_fill_value()
+        if fill_value is None:
+            fill_value = 0
+
+    # the names of the blocks are not needed after the read, the memory stays mapped as long as the arrays exist
+    out, shm = create_shared_array(out_shape, dtype)
+    try:
+        mask, mask_shm = create_shared_array(out_shape, np.dtype(bool))
+        try:
+            mask[...] = True  # until the cells are written by a piece
+            executor = get_executor()
+            futures = [executor.submit(read_piece, file_path, variable_name, piece_key, shm.name, mask_shm.name, out_shape, dtype.str, dst, fill_value)
+                       for piece_key, dst in pieces]
+            for future in futures:
+                future.result()
+        finally:
+            mask_shm.unlink()
+    finally:
+        shm.unlink()
+
+    return ma.masked_array(out, mask=mask if mask.any() else ma.nomask, copy=False)
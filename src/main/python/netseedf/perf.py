@@ -0,0 +1,196 @@
+import atexit
+import contextlib
+import json
+import os
+import threading
+import time
+from collections import deque
+
+# Lightweight timing of the hot paths. An operation (e.g. one update of the map) consists of timed stages (read,
+# mask, render, ...) and counters (bytes read, cache hits, ...). The last MAX_OPERATIONS operations are kept in
+# memory and shown in the performance panel.
+#
+# NETSEEDF_TRACE      if set, all operations are written to this file as a JSON trace (Chrome trace event format,
+#                     can be opened in chrome://tracing or ui.perfetto.dev) when the application exits
+# NETSEEDF_PERF_LOG   if set, a summary line of every operation is appended to this file
+
+MAX_OPERATIONS = 200
+
+_local = threading.local()
+_lock = threading.Lock()
+_operations = deque(maxlen=MAX_OPERATIONS)
+_trace_operations = []
+_totals = {}
+_listeners = []
+
+
+class Operation:
+    def __init__(self, name, details):
+        self.name = name
+        self.details = details
+        self.wall_start = time.time()
+        self.start = time.perf_counter()
+        self.duration = None
+        self.stages = []  # (stage name, depth, start relative to the operation, duration)
+        self.counters = {}
+        self.thread = threading.current_thread().name
+        self.depth = 0
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "details": self.details,
+            "start": self.wall_start,
+            "duration_s": self.duration,
+            "thread": self.thread,
+            "stages": [{"name": name, "depth": depth, "offset_s": offset, "duration_s": duration}
+                       for name, depth, offset, duration in self.stages],
+            "counters": dict(self.counters),
+        }
+
+    def summary(self):
+        stages = ", ".join("{} {:.1f} ms".format(name, duration * 1000) for name, depth, _, duration in self.stages if depth == 0)
+        counters = ", ".join("{}={}".format(key, value) for key, value in self.counters.items())
+        return "{} {:.1f} ms [{}] {}".format(self.name, self.duration * 1000, stages, counters).rstrip()
+
+
+def tracing_enabled():
+    return bool(os.environ.get("NETSEEDF_TRACE"))
+
+
+def current_operation():
+    stack = getattr(_local, "stack", None)
+    if stack:
+        return stack[-1]
+    return None
+
+
+# Times an operation, stages and counters recorded in the same thread while it runs are attached to it
+@contextlib.contextmanager
+def operation(name, **details):
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+
+    if stack:  # nested operation, record it as a stage of the outer one
+        with span(name):
+            yield stack[-1]
+        return
+
+    op = Operation(name, details)
+    stack.append(op)
+    try:
+        yield op
+    finally:
+        stack.pop()
+        op.duration = time.perf_counter() - op.start
+        finish(op)
+
+
+# Times a stage of the current operation. Without a current operation the stage is recorded as an operation of its own.
+@contextlib.contextmanager
+def span(name):
+    op = current_operation()
+    if op is None:
+        with operation(name):
+            yield
+        return
+
+    depth = op.depth
+    op.depth += 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        op.depth -= 1
+        op.stages.append((name, depth, start - op.start, end - start))
+
+
+# Adds to a counter of the current operation and to the totals since the start of the application
+def count(name, value=1):
+    op = current_operation()
+    if op is not None:
+        op.counters[name] = op.counters.get(name, 0) + value
+    with _lock:
+        _totals[name] = _totals.get(name, 0) + value
+
+
+def finish(op):
+    with _lock:
+        _operations.append(op)
+        if tracing_enabled():
+            _trace_operations.append(op)
+        listeners = list(_listeners)
+
+    log_path = os.environ.get("NETSEEDF_PERF_LOG")
+    if log_path:
+        try:
+            with open(log_path, "a", encoding="utf-8") as f:
+                f.write(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(op.wall_start)) + " " + op.summary() + "\n")
+        except OSError:
+            pass
+
+    for listener in listeners:
+        listener(op)
+
+
+def get_operations():
+    with _lock:
+        return list(_operations)
+
+
+def get_totals():
+    with _lock:
+        return dict(_totals)
+
+
+def clear():
+    with _lock:
+        _operations.clear()
+        _totals.clear()
+
+
+def add_listener(listener):
+    with _lock:
+        _listeners.append(listener)
+
+
+def remove_listener(listener):
+    with _lock:
+        if listener in _listeners:
+            _listeners.remove(listener)
+
+
+# Converts operations to the Chrome trace event format
+def to_trace(operations):
+    events = []
+    pid = os.getpid()
+    for op in operations:
+        op_start_us = op.wall_start * 1e6
+        events.append({"name": op.name, "ph": "X", "ts": op_start_us, "dur": op.duration * 1e6, "pid": pid,
+                       "tid": op.thread, "args": dict(op.details, **op.counters)})
+        for name, depth, offset, duration in op.stages:
+            events.append({"name": name, "ph": "X", "ts": op_start_us + offset * 1e6, "dur": duration * 1e6,
+                           "pid": pid, "tid": op.thread, "args": {"operation": op.name, "depth": depth}})
+    return {"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"totals": get_totals()}}
+
+
+def write_trace(file_path, operations=None):
+    if operations is None:
+        with _lock:
+            operations = list(_trace_operations) if tracing_enabled() else list(_operations)
+    with open(file_path, "w", encoding="utf-8") as f:
+        json.dump(to_trace(operations), f, default=str)
+
+
+def write_trace_at_exit():
+    trace_path = os.environ.get("NETSEEDF_TRACE")
+    if trace_path:
+        try:
+            write_trace(trace_path)
+        except OSError:
+            pass
+
+
+atexit.register(write_trace_at_exit)
@@ -0,0 +1,93 @@
+from pathlib import Path
+
+from PySide6.QtCore import Qt, Signal
+from PySide6.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QTreeWidget, QTreeWidgetItem, QPushButton, QLabel, \
+    QFileDialog
+
+import perf
+
+
+# Window which shows the last operations recorded by the perf module broken down by stage.
+# Toggled with F12 in the main window.
+class PerfWindow(QWidget):
+    operation_finished = Signal(object)
+
+    def __init__(self):
+        super().__init__()
+
+        self.setWindowTitle("Performance - NetSeeDF")
+        self.setMinimumSize(650, 400)
+
+        layout = QVBoxLayout()
+
+        tree = QTreeWidget()
+        tree.setColumnCount(3)
+        tree.setHeaderLabels(["Operation / stage", "Time [ms]", "Details"])
+        tree.setColumnWidth(0, 250)
+        tree.setColumnWidth(1, 90)
+        self.tree = tree
+        layout.addWidget(tree)
+
+        totals_label = QLabel(wordWrap=True)
+        totals_label.setTextInteractionFlags(Qt.TextInteractionFlag.TextSelectableByMouse)
+        self.totals_label = totals_label
+        layout.addWidget(totals_label)
+
+        buttons_widget = QWidget()
+        buttons_layout = QHBoxLayout()
+        buttons_widget.setLayout(buttons_layout)
+        clear_button = QPushButton("Clear")
+        clear_button.clicked.connect(self.clear)
+        save_button = QPushButton("Save JSON trace")
+        save_button.clicked.connect(self.save_trace)
+        buttons_layout.addStretch()
+        buttons_layout.addWidget(clear_button)
+        buttons_layout.addWidget(save_button)
+        layout.addWidget(buttons_widget)
+
+        self.setLayout(layout)
+
+        # operations can finish in other threads, the signal moves them to the GUI thread
+        self.operation_finished.connect(self.add_operation)
+        perf.add_listener(self.operation_finished.emit)
+
+        for op in perf.get_operations():
+            self.add_operation(op)
+
+    def closeEvent(self, event):
+        perf.remove_listener(self.operation_finished.emit)
+        event.accept()
+
+    def add_operation(self, op):
+        details = ", ".join("{}={}".format(key, value) for key, value in list(op.details.items()) + list(op.counters.items()))
+        item = QTreeWidgetItem([op.name, "{:.1f}".format(op.duration * 1000), details])
+
+        # stages are recorded when they end, so nested stages come before their parent, rebuild the hierarchy by depth
+        parents = {0: item}
+        for name, depth, offset, duration in sorted(op.stages, key=lambda stage: (stage[2], stage[1])):
+            parent = parents.get(depth, item)
+            child = QTreeWidgetItem([name, "{:.1f}".format(duration * 1000), "at {:.1f} ms".format(offset * 1000)])
+            parent.addChild(child)
+            parents[depth + 1] = child
+
+        self.tree.insertTopLevelItem(0, item)
+        while self.tree.topLevelItemCount() > perf.MAX_OPERATIONS:
+            self.tree.takeTopLevelItem(self.tree.topLevelItemCount() - 1)
+
+        self.update_totals()
+
+    def update_totals(self):
+        totals = perf.get_totals()
+        text = "Totals: " + ", ".join("{}={}".format(key, value) for key, value in sorted(totals.items()))
+        self.totals_label.setText(text)
+
+    def clear(self):
+        perf.clear()
+        self.tree.clear()
+        self.update_totals()
+
+    def save_trace(self):
+        file_path, _ = QFileDialog.getSaveFileName(self, "Save JSON trace", str(Path.home() / "netseedf-trace.json"),
+                                                   "JSON files (*.json)")
+        if file_path:
+            perf.write_trace(file_path, perf.get_operations())
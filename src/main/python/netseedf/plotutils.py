@@ -1,11 +1,24 @@
+import io
+
 import numpy as np
 from folium import MacroElement
 from jinja2 import Template
 from PySide6.QtCore import QObject, Slot
 from netCDF4 import num2date
+from cartopy import crs as ccrs
+from matplotlib.cm import ScalarMappable, get_cmap
+from matplotlib.colors import Normalize
+from matplotlib import use as mpluse
+from matplotlib import style as mplstyle
+from matplotlib import pyplot as plt
+
+mplstyle.use('fast')
+mpluse("agg")
 
 import utils
-import datautils
+import perf
+import resample
+import seriescache
 
 
 def find_closest_grid_point(lat, lon, x, y):
@@ -13,6 +26,126 @@ def find_closest_grid_point(lat, lon, x, y):
     j = np.abs(y - lat).argmin()
     return i, j
 
+# Renders the overlay image of gridded data in web mercator projection and the colorbar, returns both as png bytes.
+# extent is [xmin, xmax, ymin, ymax] in degrees, colorbar_label can be None. With with_colorbar=False the colorbar
+# is not rendered and returned as empty bytes.
+def render_overlay(image_data, xboundaries, yboundaries, extent, min_value, max_value, scale_min_value, scale_max_value, cmap_name, colorbar_label, with_colorbar=True):
+    image = io.BytesIO()
+
+    with perf.span("plot"):
+        ax = plt.axes(projection=ccrs.epsg(3857))
+
+        source_crs = ccrs.PlateCarree()
+
+        ax.set_extent(extent, crs=source_crs)
+        ax.axis("off")
+
+        cmap = get_cmap(cmap_name)
+        cmap.set_extremes(under='grey', over='red')
+
+        ax.pcolormesh(xboundaries, yboundaries, image_data, cmap=cmap, transform=source_crs,
+                      vmin=scale_min_value, vmax=scale_max_value, shading="flat")
+
+    with perf.span("savefig (rasterise + png)"):  # matplotlib rasterises and encodes the png in one call
+        plt.savefig(image, format="png", bbox_inches="tight", pad_inches=0, dpi=650)
+    perf.count("png_bytes", image.tell())
+
+    plt.close("all")
+    if not with_colorbar:
+        return image.getvalue(), b""
+
+    return image.getvalue(), render_colorbar(min_value, max_value, scale_min_value, scale_max_value, cmap_name, colorbar_label)
+
+
+# Renders the colorbar for the color scale, returns it as png bytes. min_value and max_value of the data decide which
+# ends of the colorbar are extended.
+def render_colorbar(min_value, max_value, scale_min_value, scale_max_value, cmap_name, colorbar_label):
+    colorbar = io.BytesIO()
+
+    with perf.span("colorbar"):
+        norm = Normalize(vmin=scale_min_value, vmax=scale_max_value)
+        cmap = get_cmap(cmap_name)
+        cmap.set_extremes(under='grey', over='red')
+        sm = ScalarMappable(norm=norm, cmap=cmap)
+
+        fig, ax = plt.subplots(figsize=(1.1, 3.5), layout="constrained")
+
+        if scale_min_value > min_value and scale_max_value < max_value:
+            extend = "both"
+        elif scale_min_value > min_value:
+            extend = "min"
+        elif scale_max_value < max_value:
+            extend = "max"
+        else:
+            extend = "neither"
+
+        cbar = fig.colorbar(sm, cax=ax, extend=extend)
+
+        if colorbar_label is not None:
+            cbar.set_label(colorbar_label)
+        fig.savefig(colorbar, format="png", bbox_inches="tight")
+
+        plt.close("all")
+
+    return colorbar.getvalue()
+
+
+# Renders reprojected data as the overlay image (png bytes) using the warp map of its grid (see reproject), without
+# going through a matplotlib figure: the cells are gathered to the pixels and colored directly.
+def render_warped(image_data, warp_map, scale_min_value, scale_max_value, cmap_name):
+    image = io.BytesIO()
+
+    with perf.span("gather"):
+        pixels = warp_map.warp(image_data)
+
+    with perf.span("colorize"):
+        cmap = get_cmap(cmap_name).with_extremes(under='grey', over='red', bad=(0, 0, 0, 0))
+        rgba = cmap(Normalize(vmin=scale_min_value, vmax=scale_max_value)(pixels), bytes=True)
+
+    with perf.span("png"):
+        plt.imsave(image, rgba, format="png")
+    perf.count("png_bytes", image.tell())
+
+    return image.getvalue()
+
+
+# Renders a section (2D data with rows and columns of any two dims) as a heatmap image (png bytes) with one pixel per
+# cell, the first row at the bottom. Colored directly like render_warped, the image is scaled by the window.
+def render_section(section_data, scale_min_value, scale_max_value, cmap_name):
+    image = io.BytesIO()
+
+    with perf.span("colorize"):
+        cmap = get_cmap(cmap_name).with_extremes(under='grey', over='red', bad=(0, 0, 0, 0))
+        rgba = cmap(Normalize(vmin=scale_min_value, vmax=scale_max_value)(section_data[::-1]), bytes=True)
+
+    with perf.span("png"):
+        plt.imsave(image, rgba, format="png")
+    perf.count("png_bytes", image.tell())
+
+    return image.getvalue()
+
+
+# Renders the time series chart of a grid point (or of several series, a column of values each, named by labels),
+# returns it as png bytes. times are datetimes or numbers, masked values are left out of the line.
+def render_timeseries(times, values, title, value_label, width, height, labels=None):
+    chart = io.BytesIO()
+
+    with perf.span("chart"):
+        fig, ax = plt.subplots(figsize=(width / 100, height / 100), dpi=100, layout="constrained")
+        ax.plot(times, values, linewidth=0.8)
+        if labels is not None:
+            ax.legend(labels, fontsize=7)
+        ax.set_title(title, fontsize=9)
+        if value_label is not None:
+            ax.set_ylabel(value_label, fontsize=8)
+        ax.tick_params(labelsize=8)
+        ax.grid(alpha=0.3)
+        fig.savefig(chart, format="png")
+        plt.close(fig)
+
+    return chart.getvalue()
+
+
 class PlotBackend(QObject):
     def __init__(self, var_props, xdata, ydata, variable_units, tdata, tunits, calendar, show_map_popup, window_instance):
         super().__init__()
@@ -27,18 +160,15 @@ class PlotBackend(QObject):
         self.window_instance = window_instance
         self.last_gridi = 0
         self.last_gridj = 0
-        self.data = None
-
-    def set_data(self, data):
-        self.data = data
 
     @Slot(float, float)
     def on_map_click(self, lat, lon):
-        # check if coordinates are inside the bounds of the data, if outside do nothing
-        if (self.xdata.min() < lon < self.xdata.max()) and (self.ydata.min() < lat < self.ydata.max()):
-            gridi, gridj = find_closest_grid_point(lat, lon, self.xdata, self.ydata)
-            gridlat, gridlon, gridval = self.ydata[gridj], self.xdata[gridi], self.data[gridj, gridi]
+        grid_point = self.window_instance.find_grid_point(lat, lon)
+        if grid_point is not None:  # if outside of the data do nothing
+            gridi, gridj, gridlat, gridlon = grid_point
+            gridval = self.window_instance.get_point_value(gridi, gridj)
             self.last_gridi, self.last_gridj = gridi, gridj
+            self.window_instance.on_point_selected(gridi, gridj, gridlat, gridlon)
 
             is_celsius = False
             if self.variable_units is not None:
@@ -60,6 +190,22 @@ class PlotBackend(QObject):
                     value_string += " " + self.variable_units
             self.show_map_popup(gridlat, gridlon, value_string)  # show popup with lat, lon and value of the closest grid point
 
+    # Called while the mouse moves over the map, if the time series chart follows the mouse
+    @Slot(float, float)
+    def on_map_hover(self, lat, lon):
+        self.window_instance.on_map_hover(lat, lon)
+
+    # Called (debounced in the window) when the map has been panned or zoomed, with the visible bounds in degrees and
+    # the size of the map in css pixels
+    @Slot(float, float, float, float, int, int)
+    def on_view_changed(self, south, west, north, east, width, height):
+        self.window_instance.on_view_changed(south, west, north, east, width, height)
+
+    # shift + drag on the map selects a region
+    @Slot(float, float, float, float)
+    def on_region_drawn(self, south, west, north, east):
+        self.window_instance.on_region_drawn(south, west, north, east)
+
     @Slot()
     def on_export_requested(self):
         slice_indices = []
@@ -67,25 +213,38 @@ class PlotBackend(QObject):
             slice_index = self.window_instance.slice_spinners[i].value() - 1  # get the index of the slice from the spinner
             slice_indices.append(slice_index)
 
-        timeseries = datautils.slice_timeseries(self.var_props, slice_indices, self.last_gridi, self.last_gridj, self.var_props["t_dim"]) # we assume that data should be sliced along the first identified time dimension
+        gridi, gridj = self.last_gridi, self.last_gridj
+        convert_temperature = self.variable_units == "K" and self.window_instance.temp_convert_checkbox.isChecked()
+        tdata, tunits, calendar = self.tdata, self.tunits, self.calendar
+        resampling = self.window_instance.get_series_resampling()
 
-        if self.variable_units is not None:
-            if self.variable_units == "K":
-                if self.window_instance.temp_convert_checkbox.isChecked():
-                    try:
-                        timeseries = timeseries - 273.15
-                    except Exception:
-                        pass
+        # runs as a background job, the state of the window is read above in the GUI thread
+        def read_timeseries(job):
+            job.set_progress(0, "reading")
+            timeseries = seriescache.get_timeseries(self.var_props, slice_indices, gridi, gridj, self.var_props["t_dim"], job) # we assume that data should be sliced along the first identified time dimension
 
-        if self.tunits is not None and self.calendar is not None:
-            print(self.tdata, self.tunits, self.calendar)
-            datetimes = num2date(self.tdata, self.tunits, self.calendar)
-        else:
-            datetimes = self.tdata
+            if convert_temperature:
+                try:
+                    timeseries = timeseries - 273.15
+                except Exception:
+                    pass
 
-        suggested_filename = self.var_props["variable_name"] + "_" + self.var_props["t_dim"]
+            if resampling is not None:  # the series of the groups of the resampling period
+                bounds, labels, statistic = resampling
+                aggregated = resample.aggregate_series(timeseries, bounds, statistic)
+                return np.array([labels[:len(aggregated)], aggregated.filled(np.nan)], dtype=object).T
 
-        utils.show_dialog_and_save(self.window_instance, np.array([datetimes, timeseries]).T, suggested_filename, False)
+            if tunits is not None and calendar is not None:
+                datetimes = num2date(tdata, tunits, calendar)
+            else:
+                datetimes = tdata
+            return np.array([datetimes, timeseries]).T
+
+        suggested_filename = self.var_props["variable_name"].replace("/", "_") + "_" + self.var_props["t_dim"]
+        if resampling is not None:
+            suggested_filename += "_" + resample.describe(*self.window_instance.resampling).replace(" ", "_")
+
+        utils.show_dialog_and_save(self.window_instance, read_timeseries, suggested_filename, False, self.var_props["file_path"])
 
         self.window_instance.close_map_popups()
 
@@ -103,6 +262,66 @@ class WebChannelJS(MacroElement):
             {{this._parent.get_name()}}.on('click', function(e) {
                 window.backend.on_map_click(e.latlng.lat, e.latlng.lng);
             });
+            {{this._parent.get_name()}}.on('mousemove', function(e) {
+                if (window.backend && window.follow_hover) {
+                    window.backend.on_map_hover(e.latlng.lat, e.latlng.lng);
+                }
+            });
+            {{this._parent.get_name()}}.on('moveend', function(e) {
+                if (window.backend) {
+                    var map = {{this._parent.get_name()}};
+                    var bounds = map.getBounds();
+                    var size = map.getSize();
+                    window.backend.on_view_changed(bounds.getSouth(), bounds.getWest(), bounds.getNorth(), bounds.getEast(), size.x, size.y);
+                }
+            });
+            {{this._parent.get_name()}}.on('boxzoomend', function(e) {
+                if (window.backend) {
+                    var bounds = e.boxZoomBounds;
+                    window.backend.on_region_drawn(bounds.getSouth(), bounds.getWest(), bounds.getNorth(), bounds.getEast());
+                }
+            });
+            {% endmacro %}
+        """)
+
+    def __init__(self):
+        super().__init__()
+
+
+# Functions of the map page which the windows call with their overlay, see mappage. show_overlay adds the overlay of
+# the window (or replaces its image and bounds) and fits the map to it once the view has a size, pooled views are
+# loaded before they are shown. The overview overlay is shown again while the map moves, it is hidden below a detail
+# overlay until the detail is updated.
+class MapPageJS(MacroElement):
+    _template = Template("""
+            {% macro script(this, kwargs) %}
+            window.overlay = null;
+            window.overlay_opacity = 1;
+            window.show_overlay = function(url, south, west, north, east, opacity) {
+                var map = {{this._parent.get_name()}};
+                var bounds = L.latLngBounds([[south, west], [north, east]]);
+                window.overlay_opacity = opacity;
+                if (window.overlay) {
+                    window.overlay.setUrl(url);
+                    window.overlay.setBounds(bounds);
+                } else {
+                    window.overlay = L.imageOverlay(url, bounds, {opacity: opacity, interactive: false}).addTo(map);
+                }
+                var fit = function(attempts) {
+                    map.invalidateSize();
+                    if (map.getSize().x > 0 || attempts <= 0) {
+                        map.fitBounds(bounds);
+                    } else {
+                        setTimeout(function() { fit(attempts - 1); }, 50);
+                    }
+                };
+                fit(100);
+            };
+            {{this._parent.get_name()}}.on('movestart', function(e) {
+                if (window.detail_overlay && window.overlay) {
+                    window.overlay.setOpacity(window.overlay_opacity);
+                }
+            });
             {% endmacro %}
         """)
 
@@ -1,39 +1,43 @@
 import base64
-import io
+import time
 
 import numpy as np
-from PySide6.QtCore import Qt
+import numpy.ma as ma
+from PySide6.QtCore import Qt, QTimer
 from PySide6.QtGui import QPixmap, QImage
-from PySide6.QtWebChannel import QWebChannel
-from PySide6.QtWebEngineWidgets import QWebEngineView
 from PySide6.QtWidgets import QVBoxLayout, QWidget, QHBoxLayout, QLabel, QSpinBox, QSizePolicy, QCheckBox, QMessageBox, \
-    QDoubleSpinBox
+    QDoubleSpinBox, QPushButton, QComboBox
 from netCDF4 import num2date
-from cartopy import crs as ccrs
-from matplotlib.cm import ScalarMappable, get_cmap
-from matplotlib.colors import Normalize
-from matplotlib import use as mpluse
-from matplotlib import style as mplstyle
-from matplotlib import pyplot as plt
 
-mplstyle.use('fast')
-mpluse("agg")
-
-from plotutils import WebChannelJS, PlotBackend
+from plotutils import PlotBackend, render_overlay, render_warped, render_colorbar, render_timeseries, \
+    find_closest_grid_point
+from datawindow import DataWindow
 import datautils
+import datastore
+import jobs
 import utils
-import offline
+import mappage
+import overlaycache
+import perf
+import reproject
+import resample
+import seriescache
+
+COLORMAP = "inferno"
+OVERLAY_OPACITY = 0.6
+DETAIL_DELAY_MS = 250  # wait for the map to stop moving before reading a detail overlay
+SERIES_DELAY_MS = 100  # update the time series chart at most this often while following the mouse
+SERIES_CHART_HEIGHT = 220
 
 
 class PlotWindow(QWidget):
     def __init__(self, appcontext, var_props):
         super().__init__()
 
-        offline.set_appcontext(appcontext)
-        offline.setup_folium()
-        import folium
-
-        slicedata, slicecalendar, slicetunits, timesliceindex, variable_units, variable_calendar, variable_description, xboundaries, yboundaries, initial_plotdata, xdata, ydata, xdataunit, ydataunit = datautils.get_initial_data(var_props)
+        self.var_props = var_props
+        self.slice_spinners = []  # on_file_grown can be called while the initial data is read
+        datastore.subscribe(var_props, self)  # shares data with the other windows of the variable
+        slicedata, slicecalendar, slicetunits, timesliceindex, variable_units, variable_calendar, variable_description, xboundaries, yboundaries, _, xdata, ydata, xdataunit, ydataunit = datastore.get_initial_data(var_props, read_slice=False)
 
         self.state = "init"
         self.autoscale = True
@@ -41,6 +45,41 @@ class PlotWindow(QWidget):
         self.variable_units = variable_units
         self.xboundaries = xboundaries
         self.yboundaries = yboundaries
+        self.xdata = np.asarray(xdata) if xdata is not None else None
+        self.ydata = np.asarray(ydata) if ydata is not None else None
+
+        # a region limits the window to a part of the grid (see datautils.region_index), xdata, ydata and the
+        # boundaries are those of the region, the coordinates of the whole grid are kept to select another one
+        self.full_xdata, self.full_ydata = self.xdata, self.ydata
+        self.full_xboundaries, self.full_yboundaries = xboundaries, yboundaries
+
+        # grids which are not regular in longitude and latitude are drawn through a precomputed warp map
+        self.warp_map = None
+        if reproject.needs_reprojection(var_props):
+            self.warp_map = reproject.get_warp_map(var_props)
+
+        # level of detail: the whole grid is shown as an overview with about one cell per screen pixel, when zooming
+        # in a detail overlay of the visible part is read at a higher resolution
+        self.overview_stride = self.get_overview_stride()
+        self.last_view = None
+        self.detail_state = None
+        self.detail_timer = QTimer(self)
+        self.detail_timer.setSingleShot(True)
+        self.detail_timer.setInterval(DETAIL_DELAY_MS)
+        self.detail_timer.timeout.connect(self.update_detail)
+
+        # time series chart of the clicked (or hovered) grid point, along the time dim if it can be sliced
+        self.series_dim = var_props["t_dim"] if var_props["t_dim"] in var_props["sliceable_dims"] else None
+        self.series_point = None  # (x index, y index, latitude, longitude)
+        self.slicecalendar = slicecalendar
+        self.slicetunits = slicetunits
+        self.timesliceindex = timesliceindex
+        self.series_times = self.get_series_times(slicedata)
+        self.series_timer = QTimer(self)
+        self.series_timer.setSingleShot(True)
+        self.series_timer.setInterval(SERIES_DELAY_MS)
+        self.series_timer.timeout.connect(self.update_series_chart)
+        self.series_job = None  # job reading the time series of the chart, while it runs
 
         self.setWindowTitle(var_props["file_path"] + " - NetSeeDF")
         self.setMinimumSize(650, 600)
@@ -76,6 +115,7 @@ class PlotWindow(QWidget):
         self.slice_spinners = []
         self.slice_date_labels = []
         self.slice_dates_list = []
+        self.slice_size_labels = []
 
         for i in range(len(var_props["sliceable_dims"])):
             slice_dim = var_props["sliceable_dims"][i]
@@ -88,29 +128,145 @@ class PlotWindow(QWidget):
             slice_spinner.setMinimum(1)
             slice_spinner.setMaximum(var_props["sizes"][slice_dim])  # set max index to size of the axis corresponding to the slicing variable
             slice_spinner.setValue(1)
-            slice_spinner.valueChanged.connect(self.update_map)
+            slice_spinner.valueChanged.connect(self.on_slice_changed)
             slice_selector_layout.addWidget(slice_spinner)
-            slice_selector_layout.addWidget(QLabel(" of " + str(var_props["sizes"][slice_dim])))
+            slice_size_label = QLabel(" of " + str(var_props["sizes"][slice_dim]))
+            slice_selector_layout.addWidget(slice_size_label)
+            self.slice_size_labels.append(slice_size_label)
             self.slice_spinners.append(slice_spinner)
 
-            try:
-                slice_dates = num2date(slicedata[i], slicetunits[i], slicecalendar[i])
-                self.slice_dates_list.append(slice_dates)
+            slice_dates = datastore.get_slice_dates(var_props, i, slicedata, slicetunits, slicecalendar)
+            self.slice_dates_list.append(slice_dates)
+            if slice_dates is not None:
                 slice_date_label = QLabel(" =  " + str(slice_dates[0]))
                 self.slice_date_labels.append(slice_date_label)
                 slice_selector_layout.addWidget(self.slice_date_labels[i])
-            except Exception:
-                self.slice_dates_list.append(None)
+            else:
                 self.slice_date_labels.append(None)
 
             layout.addWidget(slice_selector_widget)
 
-        # folium map
-        self.map = folium.Map(location=[0, 0], zoom_start=1)
-        self.map._name = "folium"
-        self.map._id = "1"
-
-        self.view = QWebEngineView()
+        # the time dim can be resampled to calendar periods (see resample), the spinner then steps through the groups
+        self.t_index = None
+        self.resampling = None  # (period, statistic)
+        self.groups = None  # bounds and labels of the groups of the time steps, while resampling
+        self.waiting_for_resample = False
+        if var_props["t_dim"] in var_props["sliceable_dims"]:
+            self.t_index = var_props["sliceable_dims"].index(var_props["t_dim"])
+        if self.t_index is not None and self.slice_dates_list[self.t_index] is not None:
+            resample_widget = QWidget()
+            resample_layout = QHBoxLayout()
+            resample_layout.setAlignment(Qt.AlignmentFlag.AlignLeft)
+            resample_widget.setLayout(resample_layout)
+            resample_layout.addWidget(QLabel("resample " + var_props["t_dim"] + ": "))
+            self.period_combo = QComboBox()
+            self.period_combo.addItem("no", None)
+            for period in resample.PERIODS:
+                self.period_combo.addItem(resample.PERIOD_NAMES[period], period)
+            self.period_combo.currentIndexChanged.connect(self.on_resampling_changed)
+            resample_layout.addWidget(self.period_combo)
+            self.statistic_combo = QComboBox()
+            self.statistic_combo.addItems(resample.STATISTICS)
+            self.statistic_combo.setEnabled(False)
+            self.statistic_combo.currentIndexChanged.connect(self.on_resampling_changed)
+            resample_layout.addWidget(self.statistic_combo)
+            layout.addWidget(resample_widget)
+
+        self.link_checkbox = None
+        if self.slice_spinners:
+            link_widget = QWidget()
+            link_layout = QHBoxLayout()
+            link_layout.setAlignment(Qt.AlignmentFlag.AlignLeft)
+            link_widget.setLayout(link_layout)
+            self.link_checkbox = QCheckBox()
+            link_layout.addWidget(self.link_checkbox)
+            link_layout.addWidget(QLabel("link slice with other windows of this variable"))
+            layout.addWidget(link_widget)
+
+            # follow mode for files which are still being written (see datastore.refresh)
+            follow_widget = QWidget()
+            follow_layout = QHBoxLayout()
+            follow_layout.setAlignment(Qt.AlignmentFlag.AlignLeft)
+            follow_widget.setLayout(follow_layout)
+            self.follow_file_checkbox = QCheckBox()
+            self.follow_file_checkbox.checkStateChanged.connect(self.on_follow_file_toggled)
+            follow_layout.addWidget(self.follow_file_checkbox)
+            follow_layout.addWidget(QLabel("follow file as it grows"))
+            self.newest_checkbox = QCheckBox()
+            self.newest_checkbox.setEnabled(False)
+            follow_layout.addWidget(self.newest_checkbox)
+            follow_layout.addWidget(QLabel("show newest step"))
+            layout.addWidget(follow_widget)
+        self.follow_file_timer = QTimer(self)
+        self.follow_file_timer.setInterval(datastore.FOLLOW_INTERVAL_MS)
+        self.follow_file_timer.timeout.connect(lambda: datastore.refresh(self.var_props))
+
+        self.lod_mean_checkbox = None
+        self.region_spinners = None
+        if self.warp_map is None:
+            # the overview option is only shown when the grid (or region) is larger than the screen
+            lod_widget = QWidget()
+            lod_layout = QHBoxLayout()
+            lod_layout.setAlignment(Qt.AlignmentFlag.AlignLeft)
+            lod_widget.setLayout(lod_layout)
+            lod_mean_checkbox = QCheckBox()
+            lod_mean_checkbox.checkStateChanged.connect(self.update_map)
+            self.lod_mean_checkbox = lod_mean_checkbox
+            lod_layout.addWidget(lod_mean_checkbox)
+            self.lod_label = QLabel()
+            lod_layout.addWidget(self.lod_label)
+            self.lod_widget = lod_widget
+            self.update_lod_widget()
+            layout.addWidget(lod_widget)
+
+            # region selection, typed in as bounds or drawn on the map with shift + drag
+            region_widget = QWidget()
+            region_layout = QHBoxLayout()
+            region_layout.setAlignment(Qt.AlignmentFlag.AlignLeft)
+            region_widget.setLayout(region_layout)
+            region_layout.addWidget(QLabel("Region: "))
+            self.region_spinners = []
+            for name, limit in (("S", 90), ("N", 90), ("W", 360), ("E", 360)):
+                region_spinner = QDoubleSpinBox()
+                region_spinner.setRange(-limit, limit)
+                region_spinner.setDecimals(3)
+                region_spinner.setFixedWidth(90)
+                region_layout.addWidget(QLabel(name))
+                region_layout.addWidget(region_spinner)
+                self.region_spinners.append(region_spinner)
+            self.set_region_spinners(*self.get_grid_bounds())
+            region_apply_button = QPushButton("Apply")
+            region_apply_button.clicked.connect(self.on_region_apply)
+            region_layout.addWidget(region_apply_button)
+            region_reset_button = QPushButton("Whole grid")
+            region_reset_button.clicked.connect(self.on_region_reset)
+            region_layout.addWidget(region_reset_button)
+            region_table_button = QPushButton("Show table")
+            region_table_button.clicked.connect(self.show_region_table)
+            region_layout.addWidget(region_table_button)
+            region_layout.addWidget(QLabel("(or shift + drag on the map)"))
+            layout.addWidget(region_widget)
+
+        self.series_checkbox = None
+        if self.series_dim is not None:
+            series_widget = QWidget()
+            series_layout = QHBoxLayout()
+            series_layout.setAlignment(Qt.AlignmentFlag.AlignLeft)
+            series_widget.setLayout(series_layout)
+            self.series_checkbox = QCheckBox()
+            self.series_checkbox.checkStateChanged.connect(self.on_series_toggled)
+            series_layout.addWidget(self.series_checkbox)
+            series_layout.addWidget(QLabel("show " + self.series_dim + " series of the clicked point"))
+            self.follow_checkbox = QCheckBox()
+            self.follow_checkbox.setEnabled(False)
+            self.follow_checkbox.checkStateChanged.connect(self.on_follow_toggled)
+            series_layout.addWidget(self.follow_checkbox)
+            series_layout.addWidget(QLabel("follow the mouse"))
+            layout.addWidget(series_widget)
+
+        # map page, from the pool of pre-loaded views (see mappage)
+        self.map_view = mappage.take_view(appcontext)
+        self.view = self.map_view.view
         self.view.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Expanding)
         mapwidget = QWidget()
         maplayout = QHBoxLayout()
@@ -141,41 +297,25 @@ class PlotWindow(QWidget):
         autoscale_layout.setAlignment(Qt.AlignmentFlag.AlignLeft)
         autoscale_widget.setLayout(autoscale_layout)
 
-        # setup channel for communication between map js and python
-        self.channel = QWebChannel()
-        print(slicedata[timesliceindex])
-        print(timesliceindex)
-        print(slicetunits)
+        # the map js calls the backend through the bridge of the page
         self.backend = PlotBackend(var_props, xdata, ydata, variable_units, slicedata[timesliceindex], slicetunits[timesliceindex], slicecalendar[timesliceindex], self.show_map_popup, self)
-        self.backend.set_data(initial_plotdata)
-        self.channel.registerObject('backend', self.backend)
-        self.view.page().setWebChannel(self.channel)
+        self.map_view.bridge.backend = self.backend
 
         # extent of map
-        xmin, ymin, xmax, ymax = np.min(xboundaries), np.min(yboundaries), np.max(xboundaries), np.max(yboundaries)
-        ymin = max(ymin, -85)
-        ymax = min(ymax, 85)
-        self.xmin, self.xmax, self.ymin, self.ymax = xmin, xmax, ymin, ymax
-
-        image, colorbar = self.getb64image(initial_plotdata)
-
-        print(initial_plotdata)
-
-        # map raster layer
-        folium.raster_layers.ImageOverlay(
-            image="data:image/png;base64," + image,
-            bounds=[[ymin, xmin], [ymax, xmax]],
-            opacity=0.6
-        ).add_to(self.map)
-
-        folium.FitOverlays().add_to(self.map)  # fit the view to the overlay size
+        self.update_extent()
+        xmin, xmax, ymin, ymax = self.xmin, self.xmax, self.ymin, self.ymax
 
-        scriptelement = folium.Element('<script>' + appcontext.webchanneljs + '</script>')
-        self.map.get_root().html.add_child(scriptelement)
-        self.map.add_child(WebChannelJS())
+        initial_slice_indices = [0 for _ in range(len(var_props["sliceable_dims"]))]
+        overview = self.get_cached_overview(initial_slice_indices)
+        if overview is None:
+            overview_data, overview_xboundaries, overview_yboundaries = self.read_overview(initial_slice_indices)
+            overview = self.getb64image(overview_data, initial_slice_indices, overview_xboundaries, overview_yboundaries)
+        image, colorbar = overview
 
-        html_data = self.map.get_root().render()
-        self.view.setHtml(html_data)  # load the html
+        # map raster layer, the map is fitted to it
+        self.overlay_name = "window.overlay"
+        self.run_js('show_overlay("data:image/png;base64,' + image + '", ' + ", ".join(str(v) for v in (ymin, xmin, ymax, xmax)) +
+                    ", " + str(OVERLAY_OPACITY) + ");")
 
         qimage = QImage.fromData(colorbar)
         pixmap = QPixmap.fromImage(qimage)
@@ -197,69 +337,576 @@ class PlotWindow(QWidget):
         maplayout.addWidget(cbar_container)
         layout.addWidget(mapwidget)
 
+        self.series_chart = QLabel("Click a grid point on the map to show its time series.")
+        self.series_chart.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        self.series_chart.setFixedHeight(SERIES_CHART_HEIGHT)
+        self.series_chart.setVisible(False)
+        layout.addWidget(self.series_chart)
+
         self.setLayout(layout)
 
+    # Stride of the overview, at which the grid (or region) has about one cell per screen pixel
+    def get_overview_stride(self):
+        if self.warp_map is not None:
+            return 1
+        screen = self.screen()
+        dpr = screen.devicePixelRatio()
+        screen_size = screen.availableGeometry().size()
+        return datautils.get_lod_stride(len(self.xdata), len(self.ydata), screen_size.width() * dpr, screen_size.height() * dpr)
+
+    def update_lod_widget(self):
+        self.lod_label.setText("overview: average blocks of {0}×{0} cells instead of showing one cell per block".format(self.overview_stride))
+        self.lod_widget.setVisible(self.overview_stride > 1)
+
+    # Extent of the overlay, limited to the latitudes web mercator can show
+    def update_extent(self):
+        if self.warp_map is not None:
+            ymin, xmin, ymax, xmax = self.warp_map.bounds
+        else:
+            xmin, ymin, xmax, ymax = np.min(self.xboundaries), np.min(self.yboundaries), np.max(self.xboundaries), np.max(self.yboundaries)
+        self.xmin, self.xmax, self.ymin, self.ymax = xmin, xmax, max(ymin, -85), min(ymax, 85)
+
+    # Bounds of the whole grid as (south, west, north, east)
+    def get_grid_bounds(self):
+        return (float(np.min(self.full_yboundaries)), float(np.min(self.full_xboundaries)),
+                float(np.max(self.full_yboundaries)), float(np.max(self.full_xboundaries)))
+
+    def set_region_spinners(self, south, west, north, east):
+        for spinner, value in zip(self.region_spinners, (south, north, west, east)):
+            spinner.setValue(value)
+
+    def on_region_apply(self):
+        south, north, west, east = [spinner.value() for spinner in self.region_spinners]
+        self.set_region(south, west, north, east)
+
+    def on_region_drawn(self, south, west, north, east):
+        if self.region_spinners is None:
+            return
+        self.set_region_spinners(south, west, north, east)
+        self.set_region(south, west, north, east)
+
+    def on_region_reset(self):
+        self.var_props["region"] = None
+        self.var_props["region_bounds"] = None
+        self.set_region_spinners(*self.get_grid_bounds())
+        self.load_region()
+
+    # Limits the window to the cells inside the bounds, all further reads only read this part of the grid
+    def set_region(self, south, west, north, east):
+        try:
+            region = datautils.get_region(self.full_xdata, self.full_ydata, south, west, north, east)
+        except ValueError as e:
+            dlg = QMessageBox(self)
+            dlg.setWindowTitle("NetSeeDF message")
+            dlg.setText(str(e))
+            dlg.exec()
+            return
+
+        self.var_props["region"] = region
+        self.var_props["region_bounds"] = (south, west, north, east)
+        self.load_region()
+
+    # Shows the current region (or the whole grid) after it has been changed
+    def load_region(self):
+        self.xdata, self.ydata, self.xboundaries, self.yboundaries = datautils.crop_to_region(
+            self.var_props, self.full_xdata, self.full_ydata, self.full_xboundaries, self.full_yboundaries)
+        self.overview_stride = self.get_overview_stride()
+        self.update_lod_widget()
+        self.update_extent()
+        self.series_point = None  # indices of points are relative to the region
+
+        self.remove_detail_overlay()
+        bounds = "[[" + str(self.ymin) + "," + str(self.xmin) + "],[" + str(self.ymax) + "," + str(self.xmax) + "]]"
+        self.run_js(self.overlay_name + ".setBounds(L.latLngBounds(" + bounds + "));" +
+                    "folium_1.fitBounds(" + bounds + ");")
+        self.update_map()
+
+    # Opens a table of the current region
+    def show_region_table(self):
+        utils.keep_window(DataWindow(dict(self.var_props)))
+
+    # Runs js code in the map page, once it has loaded
+    def run_js(self, code):
+        self.map_view.run_js(code)
+
     def show_map_popup(self, lat, lon, value):
         js_code = """L.popup()
                     .setLatLng(L.latLng({latval},{lonval}))
                     .setContent('{latval}°, {lonval}°<br>{pointval}<br><button onclick="window.backend.on_export_requested();">Export data for this point</button>')
                     .openOn(folium_1);""".format(latval=lat, lonval=lon, pointval=value)
-        self.view.page().runJavaScript(js_code)
+        self.run_js(js_code)
 
     def close_map_popups(self):
-        self.view.page().runJavaScript("folium_1.closePopup();")
-
-    def update_map(self):
-        slice_indices = []
-        for i in range(len(self.var_props["sliceable_dims"])):
-            slice_index = self.slice_spinners[i].value() - 1 # get the index of the slice from the spinner
-            slice_indices.append(slice_index)
+        self.run_js("folium_1.closePopup();")
+
+    def get_slice_indices(self):
+        return [self.slice_spinners[i].value() - 1 for i in range(len(self.var_props["sliceable_dims"]))]  # get the index of the slice from the spinner
+
+    def get_lod_method(self):
+        if self.lod_mean_checkbox is not None and self.lod_mean_checkbox.isChecked():
+            return "mean"
+        return "stride"
+
+    # Reads a window of the slice at the given stride, returns the data and its cell boundaries. The data is None while
+    # an aggregated slice is being computed (see read_slice).
+    def read_lod(self, slice_indices, x_range, y_range, stride):
+        whole_grid = stride == 1 and x_range == (0, len(self.xdata)) and y_range == (0, len(self.ydata))
+        if whole_grid or self.groups is not None:
+            sliced_data = self.read_slice(slice_indices)
+            if whole_grid or sliced_data is None:
+                return sliced_data, self.xboundaries, self.yboundaries
+            lod_data, xcenters, ycenters = datautils.get_lod_of_slice(sliced_data, self.xdata, self.ydata, x_range, y_range, stride, self.get_lod_method())
+        else:
+            lod_data, xcenters, ycenters = datautils.get_lod_data(self.var_props, slice_indices, self.xdata, self.ydata, x_range, y_range, stride, self.get_lod_method())
+        xboundaries, yboundaries = utils.grid_boundaries_from_centers(xcenters, ycenters)
+        return lod_data, xboundaries, yboundaries
+
+    def read_overview(self, slice_indices):
+        if self.warp_map is not None:
+            return self.read_slice(slice_indices), None, None
+        return self.read_lod(slice_indices, (0, len(self.xdata)), (0, len(self.ydata)), self.overview_stride)
+
+    # The whole slice, aggregated over the group of time steps while resampling. Returns None while the aggregated
+    # slice is being computed, the map is updated when it is done (see on_resampled_data).
+    def read_slice(self, slice_indices):
+        if self.groups is None:
+            return datastore.get_sliced_data(self.var_props, slice_indices)
+        group = slice_indices[self.t_index]
+        label = resample.describe(*self.resampling).capitalize() + " " + self.groups[1][group]
+        sliced_data = datastore.get_resampled_data(self.var_props, slice_indices, self.groups[0][group:group + 2], self.resampling[1], label)
+        self.waiting_for_resample = sliced_data is None
+        return sliced_data
+
+    # Value of the shown slice at a grid point, read from the file as the map may show a reduced resolution overview
+    def get_point_value(self, gridi, gridj):
+        if self.groups is not None:
+            sliced_data = self.read_slice(self.get_slice_indices())
+            return sliced_data[gridj, gridi] if sliced_data is not None else ma.masked
+        return datautils.get_point_value(self.var_props, self.get_slice_indices(), gridi, gridj)
+
+    # Returns the data converted to the selected units, or None if the conversion failed
+    def convert_units(self, data):
+        if self.is_temp_converted():
+            try:
+                with perf.span("unit conversion"):
+                    return data - 273.15
+            except Exception:
+                self.temp_convert_checkbox.setChecked(False)
+                dlg = QMessageBox(self)
+                dlg.setWindowTitle("NetSeeDF message")
+                dlg.setText("There was an error while converting to degrees Celsius!")
+                dlg.exec()
+                return None
+        return data
+
+    # Grid point closest to a point on the map as (x index, y index, latitude, longitude), None if outside of the grid
+    def find_grid_point(self, lat, lon):
+        if self.warp_map is not None:
+            cell = self.warp_map.locate(lat, lon)
+            if cell is None:
+                return None
+            gridj, gridi = cell
+            gridlat, gridlon = self.warp_map.get_cell_latlon(gridj, gridi)
+            return gridi, gridj, gridlat, gridlon
+
+        # check if coordinates are inside the bounds of the data
+        if (self.xdata.min() < lon < self.xdata.max()) and (self.ydata.min() < lat < self.ydata.max()):
+            gridi, gridj = find_closest_grid_point(lat, lon, self.xdata, self.ydata)
+            return gridi, gridj, self.ydata[gridj], self.xdata[gridi]
+        return None
+
+    # Slice indices with the first time step of the shown group while resampling, as shared with linked windows
+    def get_linked_indices(self):
+        slice_indices = self.get_slice_indices()
+        if self.groups is not None:
+            slice_indices[self.t_index] = int(self.groups[0][slice_indices[self.t_index]])
+        return slice_indices
+
+    def on_slice_changed(self):
+        self.update_map()
+        if self.is_slice_linked():
+            datastore.publish_slice(self.var_props, self.get_linked_indices(), self)
+
+    def is_slice_linked(self):
+        return self.link_checkbox is not None and self.link_checkbox.isChecked()
+
+    # Shows the slice of another linked window of the variable
+    def on_linked_slice(self, slice_indices):
+        if self.groups is not None:
+            slice_indices[self.t_index] = resample.find_group(self.groups[0], slice_indices[self.t_index])
+        if slice_indices == self.get_slice_indices():
+            return
+        for spinner, slice_index in zip(self.slice_spinners, slice_indices):
+            spinner.blockSignals(True)
+            spinner.setValue(slice_index + 1)
+            spinner.blockSignals(False)
+        self.update_map()
 
-            if self.slice_dates_list[i] is not None:
-                self.slice_date_labels[i].setText(" =  " + str(self.slice_dates_list[i][slice_indices[i]]))
+    def on_resampling_changed(self):
+        period = self.period_combo.currentData()
+        t_step = self.get_linked_indices()[self.t_index]
+        self.resampling = (period, self.statistic_combo.currentText()) if period is not None else None
+        self.statistic_combo.setEnabled(period is not None)
+        self.update_t_range()
+        spinner = self.slice_spinners[self.t_index]
+        spinner.blockSignals(True)
+        spinner.setValue((resample.find_group(self.groups[0], t_step) if self.groups is not None else t_step) + 1)
+        spinner.blockSignals(False)
+        self.update_map()
 
-        sliced_data = datautils.get_sliced_data(self.var_props, slice_indices)
+    # Range of the time spinner, the time steps or the groups of the resampling period
+    def update_t_range(self):
+        if self.resampling is None:
+            self.groups = None
+            size = self.var_props["sizes"][self.var_props["t_dim"]]
+        else:
+            slicedata = datastore.get_initial_data(self.var_props, read_slice=False)[0]
+            self.groups = datastore.get_groups(self.var_props, self.resampling[0], self.t_index, slicedata, self.slicetunits, self.slicecalendar)
+            size = len(self.groups[1])
+        spinner = self.slice_spinners[self.t_index]
+        spinner.blockSignals(True)
+        spinner.setMaximum(size)
+        spinner.blockSignals(False)
+        self.slice_size_labels[self.t_index].setText(" of " + str(size))
+
+    # Called by the datastore when an aggregated slice has been computed
+    def on_resampled_data(self, state, error):
+        if not self.waiting_for_resample:
+            return
+        self.waiting_for_resample = False
+        if state == jobs.CANCELLED:
+            label = self.slice_date_labels[self.t_index]
+            label.setText(label.text().replace(" (computing...)", " (cancelled)"))
+            return
+        if error:
+            dlg = QMessageBox(self)
+            dlg.setWindowTitle("NetSeeDF message")
+            dlg.setText("There was an error while resampling the data!\n" + error)
+            dlg.exec()
+            return
+        self.update_map()
 
-        if self.variable_units is not None:
-            if self.variable_units == "K":
-                if self.temp_convert_checkbox.isChecked():
-                    try:
-                        sliced_data = sliced_data - 273.15
-                    except Exception:
-                        self.temp_convert_checkbox.setChecked(False)
-                        dlg = QMessageBox(self)
-                        dlg.setWindowTitle("NetSeeDF message")
-                        dlg.setText("There was an error while converting to degrees Celsius!")
-                        dlg.exec()
-                        return
-
-        #self.backend.set_data(sliced_data)
-
-        # generate images
-        image, colorbar = self.getb64image(sliced_data)
-
-        # update image overlay layer on the folium map
-        js_code = 'var overlay = null;folium_1.eachLayer(function(layer){if(layer instanceof L.ImageOverlay){overlay = layer;}});if(overlay !== null){overlay.setUrl("data:image/png;base64,' + image + '");}'
-        self.view.page().runJavaScript(js_code)
+    # Bounds and labels of the groups and the statistic of the time series while resampling, otherwise None
+    def get_series_resampling(self):
+        if self.groups is None:
+            return None
+        return self.groups[0], self.groups[1], self.resampling[1]
+
+    def on_follow_file_toggled(self):
+        following = self.follow_file_checkbox.isChecked()
+        self.newest_checkbox.setEnabled(following)
+        if following:
+            self.follow_file_timer.start()
+            datastore.refresh(self.var_props)
+        else:
+            self.follow_file_timer.stop()
+
+    # Extends the slice ranges and the time series to the records appended to the file (see datastore.extend_stored)
+    def on_file_grown(self, sizes, slicedata):
+        dims = self.var_props["sliceable_dims"]
+        grown = [i for i in range(len(self.slice_spinners)) if sizes[dims[i]] != self.var_props["sizes"][dims[i]]]
+        self.var_props["sizes"].update(sizes)
+        for i in grown:
+            size = sizes[dims[i]]
+            self.slice_spinners[i].setMaximum(size)
+            self.slice_size_labels[i].setText(" of " + str(size))
+            if self.slice_dates_list[i] is not None:
+                self.slice_dates_list[i] = datastore.get_slice_dates(self.var_props, i, slicedata, self.slicetunits, self.slicecalendar)
+            if i == self.t_index and self.groups is not None:
+                self.update_t_range()
+        if not grown:
+            return
+
+        self.series_times = self.get_series_times(slicedata)
+        self.backend.tdata = slicedata[self.timesliceindex]
+        if self.follow_file_checkbox.isChecked() and self.newest_checkbox.isChecked():
+            QTimer.singleShot(0, lambda: self.show_newest(grown))
+        elif self.series_point is not None:
+            self.series_timer.start()  # the series got longer
+
+    def show_newest(self, grown):
+        for i in grown:
+            self.slice_spinners[i].blockSignals(True)
+            self.slice_spinners[i].setValue(self.slice_spinners[i].maximum())
+            self.slice_spinners[i].blockSignals(False)
+        self.on_slice_changed()
+
+    # Dates of the axis of the time series chart, the values of the axis if it has no dates
+    def get_series_times(self, slicedata):
+        if self.series_dim is None:
+            return None
+        series_index = self.var_props["sliceable_dims"].index(self.series_dim)
+        try:
+            return num2date(slicedata[series_index], self.slicetunits[series_index], self.slicecalendar[series_index] or "standard",
+                            only_use_cftime_datetimes=False, only_use_python_datetimes=True)
+        except Exception:
+            return slicedata[series_index]  # not a time axis or a calendar without python datetimes
+
+    def closeEvent(self, event):
+        self.detail_timer.stop()
+        self.series_timer.stop()
+        if self.series_job is not None:
+            jobs.cancel(self.series_job)
+            self.series_job = None
+        self.follow_file_timer.stop()
+        datastore.unsubscribe(self.var_props, self)
+        super().closeEvent(event)
 
-        qimage = QImage.fromData(colorbar)
-        pixmap = QPixmap.fromImage(qimage)
-        self.cbar.setPixmap(pixmap)
+    def update_map(self):
+        with perf.operation("update_map", variable=self.var_props["variable_name"]):
+            slice_indices = self.get_slice_indices()
+            for i in range(len(self.var_props["sliceable_dims"])):
+                if i == self.t_index and self.groups is not None:
+                    self.slice_date_labels[i].setText(" =  " + resample.describe(*self.resampling) + " " + self.groups[1][slice_indices[i]])
+                elif self.slice_dates_list[i] is not None:
+                    self.slice_date_labels[i].setText(" =  " + str(self.slice_dates_list[i][slice_indices[i]]))
+
+            # generate images, unless they are cached
+            overview = self.get_cached_overview(slice_indices)
+            if overview is not None:
+                self.waiting_for_resample = False  # a cached aggregated slice is not computed again
+            else:
+                sliced_data, xboundaries, yboundaries = self.read_overview(slice_indices)
+                if sliced_data is None:  # the aggregated slice is being computed, see on_resampled_data
+                    self.slice_date_labels[self.t_index].setText(self.slice_date_labels[self.t_index].text() + " (computing...)")
+                    return
+
+                sliced_data = self.convert_units(sliced_data)
+                if sliced_data is None:
+                    return
+
+                overview = self.getb64image(sliced_data, slice_indices, xboundaries, yboundaries)
+            image, colorbar = overview
+
+            # update image overlay layer on the folium map
+            with perf.span("transfer"):
+                js_code = self.overlay_name + '.setUrl("data:image/png;base64,' + image + '");'
+                self.run_js(js_code)
+            perf.count("bytes_to_js", len(js_code))
+
+            with perf.span("colorbar pixmap"):
+                qimage = QImage.fromData(colorbar)
+                pixmap = QPixmap.fromImage(qimage)
+                self.cbar.setPixmap(pixmap)
+
+            self.close_map_popups()
+
+        self.update_series_chart()  # the series depends on the other slice dims and the units
+
+        # the detail overlay shows the previous slice or scale, read it again
+        self.detail_state = None
+        if self.last_view is not None:
+            self.detail_timer.start()
+
+    def on_view_changed(self, south, west, north, east, width, height):
+        self.last_view = (south, west, north, east, width, height)
+        if self.overview_stride > 1:
+            self.detail_timer.start()
+
+    # Shows the visible part of the slice at a higher resolution than the overview, once the map is zoomed in far
+    # enough. Only about one cell per screen pixel is read, so the memory used is bounded by the size of the map.
+    def update_detail(self):
+        if self.last_view is None or self.overview_stride == 1:
+            return
+
+        south, west, north, east, width, height = self.last_view
+        window = datautils.get_index_window(self.xdata, self.ydata, west, east, max(south, -85), min(north, 85))
+        if window is None:
+            self.remove_detail_overlay()
+            return
+
+        x_range, y_range = window
+        dpr = self.devicePixelRatioF()
+        stride = datautils.get_lod_stride(x_range[1] - x_range[0], y_range[1] - y_range[0], width * dpr, height * dpr)
+        if stride >= self.overview_stride:  # zoomed out, the overview is detailed enough
+            self.remove_detail_overlay()
+            return
+
+        slice_indices = self.get_slice_indices()
+        detail_state = (x_range, y_range, stride, tuple(slice_indices), self.scale_min_value, self.scale_max_value,
+                        self.is_temp_converted(), self.get_lod_method(), self.resampling)
+        if detail_state == self.detail_state:
+            self.run_js(self.overlay_name + ".setOpacity(0);")
+            return
+
+        with perf.operation("update_detail", variable=self.var_props["variable_name"], stride=stride):
+            detail_data, xboundaries, yboundaries = self.read_lod(slice_indices, x_range, y_range, stride)
+            if detail_data is None:
+                return
+            detail_data = self.convert_units(detail_data)
+            if detail_data is None:
+                return
+
+            with perf.span("min/max"):
+                max_value = np.nanmax(detail_data)
+                min_value = np.nanmin(detail_data)
+
+            xmin, xmax = np.min(xboundaries), np.max(xboundaries)
+            ymin, ymax = max(np.min(yboundaries), -85), min(np.max(yboundaries), 85)
+            lod = [stride, self.get_lod_method(), list(x_range), list(y_range)]
+            image, _ = self.get_overlay_image(detail_data, slice_indices, xboundaries, yboundaries, [xmin, xmax, ymin, ymax],
+                                              min_value, max_value, self.scale_min_value, self.scale_max_value, lod, False)
+
+            with perf.span("transfer"):
+                js_code = ('if (window.detail_overlay) { folium_1.removeLayer(window.detail_overlay); }'
+                           'window.detail_overlay = L.imageOverlay("data:image/png;base64,' + image + '", '
+                           '[[' + str(ymin) + ',' + str(xmin) + '],[' + str(ymax) + ',' + str(xmax) + ']], '
+                           '{opacity: ' + str(OVERLAY_OPACITY) + ', interactive: false}).addTo(folium_1);' +
+                           self.overlay_name + '.setOpacity(0);')
+                self.run_js(js_code)
+            perf.count("bytes_to_js", len(js_code))
+
+        self.detail_state = detail_state
+
+    def remove_detail_overlay(self):
+        self.detail_state = None
+        self.run_js('if (window.detail_overlay) { folium_1.removeLayer(window.detail_overlay); window.detail_overlay = null; }' +
+                    self.overlay_name + '.setOpacity(' + str(OVERLAY_OPACITY) + ');')
+
+    def on_series_toggled(self):
+        shown = self.series_checkbox.isChecked()
+        self.series_chart.setVisible(shown)
+        self.follow_checkbox.setEnabled(shown)
+        if not shown:
+            self.follow_checkbox.setChecked(False)
+        self.update_series_chart()
+
+    def on_follow_toggled(self):
+        self.run_js("window.follow_hover = " + ("true" if self.follow_checkbox.isChecked() else "false") + ";")
+
+    def on_point_selected(self, gridi, gridj, gridlat, gridlon):
+        self.series_point = (gridi, gridj, gridlat, gridlon)
+        self.update_series_chart()
+
+    def on_map_hover(self, lat, lon):
+        grid_point = self.find_grid_point(lat, lon)
+        if grid_point is None or self.series_point is not None and grid_point[0:2] == self.series_point[0:2]:
+            return
+        self.series_point = grid_point
+        if not self.series_timer.isActive():
+            self.series_timer.start()
+
+    # Shows the time series of the selected grid point, neighbouring points are read from the cached chunk column. The
+    # series is read in a job, reading an uncached column reads the whole time axis of its chunks. While a job runs
+    # the point can change (e.g. following the mouse), the chart is then updated for the latest point once it is done.
+    def update_series_chart(self):
+        if self.series_checkbox is None or not self.series_checkbox.isChecked() or self.series_point is None:
+            return
+        if self.series_job is not None:
+            return  # see on_series_read
+
+        # runs as a background job, the state of the window is read here in the GUI thread
+        var_props, series_dim = self.var_props, self.series_dim
+        slice_indices = self.get_slice_indices()
+        request = (self.series_point, slice_indices)
+        gridi, gridj = self.series_point[0:2]
+
+        def read_series(job):
+            return request, seriescache.get_timeseries(var_props, slice_indices, gridi, gridj, series_dim, job)
+
+        self.series_job = jobs.submit("Time series of " + var_props["variable_name"], read_series, var_props["file_path"],
+                                      jobs.PRIORITY_HIGH, self.on_series_read)
+
+    def on_series_read(self, job):
+        if job is not self.series_job:
+            return
+        self.series_job = None
+        if job.state != jobs.FINISHED:
+            return
+        request, series = job.result
+        if request != (self.series_point, self.get_slice_indices()):
+            self.update_series_chart()  # the point or slice changed while the series was read
+            return
+        self.show_series_chart(series)
+
+    def show_series_chart(self, series):
+        if self.series_checkbox is None or not self.series_checkbox.isChecked():
+            return
+
+        gridi, gridj, gridlat, gridlon = self.series_point
+        with perf.operation("update_series_chart", variable=self.var_props["variable_name"]):
+            series = self.convert_units(series)
+            if series is None:
+                return
+
+            value_label = "°C" if self.is_temp_converted() else self.variable_units
+            title = "{0:.4g}°, {1:.4g}°".format(float(gridlat), float(gridlon))
+            times = self.series_times
+            if self.groups is not None:  # one value per group, at the time of its first step
+                series = resample.aggregate_series(series, self.groups[0], self.resampling[1])
+                times = np.asarray(times)[self.groups[0][:len(series)]]
+                title += " (" + resample.describe(*self.resampling) + ")"
+            dpr = self.devicePixelRatioF()
+            chart = render_timeseries(times, series, title, value_label,
+                                      max(self.series_chart.width(), 300) * dpr, SERIES_CHART_HEIGHT * dpr)
+            pixmap = QPixmap.fromImage(QImage.fromData(chart))
+            pixmap.setDevicePixelRatio(dpr)
+            self.series_chart.setPixmap(pixmap)
+
+    def is_temp_converted(self):
+        return self.variable_units == "K" and self.temp_convert_checkbox.isChecked()
+
+    # Key of the overview overlay of a slice in the overlay cache. With autoscale the scale is only known once the slice
+    # has been read, the overlay is cached under an autoscale flag then (see get_cached_overview).
+    def get_overview_key(self, slice_indices):
+        lod = None
+        if self.warp_map is not None:
+            lod = ["warp", self.warp_map.key]
+        elif self.overview_stride > 1:
+            lod = [self.overview_stride, self.get_lod_method()]
+        scale_min_value, scale_max_value = (None, None) if self.autoscale else self.get_manual_scale()
+        return overlaycache.make_key(self.var_props, slice_indices, scale_min_value, scale_max_value, COLORMAP,
+                                     self.is_temp_converted(), lod, self.resampling)
+
+    # Returns the base64 encoded overview image and the colorbar image of a slice from the overlay cache, None if they
+    # are not cached. The color scale is set from the value range stored with the images, so the slice is not read.
+    def get_cached_overview(self, slice_indices):
+        with perf.span("cache lookup"):
+            cached = overlaycache.get(self.get_overview_key(slice_indices))
+        if cached is None:
+            return None
+        image, colorbar, min_value, max_value = cached
 
-        self.close_map_popups()
+        self.state = "generating image"
+        self.set_scale(min_value, max_value)
+        with perf.span("base64"):
+            b64image = base64.b64encode(image).decode("utf-8")
+        self.state = "image done"
+        return b64image, colorbar
 
-    def getb64image(self, image_data):
+    # Returns the base64 encoded overlay image and the colorbar image for the data, which covers the whole grid
+    # (possibly at a reduced resolution), and stores them in the overlay cache. Sets the color scale if autoscale is
+    # enabled.
+    def getb64image(self, image_data, slice_indices, xboundaries, yboundaries):
         self.state = "generating image"
 
-        image = io.BytesIO()
-        colorbar = io.BytesIO()
+        with perf.span("min/max"):
+            max_value = np.nanmax(image_data)
+            min_value = np.nanmin(image_data)
+        self.set_scale(min_value, max_value)
 
-        ax = plt.axes(projection=ccrs.epsg(3857))
+        start = time.perf_counter()
+        image, colorbar = self.render_images(image_data, xboundaries, yboundaries, [self.xmin, self.xmax, self.ymin, self.ymax],
+                                             min_value, max_value, self.scale_min_value, self.scale_max_value)
+        with perf.span("cache store"):
+            overlaycache.put(self.get_overview_key(slice_indices), image, colorbar, min_value, max_value, time.perf_counter() - start)
 
-        source_crs = ccrs.PlateCarree()
+        with perf.span("base64"):
+            b64image = base64.b64encode(image).decode("utf-8")
 
-        max_value = np.nanmax(image_data)
-        min_value = np.nanmin(image_data)
+        self.state = "image done"
+        return b64image, colorbar
+
+    # Color scale set in the spinners
+    def get_manual_scale(self):
+        scale_min_value = self.min_spinner.value()
+        if self.variable_units in ["mm", "day"]:  # force the color scale minimum value to 0
+            scale_min_value = 0
+        return scale_min_value, self.max_spinner.value()
+
+    # Sets the color scale of the overlays for data with the value range min_value to max_value, which is shown in the
+    # spinners if autoscale is enabled
+    def set_scale(self, min_value, max_value):
         rounded_max_value = utils.round_max_value(max_value)
         rounded_min_value = utils.round_min_value(min_value)
         step = utils.calculate_step(rounded_min_value, rounded_max_value)
@@ -288,8 +935,7 @@ class PlotWindow(QWidget):
             self.min_spinner.setValue(scale_min_value)
 
         else:
-            scale_max_value = self.max_spinner.value()
-            scale_min_value = self.min_spinner.value()
+            scale_min_value, scale_max_value = self.get_manual_scale()
 
         if self.variable_units is not None:
             if self.variable_units in ["mm", "day"]:  # force the color scale minimum value to 0
@@ -297,47 +943,41 @@ class PlotWindow(QWidget):
                 if self.autoscale:
                     self.min_spinner.setValue(0)
 
-        ax.set_extent([self.xmin, self.xmax, self.ymin, self.ymax], crs=source_crs)
-        ax.axis("off")
-
-        norm = Normalize(vmin=scale_min_value, vmax=scale_max_value)
-        cmap = get_cmap("inferno")
-        cmap.set_extremes(under='grey', over='red')
-        sm = ScalarMappable(norm=norm, cmap=cmap)
-
-        ax.pcolormesh(self.xboundaries, self.yboundaries, image_data, cmap=cmap, transform=source_crs,
-                      vmin=scale_min_value, vmax=scale_max_value, shading="flat")
-        plt.savefig(image, format="png", bbox_inches="tight", pad_inches=0, dpi=650)
-
-        fig, ax = plt.subplots(figsize=(1.1, 3.5), layout="constrained")
-
-        if scale_min_value > min_value and scale_max_value < max_value:
-            extend = "both"
-        elif scale_min_value > min_value:
-            extend = "min"
-        elif scale_max_value < max_value:
-            extend = "max"
+        self.scale_min_value, self.scale_max_value = scale_min_value, scale_max_value  # detail overlays use the same scale
+
+    # Returns the base64 encoded overlay image and the colorbar image (empty bytes without with_colorbar). Rendered
+    # images are kept in the on-disk overlay cache, so revisiting the same slice with the same color scale does not
+    # render it again. lod describes the resolution and window of reduced resolution data, None for the full grid.
+    def get_overlay_image(self, image_data, slice_indices, xboundaries, yboundaries, extent, min_value, max_value, scale_min_value, scale_max_value, lod, with_colorbar):
+        cache_key = overlaycache.make_key(self.var_props, slice_indices, scale_min_value, scale_max_value, COLORMAP, self.is_temp_converted(), lod, self.resampling)
+        with perf.span("cache lookup"):
+            cached = overlaycache.get(cache_key)
+        if cached is not None:
+            image, colorbar = cached[:2]
         else:
-            extend = "neither"
+            start = time.perf_counter()
+            image, colorbar = self.render_images(image_data, xboundaries, yboundaries, extent, min_value, max_value, scale_min_value, scale_max_value, with_colorbar)
+            with perf.span("cache store"):
+                overlaycache.put(cache_key, image, colorbar, min_value, max_value, time.perf_counter() - start)
 
-        cbar = fig.colorbar(sm, cax=ax, extend=extend)
+        with perf.span("base64"):
+            b64image = base64.b64encode(image).decode("utf-8")
 
-        if self.variable_units is not None:
-            if self.variable_units == "K":
-                if self.temp_convert_checkbox.isChecked():
-                    cbar.set_label("°C")
-                else:
-                    cbar.set_label(self.variable_units)
-            else:
-                cbar.set_label(self.variable_units)
-        fig.savefig(colorbar, format="png", bbox_inches="tight")
+        return b64image, colorbar
 
-        plt.close("all")
-        image.seek(0)
-        colorbar.seek(0)
+    # Renders the overlay image in web mercator projection and the colorbar, returns both as png bytes
+    def render_images(self, image_data, xboundaries, yboundaries, extent, min_value, max_value, scale_min_value, scale_max_value, with_colorbar=True):
+        colorbar_label = self.variable_units
+        if self.is_temp_converted():
+            colorbar_label = "°C"
 
-        self.state = "image done"
-        return base64.b64encode(image.read()).decode("utf-8"), colorbar.read()
+        if self.warp_map is not None:
+            image = render_warped(image_data, self.warp_map, scale_min_value, scale_max_value, COLORMAP)
+            colorbar = render_colorbar(min_value, max_value, scale_min_value, scale_max_value, COLORMAP, colorbar_label) if with_colorbar else b""
+            return image, colorbar
+
+        return render_overlay(image_data, xboundaries, yboundaries, extent, min_value, max_value, scale_min_value,
+                              scale_max_value, COLORMAP, colorbar_label, with_colorbar)
 
     def on_convert_temp(self):
         self.update_map()
@@ -0,0 +1,209 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import numpy.ma as ma
+
+import membudget
+import perf
+from zarrstore import normalize_key, split_index
+
+# Read planning for chunked NetCDF4 variables. The same variables are read as whole 2D slices, as strided overviews
+# and as long time series of small blocks, and the default HDF5 chunk cache of a variable (a few MB) is too small for
+# most of these: chunks which are needed again while a read gathers its elements are evicted and decompressed again.
+#
+# For every read the planner looks at the chunking of the variable and the requested hyperslab and
+# - sizes the chunk cache of the variable to hold the chunks touched by one sub-read (up to MAX_CACHE_BYTES),
+# - reads strided selections whose step is smaller than the chunk as a contiguous range and subsamples it in memory,
+#   every chunk is decompressed anyway and the netCDF library reads strided selections very slowly,
+# - splits reads larger than PIECE_BYTES into sub-reads along chunk boundaries of the outermost dimension, so each
+#   chunk is decompressed by exactly one sub-read and the memory of the unstrided ranges is bounded.
+# The chunks touched and decompressed by each read are added to the counters of the performance panel.
+#
+# The enlarged chunk caches live as long as their file is open. Together they are limited to the cache budget of the
+# process (CACHE_BUDGET_BYTES, lower in the worker processes of parallelread): the caches of the least recently read
+# variables are set back to their default size when it is exceeded. Their size is counted by the memory budget (see
+# membudget.track) and released when the file is closed (see forget_file).
+
+PIECE_BYTES = 64 * 1024 * 1024  # stored data read by one sub-read
+MAX_CACHE_BYTES = 256 * 1024 * 1024  # chunk cache of one variable
+CACHE_BUDGET_BYTES = 512 * 1024 * 1024  # enlarged chunk caches of all variables of the process
+CACHE_PREEMPTION = 0.75  # HDF5 default
+
+_lock = threading.RLock()
+_caches = OrderedDict()  # id of the variable -> (variable, its file, cache size, default cache), least recently read first
+_cache_budget = CACHE_BUDGET_BYTES
+
+
+# Chunk shape of a NetCDF4 variable, None for other backends and contiguous variables
+def get_chunks(var):
+    if type(var).__module__.split(".")[0] != "netCDF4":
+        return None
+    try:
+        chunking = var.chunking()
+    except Exception:
+        return None
+    if chunking is None or chunking == "contiguous":
+        return None
+    return [int(c) for c in chunking]
+
+
+# Number of chunks of each dim touched by a selection
+def count_chunks(key, shape, chunks):
+    return [len(split_index(k, size, chunk)) for k, size, chunk in zip(key, shape, chunks)]
+
+
+# Plans a read of var[key]. Returns a list of (key of the sub-read, subsampling of its result, index of the result in
+# the output) and the shape of the output, or None if the read is not planned.
+def plan(key, shape, chunks, itemsize):
+    read_key = []
+    subsample = []
+    for k, size, chunk in zip(key, shape, chunks):
+        if isinstance(k, (int, np.integer)):
+            read_key.append(int(k))
+            continue
+        start, stop, step = k.indices(size)
+        n = len(range(start, stop, step))
+        if n == 0 or step < 0:
+            return None
+        if 1 < step < chunk:  # every chunk along the dim is touched, read the range
+            read_key.append(slice(start, start + step * (n - 1) + 1))
+            subsample.append(slice(None, None, step))
+        else:
+            read_key.append(slice(start, start + step * (n - 1) + 1, step))
+            subsample.append(slice(None))
+
+    out_shape = tuple(len(range(*k.indices(size))) for k, size in zip(key, shape) if isinstance(k, slice))
+    read_lengths = [len(range(*k.indices(size))) if isinstance(k, slice) else 1 for k, size in zip(read_key, shape)]
+    read_bytes = int(np.prod(read_lengths, dtype=np.int64)) * itemsize
+
+    # split along the outermost dim which spans several chunks, in groups of whole chunks
+    split_dim = None
+    if read_bytes > PIECE_BYTES:
+        for i, k in enumerate(key):
+            if isinstance(k, slice) and len(split_index(k, shape[i], chunks[i])) > 1:
+                split_dim = i
+                break
+    if split_dim is None:
+        return [(tuple(read_key), tuple(subsample), tuple(slice(None) for _ in out_shape))], out_shape
+
+    parts = split_index(key[split_dim], shape[split_dim], chunks[split_dim])
+    part_bytes = read_bytes / max(1, read_lengths[split_dim]) * chunks[split_dim]
+    parts_per_piece = max(1, int(PIECE_BYTES // max(1, part_bytes)))
+    out_dim = sum(1 for k in key[:split_dim] if isinstance(k, slice))
+    read_step = read_key[split_dim].step or 1
+
+    pieces = []
+    for lo in range(0, len(parts), parts_per_piece):
+        first_src, first_dst = parts[lo]
+        last_src, last_dst = parts[min(lo + parts_per_piece, len(parts)) - 1]
+        piece_key = list(read_key)
+        piece_key[split_dim] = slice(first_src.start, last_src.stop, read_step)
+        dst = [slice(None) for _ in out_shape]
+        dst[out_dim] = slice(first_dst.start, last_dst.stop)
+        pieces.append((tuple(piece_key), tuple(subsample), tuple(dst)))
+    return pieces, out_shape
+
+
+# The root group (the file) of a variable
+def get_file(var):
+    group = var.group()
+    while group.parent is not None:
+        group = group.parent
+    return group
+
+
+def get_cache_bytes():
+    with _lock:
+        return sum(entry[2] for entry in _caches.values())
+
+
+# Limits the enlarged chunk caches of all variables of the process
+def set_cache_budget(nbytes):
+    global _cache_budget
+    with _lock:
+        _cache_budget = int(nbytes)
+        evict_caches()
+
+
+# Drops the variables of closed files and sets the chunk caches of the least recently read variables back to their
+# default size until the enlarged caches fit into the cache budget, the cache of the variable keep goes last
+def evict_caches(keep=None):
+    with _lock:
+        for key, (var, ncfile, size, default) in list(_caches.items()):
+            if not ncfile.isopen():
+                del _caches[key]
+        total = sum(entry[2] for entry in _caches.values())
+        for key in [k for k in _caches if k != keep] + [keep]:
+            if total <= _cache_budget or key not in _caches:
+                continue
+            var, ncfile, size, default = _caches.pop(key)
+            try:
+                var.set_var_chunk_cache(*default)
+            except Exception:
+                pass
+            total -= size
+            perf.count("chunk_cache_evictions")
+        membudget.track(_caches, "chunk caches", total)
+
+
+# Forgets the chunk caches of the variables of a file which is closed
+def forget_file(ncfile):
+    with _lock:
+        for key, entry in list(_caches.items()):
+            if entry[1] is ncfile:
+                del _caches[key]
+        membudget.track(_caches, "chunk caches", sum(entry[2] for entry in _caches.values()))
+
+
+# Sizes the chunk cache of the variable to hold the chunks touched by a sub-read
+def set_chunk_cache(var, piece_key, shape, chunks):
+    touched = int(np.prod(count_chunks(piece_key, shape, chunks), dtype=np.int64))
+    chunk_bytes = int(np.prod(chunks, dtype=np.int64)) * np.dtype(var.dtype).itemsize
+    with _lock:
+        size = int(min(MAX_CACHE_BYTES, _cache_budget, max(touched, 1) * chunk_bytes))
+        try:
+            entry = _caches.pop(id(var), None)
+            default = entry[3] if entry is not None else var.get_var_chunk_cache()
+            if var.get_var_chunk_cache()[0] < size:
+                var.set_var_chunk_cache(size=size, nelems=4 * touched + 1, preemption=CACHE_PREEMPTION)
+                perf.count("chunk_cache_resizes")
+            elif entry is not None:
+                size = entry[2]
+            if entry is not None or size > default[0]:
+                _caches[id(var)] = (var, get_file(var), size, default)  # the entry keeps the variable and its id
+                evict_caches(keep=id(var))
+        except Exception:
+            pass  # not supported by the library build, the read still works
+    perf.count("chunk_cache_bytes", size)
+    return touched, chunk_bytes
+
+
+# Reads var[key] following the plan, other variables are read directly
+def read(var, key):
+    chunks = get_chunks(var)
+    normalized = normalize_key(key, len(var.shape)) if chunks is not None else None
+    planned = plan(normalized, var.shape, chunks, np.dtype(var.dtype).itemsize) if normalized is not None else None
+    if planned is None:
+        return var[key]
+
+    pieces, out_shape = planned
+    perf.count("planned_reads")
+    perf.count("read_pieces", len(pieces))
+
+    out = None
+    for piece_key, subsample, dst in pieces:
+        touched, chunk_bytes = set_chunk_cache(var, piece_key, var.shape, chunks)
+        perf.count("chunks_decompressed", touched)
+        perf.count("chunk_bytes_decompressed", touched * chunk_bytes)
+
+        data = var[piece_key]
+        if any(s.step not in (None, 1) for s in subsample):
+            data = data[subsample]
+        if len(pieces) == 1:
+            return data
+
+        if out is None:
+            out = ma.masked_array(np.empty(out_shape, dtype=data.dtype), mask=np.zeros(out_shape, dtype=bool))
+        out[dst] = data
+    return out
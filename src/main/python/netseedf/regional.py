@@ -0,0 +1,233 @@
+import os
+import time
+
+import numpy as np
+import numpy.ma as ma
+from netCDF4 import num2date
+
+import datautils
+import membudget
+import perf
+import reproject
+
+# Area weighted mean time series of regions of a variable. A region is a box of latitude and longitude or the cells of
+# a mask variable on the same grid: every value of the mask other than 0 is a region (e.g. the codes of a country
+# mask), a mask with fractions between 0 and 1 (e.g. a land fraction) is one region whose cells count with their
+# fraction. Cells are weighted by the cosine of their latitude.
+#
+# The cells of the regions are kept as integer labels of the grid, one label array for a box and one shared by all
+# regions of a mask, so a mask with hundreds of codes costs no more than the mask itself. The weights of the labelled
+# cells are computed once (and kept as long as the memory budget has room for them). The variable is then read in a
+# single pass along time, in blocks which are whole multiples of its chunks and hold about BLOCK_BYTES, covering only
+# the bounding box of all regions. Every time step of a block is reduced for all regions of a label array at once
+# with np.bincount, so neither the data of the regions nor the 3D box is held in memory. Cells without a value
+# (masked) do not count for the mean of their time step.
+
+BLOCK_BYTES = 64 * 1024 * 1024
+MAX_MASK_REGIONS = 500
+
+_weights = membudget.BudgetedCache("region weights")  # (file path, variable, region specs) -> (box, label groups)
+
+
+# Cells of one or more regions of the grid. labels is an integer array (y, x) with the index of the region of every
+# cell, -1 for cells outside of all of them. fractions is an array (y, x) with the fraction of every cell which
+# belongs to its region, or None if the cells belong to their region wholly.
+class RegionLabels:
+    def __init__(self, labels, fractions=None):
+        self.labels = labels
+        self.fractions = fractions
+
+
+# A region of the grid, the cells with the label index in labels (a RegionLabels, shared by the regions of a mask).
+# spec identifies the region for the cache of weights.
+class Region:
+    def __init__(self, name, labels, index, spec):
+        self.name = name
+        self.labels = labels
+        self.index = index
+        self.spec = spec
+
+
+# Longitude and latitude of every cell of the grid of a variable (2D arrays y, x)
+def get_cell_lonlat(var_props):
+    ncfile = datautils.open_dataset(var_props["file_path"])
+    try:
+        if reproject.is_projected(ncfile, var_props):
+            geolocation = reproject.get_geolocation(ncfile, var_props)
+            if geolocation is None:
+                raise ValueError("The latitude and longitude of the grid are not known.")
+            jj, ii = np.meshgrid(np.arange(geolocation.shape[0]), np.arange(geolocation.shape[1]), indexing="ij")
+            lon, lat = geolocation.to_lonlat(jj, ii)
+            return lon.reshape(jj.shape), lat.reshape(jj.shape)
+
+        xdata = np.asarray(datautils.find_scoped_variable(ncfile, var_props["variable_name"], var_props["x_dim"])[:], dtype=np.float64)
+        ydata = np.asarray(datautils.find_scoped_variable(ncfile, var_props["variable_name"], var_props["y_dim"])[:], dtype=np.float64)
+        return np.broadcast_to(xdata[None, :], (len(ydata), len(xdata))), np.broadcast_to(ydata[:, None], (len(ydata), len(xdata)))
+    finally:
+        ncfile.close()
+
+
+# Region of the cells whose centers are in a box, longitudes may cross the antimeridian (west > east)
+def box_region(var_props, south, west, north, east):
+    lon, lat = get_cell_lonlat(var_props)
+    if east - west >= 360 or east - west <= -360:
+        in_lon = np.ones(lon.shape, dtype=bool)
+    else:
+        in_lon = (lon - west) % 360 <= (east - west) % 360
+    cells = in_lon & (lat >= south) & (lat <= north)
+    if not cells.any():
+        raise ValueError("The box does not contain any cells of the grid.")
+    name = "{0:g}° to {2:g}° N / {1:g}° to {3:g}° E".format(south, west, north, east)
+    return Region(name, RegionLabels(np.where(cells, 0, -1).astype(np.int16)), 0, ("box", south, west, north, east))
+
+
+# Regions of a mask variable (file path, variable path) on the grid of the variable, see the top of the module
+def mask_regions(var_props, mask_file, mask_path):
+    ncfile = datautils.open_dataset(mask_file)
+    try:
+        mask_var = datautils.get_variable(ncfile, mask_path)
+        mask = ma.masked_invalid(ma.asarray(mask_var[:], dtype=np.float64))
+        dims = [d for d, s in zip(mask_var.dimensions, mask_var.shape) if s != 1]
+        mask = mask.reshape([s for s in mask_var.shape if s != 1])
+    finally:
+        ncfile.close()
+
+    grid_shape = (var_props["sizes"][var_props["y_dim"]], var_props["sizes"][var_props["x_dim"]])
+    if dims == [var_props["x_dim"], var_props["y_dim"]] or (mask.shape[::-1] == grid_shape and mask.shape != grid_shape):
+        mask = mask.T
+    if mask.shape != grid_shape:
+        raise ValueError("The mask " + mask_path + " is not on the grid of the variable (" + str(grid_shape) + ").")
+
+    values = ma.compressed(mask)
+    values = np.unique(values[values != 0])
+    name = os.path.basename(mask_file) + ": " + mask_path
+    spec = ("mask", os.path.abspath(mask_file), mask_path)
+    if not len(values):
+        raise ValueError("The mask " + mask_path + " does not contain any cells of a region.")
+    mask = mask.filled(0)
+    if np.any(values != np.round(values)):
+        if values.min() < 0 or values.max() > 1:
+            raise ValueError("The values of the mask " + mask_path + " are neither region codes nor fractions between 0 and 1.")
+        return [Region(name, RegionLabels(np.where(mask != 0, 0, -1).astype(np.int16), mask), 0, spec)]
+    if len(values) > MAX_MASK_REGIONS:
+        raise ValueError("The mask has {} different values, at most {} regions are supported.".format(len(values), MAX_MASK_REGIONS))
+
+    # label of a cell: index of its value in the sorted codes
+    labels = RegionLabels(np.where(mask != 0, np.searchsorted(values, mask), -1).astype(np.int16))
+    if len(values) == 1:
+        return [Region(name, labels, 0, spec)]
+    return [Region(name + " = {0:g}".format(value), labels, i, spec + (float(value),)) for i, value in enumerate(values)]
+
+
+# Values of the time dim of a variable, as datetimes if they can be decoded, otherwise as numbers
+def get_times(var_props):
+    ncfile = datautils.open_dataset(var_props["file_path"])
+    try:
+        coordinate = datautils.find_scoped_variable(ncfile, var_props["variable_name"], var_props["t_dim"])
+        values = coordinate[:]
+        try:
+            return num2date(values, coordinate.units, getattr(coordinate, "calendar", "standard"),
+                            only_use_cftime_datetimes=False, only_use_python_datetimes=True)
+        except Exception:
+            return np.asarray(values)
+    except Exception:
+        return np.arange(var_props["sizes"][var_props["t_dim"]])
+    finally:
+        ncfile.close()
+
+
+# Bounding box (y start, y stop, x start, x stop) of all regions and the weights of their cells, a list with for every
+# label array of the regions (cells in the flattened box, their labels, their weights, the label index of each of its
+# regions and the columns of these regions in the means)
+def get_weights(var_props, regions):
+    key = (os.path.abspath(var_props["file_path"]), var_props["variable_name"], tuple(r.spec for r in regions))
+    cached = _weights.get(key)
+    if cached is not None:
+        perf.count("region_weight_hits")
+        return cached
+
+    start = time.perf_counter()
+    with perf.span("weights"):
+        label_arrays = []
+        for region in regions:
+            if not any(region.labels is labels for labels in label_arrays):
+                label_arrays.append(region.labels)
+
+        inside = np.zeros(label_arrays[0].labels.shape, dtype=bool)
+        for labels in label_arrays:
+            inside |= labels.labels >= 0
+        rows = np.nonzero(inside.any(axis=1))[0]
+        cols = np.nonzero(inside.any(axis=0))[0]
+        box = (int(rows[0]), int(rows[-1]) + 1, int(cols[0]), int(cols[-1]) + 1)
+
+        _, lat = get_cell_lonlat(var_props)
+        area = np.clip(np.cos(np.deg2rad(lat[box[0]:box[1], box[2]:box[3]])), 0, None).ravel()
+        groups = []
+        for labels in label_arrays:
+            box_labels = labels.labels[box[0]:box[1], box[2]:box[3]].ravel()
+            cells = np.nonzero(box_labels >= 0)[0]
+            weights = area[cells]
+            if labels.fractions is not None:
+                weights = weights * labels.fractions[box[0]:box[1], box[2]:box[3]].ravel()[cells]
+            columns = [i for i, region in enumerate(regions) if region.labels is labels]
+            indices = [regions[i].index for i in columns]
+            groups.append((cells, box_labels[cells].astype(np.intp), weights, np.array(indices, dtype=np.intp), np.array(columns, dtype=np.intp)))
+    return _weights.put(key, (box, groups), cost=time.perf_counter() - start)
+
+
+# Area weighted mean of every region at every index of the time dim, with the other sliceable dims at slice_indices.
+# Returns a masked array (time, regions). Run as a job (see jobs), the progress is reported after every block.
+def get_regional_means(var_props, regions, slice_indices, job=None):
+    with perf.operation("get_regional_means", variable=var_props["variable_name"], regions=len(regions)):
+        t_dim, y_dim, x_dim = var_props["t_dim"], var_props["y_dim"], var_props["x_dim"]
+        dims = list(var_props["all_dims"])
+        (y_start, y_stop, x_start, x_stop), groups = get_weights(var_props, regions)
+
+        shape, itemsize, chunk_shape = datautils.get_variable_layout(var_props)
+
+        # blocks along time are whole multiples of its chunk size and hold about BLOCK_BYTES
+        t_axis = dims.index(t_dim)
+        blocks = datautils.get_series_pieces(shape, itemsize, chunk_shape, t_axis, (y_stop - y_start) * (x_stop - x_start),
+                                             block_bytes=BLOCK_BYTES)
+
+        means = ma.masked_all((shape[t_axis], len(regions)), dtype=np.float64)
+        for block_start, block_stop in blocks:
+            key = []
+            for d in dims:
+                if d == t_dim:
+                    key.append(slice(block_start, block_stop))
+                elif d == y_dim:
+                    key.append(slice(y_start, y_stop))
+                elif d == x_dim:
+                    key.append(slice(x_start, x_stop))
+                elif d in var_props["drop_dims"]:
+                    key.append(0)
+                else:
+                    key.append(int(slice_indices[var_props["sliceable_dims"].index(d)]))
+
+            with perf.span("read"):
+                block = datautils.read_block(var_props, tuple(key))
+            perf.count("bytes_read", block.nbytes)
+
+            with perf.span("reduce"):
+                kept = [d for d in dims if d in (t_dim, y_dim, x_dim)]
+                block = ma.transpose(block, [kept.index(t_dim), kept.index(y_dim), kept.index(x_dim)])
+                block = ma.masked_invalid(ma.masked_equal(block, var_props["fill_value"]))
+                values = ma.getdata(block.filled(0)).reshape(block.shape[0], -1)
+                valid = (~ma.getmaskarray(block)).reshape(block.shape[0], -1)
+                sums = np.zeros((block.shape[0], len(regions)), dtype=np.float64)
+                total_weights = np.zeros(sums.shape, dtype=np.float64)
+                for cells, labels, weights, indices, columns in groups:
+                    n_labels = int(indices.max()) + 1
+                    block_values = values[:, cells]
+                    block_valid = valid[:, cells]
+                    for t in range(block.shape[0]):
+                        sums[t, columns] = np.bincount(labels, weights=block_values[t] * weights, minlength=n_labels)[indices]
+                        total_weights[t, columns] = np.bincount(labels, weights=block_valid[t] * weights, minlength=n_labels)[indices]
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    means[block_start:block_stop] = ma.masked_where(total_weights == 0, sums / np.where(total_weights == 0, 1, total_weights))
+
+            if job is not None:
+                job.set_progress(block_stop / shape[t_axis])
+
+        return means
@@ -0,0 +1,223 @@
+import os
+from pathlib import Path
+
+import numpy as np
+import numpy.ma as ma
+from PySide6.QtCore import Qt
+from PySide6.QtGui import QPixmap, QImage
+from PySide6.QtWidgets import QVBoxLayout, QWidget, QHBoxLayout, QLabel, QSpinBox, QDoubleSpinBox, QComboBox, \
+    QPushButton, QMessageBox, QListWidget, QSizePolicy
+
+from plotutils import render_timeseries
+import datautils
+import jobs
+import regional
+import utils
+
+MAX_LEGEND_REGIONS = 10  # charts of more regions are drawn without a legend
+
+
+# Window which shows the area weighted mean time series of regions (boxes of latitude and longitude or the regions of
+# a mask variable on the same grid) of a variable, see regional. Displayed when 'Regional means' button is clicked.
+class RegionalWindow(QWidget):
+    def __init__(self, var_props, mask_variables):
+        super().__init__()
+
+        self.var_props = var_props
+        self.regions = []
+        self.times = None
+        self.means = None
+        self.mean_names = None
+        self.job = None  # job computing the means, while it runs
+        self.last_directory = str(Path.home())
+
+        ncfile = datautils.open_dataset(var_props["file_path"])
+        try:
+            self.variable_units = getattr(datautils.get_variable(ncfile, var_props["variable_name"]), "units", None)
+        finally:
+            ncfile.close()
+
+        self.setWindowTitle(var_props["file_path"] + " - NetSeeDF")
+        self.setMinimumSize(700, 700)
+
+        # GUI setup
+        layout = QVBoxLayout()
+        file_label = QLabel("File: \t\t" + var_props["file_path"], wordWrap=True)
+        layout.addWidget(file_label)
+        var_label = QLabel("Variable: \t" + var_props["variable_name"], wordWrap=True)
+        layout.addWidget(var_label)
+        if self.variable_units is not None:
+            unit_label = QLabel("Units: \t\t" + str(self.variable_units), wordWrap=True)
+            layout.addWidget(unit_label)
+
+        # box of latitude and longitude, west > east crosses the antimeridian
+        box_widget = QWidget()
+        box_layout = QHBoxLayout()
+        box_layout.setAlignment(Qt.AlignmentFlag.AlignLeft)
+        box_widget.setLayout(box_layout)
+        self.box_spinners = []
+        for label, minimum, maximum, value in (("S", -90, 90, -90), ("N", -90, 90, 90), ("W", -360, 360, -180), ("E", -360, 360, 180)):
+            spinner = QDoubleSpinBox()
+            spinner.setRange(minimum, maximum)
+            spinner.setDecimals(2)
+            spinner.setValue(value)
+            box_layout.addWidget(QLabel(label + ": "))
+            box_layout.addWidget(spinner)
+            self.box_spinners.append(spinner)
+        add_box_button = QPushButton("Add box")
+        add_box_button.clicked.connect(self.add_box)
+        box_layout.addWidget(add_box_button)
+        layout.addWidget(box_widget)
+
+        # mask variables of the open files which have the shape of the grid
+        mask_widget = QWidget()
+        mask_layout = QHBoxLayout()
+        mask_layout.setAlignment(Qt.AlignmentFlag.AlignLeft)
+        mask_widget.setLayout(mask_layout)
+        self.mask_combo = QComboBox()
+        for file_path, path in mask_variables:
+            self.mask_combo.addItem(os.path.basename(file_path) + ": " + path, (file_path, path))
+        add_mask_button = QPushButton("Add mask")
+        add_mask_button.clicked.connect(self.add_mask)
+        add_mask_button.setEnabled(len(mask_variables) > 0)
+        mask_layout.addWidget(QLabel("Mask: "))
+        mask_layout.addWidget(self.mask_combo)
+        mask_layout.addWidget(add_mask_button)
+        layout.addWidget(mask_widget)
+
+        self.region_list = QListWidget()
+        self.region_list.setMaximumHeight(120)
+        layout.addWidget(self.region_list)
+        remove_button = QPushButton("Remove region")
+        remove_button.clicked.connect(self.remove_region)
+        layout.addWidget(remove_button)
+
+        # other sliceable dims, fixed at an index
+        self.dim_spinners = {}
+        for dim in var_props["sliceable_dims"]:
+            if dim == var_props["t_dim"]:
+                continue
+            dim_widget = QWidget()
+            dim_layout = QHBoxLayout()
+            dim_layout.setAlignment(Qt.AlignmentFlag.AlignLeft)
+            dim_widget.setLayout(dim_layout)
+            dim_layout.addWidget(QLabel(dim + ": "))
+            dim_spinner = QSpinBox()
+            dim_spinner.setMinimum(1)
+            dim_spinner.setMaximum(var_props["sizes"][dim])
+            dim_spinner.setValue(1)
+            dim_layout.addWidget(dim_spinner)
+            dim_layout.addWidget(QLabel(" of " + str(var_props["sizes"][dim])))
+            self.dim_spinners[dim] = dim_spinner
+            layout.addWidget(dim_widget)
+
+        self.compute_button = QPushButton("Compute regional means")
+        self.compute_button.clicked.connect(self.compute_means)
+        self.compute_button.setEnabled(False)
+        layout.addWidget(self.compute_button)
+
+        self.chart = QLabel()
+        self.chart.setMinimumSize(300, 250)
+        self.chart.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Expanding)
+        self.chart.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        layout.addWidget(self.chart)
+
+        self.export_button = QPushButton("Export regional means")
+        self.export_button.clicked.connect(self.export_means)
+        self.export_button.setEnabled(False)
+        layout.addWidget(self.export_button)
+
+        self.setLayout(layout)
+        jobs.add_listener(self.on_job_changed)
+
+    def show_error(self, text):
+        dlg = QMessageBox(self)
+        dlg.setWindowTitle("NetSeeDF message")
+        dlg.setText(text)
+        dlg.exec()
+
+    def add_regions(self, regions):
+        for region in regions:
+            self.regions.append(region)
+            self.region_list.addItem(region.name)
+        self.update_buttons()
+
+    def add_box(self):
+        south, north, west, east = (spinner.value() for spinner in self.box_spinners)
+        if south >= north:
+            self.show_error("The south edge of the box has to be below its north edge.")
+            return
+        try:
+            self.add_regions([regional.box_region(self.var_props, south, west, north, east)])
+        except ValueError as e:
+            self.show_error(str(e))
+
+    def add_mask(self):
+        mask_file, mask_path = self.mask_combo.currentData()
+        try:
+            self.add_regions(regional.mask_regions(self.var_props, mask_file, mask_path))
+        except ValueError as e:
+            self.show_error(str(e))
+
+    def remove_region(self):
+        row = self.region_list.currentRow()
+        if row >= 0:
+            self.region_list.takeItem(row)
+            del self.regions[row]
+            self.update_buttons()
+
+    def update_buttons(self):
+        self.compute_button.setEnabled(len(self.regions) > 0 and self.job is None)
+
+    def compute_means(self):
+        var_props = self.var_props
+        regions = list(self.regions)
+        slice_indices = [self.dim_spinners[d].value() - 1 if d in self.dim_spinners else 0 for d in var_props["sliceable_dims"]]
+
+        # all regions are computed in one pass over the variable as a background job (see on_means_done)
+        def read_means(job):
+            return regional.get_times(var_props), regional.get_regional_means(var_props, regions, slice_indices, job), regions
+
+        self.compute_button.setEnabled(False)
+        self.compute_button.setText("Computing regional means...")
+        self.job = jobs.submit("Regional means of " + var_props["variable_name"] + " (" + str(len(regions)) + " regions)",
+                               read_means, var_props["file_path"], jobs.PRIORITY_HIGH, self.on_means_done)
+
+    def on_job_changed(self, job):
+        if job is self.job and job.state == jobs.RUNNING:
+            self.compute_button.setText("Computing regional means... {:.0f} %".format(job.progress * 100))
+
+    def on_means_done(self, job):
+        self.job = None
+        self.compute_button.setText("Compute regional means")
+        self.update_buttons()
+
+        if job.state == jobs.FAILED:
+            self.show_error("There was an error while computing the regional means!\n" + job.error)
+            return
+
+        self.times, self.means, regions = job.result
+        self.mean_names = [region.name for region in regions]
+        labels = self.mean_names if len(regions) <= MAX_LEGEND_REGIONS else None
+        chart = render_timeseries(self.times, self.means, "Regional means of " + self.var_props["variable_name"],
+                                  self.variable_units, max(300, self.chart.width()), max(250, self.chart.height()), labels)
+        self.chart.setPixmap(QPixmap.fromImage(QImage.fromData(chart)))
+        self.export_button.setEnabled(True)
+
+    # Exports a table with the time in the first column and the mean of a region in every other column
+    def export_means(self):
+        table = np.empty((len(self.times) + 1, len(self.mean_names) + 1), dtype=object)
+        table[0] = ["time"] + self.mean_names
+        table[1:, 0] = [str(t) for t in self.times]
+        table[1:, 1:] = ma.getdata(self.means)
+        mask = np.zeros(table.shape, dtype=bool)
+        mask[1:, 1:] = ma.getmaskarray(self.means)
+        utils.show_dialog_and_save(self, ma.masked_array(table, mask=mask), self.var_props["variable_name"] + "_regional_means",
+                                   source_path=self.var_props["file_path"])
+
+    def closeEvent(self, event):
+        jobs.remove_listener(self.on_job_changed)
+        if self.job is not None:
+            jobs.cancel(self.job)
+            self.job = None
+        event.accept()
@@ -0,0 +1,513 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+import datautils
+import membudget
+import perf
+from overlaycache import get_cache_root
+
+# Reprojection of grids which are not regular in longitude and latitude (projected grids with a CF grid_mapping, e.g.
+# rotated pole or Lambert conformal, and curvilinear grids with 2D latitude and longitude coordinates) to the
+# web mercator map overlay. The geolocation of the grid is read once and turned into a warp map: a lookup table with
+# the (flat) index of the source cell shown in every pixel of the overlay, or -1 outside of the grid. Every slice is
+# then drawn with a single gather (data.ravel()[lut]) instead of reprojecting it.
+#
+# Warp maps are kept in memory (as long as the memory budget has room for them, see membudget) and in the cache
+# directory (see overlaycache), they only depend on the grid, so all variables on the same grid of a file share one.
+
+WARP_FORMAT_VERSION = 1  # increase when the computation changes, so that old warp maps are not reused
+MAX_PIXELS = 2048  # longest side of the overlay
+OVERSAMPLING = 2  # overlay pixels per grid cell (along the longer side)
+MAX_LATITUDE = 85  # the web mercator map ends here
+MAX_DISK_ENTRIES = 50
+BLOCK_SIZE = 4 * 1024 * 1024  # points transformed at once, bounds the temporary memory
+
+DEGREES_EAST_UNITS = {"degrees_east", "degree_east", "degrees_e", "degree_e", "degreee", "degreese"}
+PROJECTED_STANDARD_NAMES = {"projection_x_coordinate", "grid_longitude"}
+PROJECTED_UNITS = {"m", "km", "meter", "meters", "metre", "metres"}
+LAT_COORDINATE_NAMES = {"lat", "latitude", "nav_lat", "XLAT", "TLAT", "lat_rho"}
+LON_COORDINATE_NAMES = {"lon", "longitude", "nav_lon", "XLONG", "TLONG", "lon_rho"}
+
+_warp_maps = membudget.BudgetedCache("warp maps")  # key -> WarpMap
+_warp_keys = {}  # (file path, file state, variable) -> key of its warp map, to find it without reading the grid
+
+
+# Whether the grid of a variable is not regular in longitude and latitude. This is decided by the metadata, not by the
+# names of the dims: a grid mapping other than latitude_longitude, x coordinates in projection units or 2D latitude
+# and longitude coordinates. Grids without any of these are drawn as longitude and latitude, like before.
+def needs_reprojection(var_props):
+    ncfile = datautils.open_dataset(var_props["file_path"])
+    try:
+        return is_projected(ncfile, var_props)
+    finally:
+        ncfile.close()
+
+
+def is_projected(ncfile, var_props):
+    variable_path = var_props["variable_name"]
+    var = datautils.get_variable(ncfile, variable_path)
+    if "grid_mapping" in var.ncattrs():
+        mapping_var = find_variable(ncfile, variable_path, str(var.getncattr("grid_mapping")).split()[0].rstrip(":"))
+        if mapping_var is not None and getattr(mapping_var, "grid_mapping_name", None) != "latitude_longitude":
+            return True
+
+    x_var = find_variable(ncfile, variable_path, var_props["x_dim"])
+    if x_var is not None and len(x_var.dimensions) == 1:
+        attrs = get_attributes(x_var)
+        if str(attrs.get("units", "")).lower() in DEGREES_EAST_UNITS or attrs.get("standard_name") == "longitude":
+            return False
+        if attrs.get("standard_name") in PROJECTED_STANDARD_NAMES or str(attrs.get("units", "")).lower() in PROJECTED_UNITS:
+            return True
+
+    lat_var, lon_var = find_latlon_variables(ncfile, variable_path, var, var_props["x_dim"], var_props["y_dim"])
+    return lat_var is not None and lon_var is not None
+
+
+def mercator_y(lat):
+    return np.log(np.tan(np.pi / 4 + np.radians(lat) / 2))
+
+
+def mercator_lat(y):
+    return np.degrees(2 * np.arctan(np.exp(y)) - np.pi / 2)
+
+
+# Cell edges of 1D cell centers, in increasing order. Returns the edges and whether the centers were decreasing.
+def get_edges(centers):
+    centers = np.asarray(centers, dtype=np.float64)
+    descending = len(centers) > 1 and centers[0] > centers[-1]
+    if descending:
+        centers = centers[::-1]
+    if len(centers) < 2:
+        return np.array([centers[0] - 0.5, centers[0] + 0.5]), descending
+    middles = (centers[:-1] + centers[1:]) / 2
+    edges = np.concatenate(([centers[0] - (middles[0] - centers[0])], middles, [centers[-1] + (centers[-1] - middles[-1])]))
+    return edges, descending
+
+
+# Index of the cell containing each value, -1 outside of the cells
+def get_cell_index(edges, descending, values):
+    n = len(edges) - 1
+    index = np.searchsorted(edges, values, side="right") - 1
+    outside = (index < 0) | (index >= n) | ~np.isfinite(values)
+    if descending:
+        index = n - 1 - index
+    index[outside] = -1
+    return index
+
+
+# CF grid mapping attributes -> cartopy CRS, None if the mapping is not supported
+def make_crs(attrs):
+    from cartopy import crs as ccrs
+
+    def get(name, default=0.0):
+        value = attrs.get(name, default)
+        return float(np.ravel(value)[0]) if value is not None else None
+
+    globe = None
+    if "semi_major_axis" in attrs or "earth_radius" in attrs:
+        globe = ccrs.Globe(semimajor_axis=get("semi_major_axis", attrs.get("earth_radius")),
+                           semiminor_axis=get("semi_minor_axis", None),
+                           inverse_flattening=get("inverse_flattening", None),
+                           ellipse=None)
+
+    standard_parallels = attrs.get("standard_parallel")
+    if standard_parallels is not None:
+        standard_parallels = [float(v) for v in np.ravel(standard_parallels)]
+
+    mapping = attrs.get("grid_mapping_name")
+    if mapping == "rotated_latitude_longitude":
+        return ccrs.RotatedPole(pole_longitude=get("grid_north_pole_longitude"), pole_latitude=get("grid_north_pole_latitude"),
+                                central_rotated_longitude=get("north_pole_grid_longitude"), globe=globe)
+    if mapping == "lambert_conformal_conic":
+        return ccrs.LambertConformal(central_longitude=get("longitude_of_central_meridian"), central_latitude=get("latitude_of_projection_origin"),
+                                     false_easting=get("false_easting"), false_northing=get("false_northing"),
+                                     standard_parallels=standard_parallels or (33, 45), globe=globe)
+    if mapping == "transverse_mercator":
+        return ccrs.TransverseMercator(central_longitude=get("longitude_of_central_meridian"), central_latitude=get("latitude_of_projection_origin"),
+                                       false_easting=get("false_easting"), false_northing=get("false_northing"),
+                                       scale_factor=get("scale_factor_at_central_meridian", 1.0), globe=globe, approx=False)
+    if mapping == "polar_stereographic":
+        true_scale_latitude = standard_parallels[0] if standard_parallels else None
+        return ccrs.Stereographic(central_latitude=get("latitude_of_projection_origin"), central_longitude=get("straight_vertical_longitude_from_pole"),
+                                  false_easting=get("false_easting"), false_northing=get("false_northing"),
+                                  true_scale_latitude=true_scale_latitude, globe=globe)
+    if mapping == "stereographic":
+        return ccrs.Stereographic(central_latitude=get("latitude_of_projection_origin"), central_longitude=get("longitude_of_projection_origin"),
+                                  false_easting=get("false_easting"), false_northing=get("false_northing"),
+                                  scale_factor=get("scale_factor_at_projection_origin", 1.0), globe=globe)
+    if mapping == "lambert_azimuthal_equal_area":
+        return ccrs.LambertAzimuthalEqualArea(central_longitude=get("longitude_of_projection_origin"), central_latitude=get("latitude_of_projection_origin"),
+                                              false_easting=get("false_easting"), false_northing=get("false_northing"), globe=globe)
+    if mapping == "albers_conical_equal_area":
+        return ccrs.AlbersEqualArea(central_longitude=get("longitude_of_central_meridian"), central_latitude=get("latitude_of_projection_origin"),
+                                    false_easting=get("false_easting"), false_northing=get("false_northing"),
+                                    standard_parallels=standard_parallels or (20, 50), globe=globe)
+    if mapping == "mercator":
+        return ccrs.Mercator(central_longitude=get("longitude_of_projection_origin"), latitude_true_scale=get("standard_parallel", None),
+                             false_easting=get("false_easting"), false_northing=get("false_northing"), globe=globe)
+
+    if "crs_wkt" in attrs:  # any other projection, if it is described as well known text
+        try:
+            from pyproj import CRS
+            return ccrs.Projection(CRS.from_wkt(attrs["crs_wkt"]))
+        except Exception:
+            return None
+    return None
+
+
+# Geolocation of a grid given by a grid mapping and 1D projection coordinates
+class ProjectedGrid:
+    def __init__(self, crs, x, y, description):
+        self.crs = crs
+        self.x = x
+        self.y = y
+        self.shape = (len(y), len(x))
+        self.description = description
+
+    # Longitudes and latitudes of cells (j, i are index arrays)
+    def to_lonlat(self, j, i):
+        from cartopy import crs as ccrs
+        points = ccrs.PlateCarree().transform_points(self.crs, self.x[np.ravel(i)], self.y[np.ravel(j)])
+        return points[:, 0], points[:, 1]
+
+    # Longitude and latitude range of the grid, estimated from a coarse subgrid
+    def get_bounds(self):
+        j = np.unique(np.linspace(0, self.shape[0] - 1, 65).round().astype(int))
+        i = np.unique(np.linspace(0, self.shape[1] - 1, 65).round().astype(int))
+        jj, ii = np.meshgrid(j, i, indexing="ij")
+        lon, lat = self.to_lonlat(jj, ii)
+        lon = np.unwrap(lon.reshape(jj.shape), period=360, axis=1)
+        return get_padded_bounds(lon, lat, self.shape)
+
+    # Source cell of every pixel, computed by transforming the pixel centers to the grid projection
+    def compute_lut(self, lon, lat):
+        from cartopy import crs as ccrs
+        x_edges, x_descending = get_edges(self.x)
+        y_edges, y_descending = get_edges(self.y)
+        lut = np.empty(lon.shape, dtype=np.int64)
+        rows = max(1, BLOCK_SIZE // lon.shape[1])
+        for start in range(0, lon.shape[0], rows):
+            block_lon, block_lat = lon[start:start + rows], lat[start:start + rows]
+            points = self.crs.transform_points(ccrs.PlateCarree(), block_lon.ravel(), block_lat.ravel())
+            i = get_cell_index(x_edges, x_descending, points[:, 0])
+            j = get_cell_index(y_edges, y_descending, points[:, 1])
+            lut[start:start + rows] = np.where((i >= 0) & (j >= 0), j * self.shape[1] + i, -1).reshape(block_lon.shape)
+        return lut
+
+
+# Geolocation of a grid given by 2D latitude and longitude of its cells
+class CurvilinearGrid:
+    def __init__(self, lon, lat, description):
+        self.lon = np.unwrap(np.asarray(lon, dtype=np.float64), period=360, axis=1)
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.shape = self.lat.shape
+        self.description = description
+
+    def to_lonlat(self, j, i):
+        return self.lon[np.ravel(j), np.ravel(i)], self.lat[np.ravel(j), np.ravel(i)]
+
+    def get_bounds(self):
+        return get_padded_bounds(self.lon, self.lat, self.shape)
+
+    # There is no inverse transformation, so the cells are scattered to the pixels instead. Every cell is sampled k x k
+    # times (positions interpolated from the cell centers), with k large enough that neighbouring samples are less
+    # than a pixel apart, so the pixels inside the grid are covered without holes.
+    def compute_lut(self, lon, lat):
+        height, width = lon.shape
+        west, east = lon[0, 0], lon[0, -1]
+        top, bottom = mercator_y(lat[0, 0]), mercator_y(lat[-1, 0])
+        pixel_width = (east - west) / max(width - 1, 1)
+        pixel_height = (top - bottom) / max(height - 1, 1)
+
+        def to_pixels(cell_lon, cell_lat):
+            px = (cell_lon - west) / pixel_width
+            py = (top - mercator_y(np.clip(cell_lat, -89.9, 89.9))) / pixel_height
+            return px, py
+
+        px, py = to_pixels(self.lon, self.lat)
+        steps = [np.hypot(np.diff(px, axis=a), np.diff(py, axis=a)).ravel() for a in (0, 1) if self.shape[a] > 1]
+        steps = np.concatenate(steps) if steps else np.zeros(1)
+        steps = steps[np.isfinite(steps)]
+        k = int(np.clip(np.ceil(np.percentile(steps, 99) * 1.5), 1, 8)) if len(steps) else 1
+
+        lut = np.full((height, width), -1, dtype=np.int64)
+        ny, nx = self.shape
+        fi = (np.arange(nx * k) + 0.5) / k - 0.5  # fractional cell positions of the samples
+        i = np.clip(np.round(fi), 0, nx - 1).astype(np.int64)
+        i0 = np.clip(np.floor(fi), 0, max(nx - 2, 0)).astype(np.int64)
+        i1 = np.minimum(i0 + 1, nx - 1)
+        wi = fi - i0
+
+        rows = max(1, BLOCK_SIZE // (nx * k * k))
+        for start in range(0, ny, rows):
+            fj = (np.arange(start * k, min(ny, start + rows) * k) + 0.5) / k - 0.5
+            j = np.clip(np.round(fj), 0, ny - 1).astype(np.int64)
+            j0 = np.clip(np.floor(fj), 0, max(ny - 2, 0)).astype(np.int64)
+            j1 = np.minimum(j0 + 1, ny - 1)
+            wj = (fj - j0)[:, None]
+
+            def interpolate(values):
+                top_row = values[j0][:, i0] * (1 - wi) + values[j0][:, i1] * wi
+                bottom_row = values[j1][:, i0] * (1 - wi) + values[j1][:, i1] * wi
+                return top_row * (1 - wj) + bottom_row * wj
+
+            sample_px, sample_py = to_pixels(interpolate(self.lon), interpolate(self.lat))
+            sample_px = np.round(sample_px)
+            sample_py = np.round(sample_py)
+            inside = (sample_px >= 0) & (sample_px < width) & (sample_py >= 0) & (sample_py < height)
+            cells = j[:, None] * nx + i[None, :]
+            lut[sample_py[inside].astype(np.int64), sample_px[inside].astype(np.int64)] = cells[inside]
+        return lut
+
+
+# Longitude and latitude range of cell centers extended by half a cell, with latitudes limited to the mercator map
+def get_padded_bounds(lon, lat, shape):
+    west, east = np.nanmin(lon), np.nanmax(lon)
+    south, north = np.nanmin(lat), np.nanmax(lat)
+    pad_x = (east - west) / max(shape[1] - 1, 1) / 2
+    pad_y = (north - south) / max(shape[0] - 1, 1) / 2
+    return (max(south - pad_y, -MAX_LATITUDE), max(west - pad_x, -540), min(north + pad_y, MAX_LATITUDE), min(east + pad_x, 540))
+
+
+def get_attributes(var):
+    return {name: var.getncattr(name) for name in var.ncattrs()}
+
+
+# Variable by name in the scope of the variable at variable_path (see datautils.find_scoped_variable), None if none
+def find_variable(ncfile, variable_path, name):
+    try:
+        return datautils.find_scoped_variable(ncfile, variable_path, name)
+    except KeyError:
+        return None
+
+
+# 2D latitude and longitude variables of the horizontal dims, listed in the coordinates attribute or found by name
+def find_latlon_variables(ncfile, variable_path, var, x_dim, y_dim):
+    names = []
+    if "coordinates" in var.ncattrs():
+        names += str(var.getncattr("coordinates")).split()
+    names += list(datautils.get_group(ncfile, datautils.split_variable_path(variable_path)[0]).variables.keys())
+
+    lat_var, lon_var = None, None
+    for name in names:
+        cvar = find_variable(ncfile, variable_path, name)
+        if cvar is None or set(cvar.dimensions) != {x_dim, y_dim} or len(cvar.dimensions) != 2:
+            continue
+        attrs = get_attributes(cvar)
+        units = str(attrs.get("units", "")).lower()
+        standard_name = attrs.get("standard_name")
+        if lat_var is None and (standard_name == "latitude" or units in ("degrees_north", "degree_north", "degrees_n") or name in LAT_COORDINATE_NAMES):
+            lat_var = cvar
+        elif lon_var is None and (standard_name == "longitude" or units in ("degrees_east", "degree_east", "degrees_e") or name in LON_COORDINATE_NAMES):
+            lon_var = cvar
+    return lat_var, lon_var
+
+
+def read_yx(cvar, y_dim):
+    values = np.ma.filled(np.ma.asarray(cvar[:], dtype=np.float64), np.nan)
+    if cvar.dimensions[0] != y_dim:
+        values = values.T
+    return values
+
+
+def read_projection_coordinate(ncfile, variable_path, dim):
+    cvar = find_variable(ncfile, variable_path, dim)
+    if cvar is None or len(cvar.dimensions) != 1:
+        return None
+    values = np.ma.filled(np.ma.asarray(cvar[:], dtype=np.float64), np.nan)
+    units = str(getattr(cvar, "units", "")).lower()
+    if units == "km":
+        values = values * 1000
+    return values
+
+
+# Reads the geolocation of the grid of a variable, None if the grid cannot be located
+def get_geolocation(ncfile, var_props):
+    variable_path = var_props["variable_name"]
+    var = datautils.get_variable(ncfile, variable_path)
+    x_dim, y_dim = var_props["x_dim"], var_props["y_dim"]
+
+    if "grid_mapping" in var.ncattrs():
+        # the attribute can also be in the extended form "crs: x y", the first name is the grid mapping variable
+        mapping_name = str(var.getncattr("grid_mapping")).split()[0].rstrip(":")
+        mapping_var = find_variable(ncfile, variable_path, mapping_name)
+        x = read_projection_coordinate(ncfile, variable_path, x_dim)
+        y = read_projection_coordinate(ncfile, variable_path, y_dim)
+        if mapping_var is not None and x is not None and y is not None:
+            attrs = get_attributes(mapping_var)
+            crs = make_crs(attrs)
+            if crs is not None:
+                description = ["projected", mapping_name, crs.to_wkt(), x_dim, y_dim, [float(x[0]), float(x[-1])], [float(y[0]), float(y[-1])]]
+                return ProjectedGrid(crs, x, y, description)
+
+    lat_var, lon_var = find_latlon_variables(ncfile, variable_path, var, x_dim, y_dim)
+    if lat_var is not None and lon_var is not None:
+        return CurvilinearGrid(read_yx(lon_var, y_dim), read_yx(lat_var, y_dim), ["curvilinear", lon_var.name, lat_var.name, y_dim, x_dim])
+
+    return None
+
+
+def can_reproject(var_props):
+    ncfile = datautils.open_dataset(var_props["file_path"])
+    try:
+        return get_geolocation(ncfile, var_props) is not None
+    except Exception:
+        return False
+    finally:
+        ncfile.close()
+
+
+class WarpMap:
+    def __init__(self, key, lut, bounds, geolocation):
+        self.key = key
+        self.lut = lut  # (height, width) flat index into the (y, x) data, -1 outside of the grid
+        self.bounds = bounds  # (south, west, north, east) of the overlay
+        self.geolocation = geolocation
+
+    # Draws the 2D (y, x) data, masked values and pixels outside of the grid are masked
+    def warp(self, data):
+        import numpy.ma as ma
+        values = ma.getdata(data).ravel()
+        mask = ma.getmaskarray(data).ravel()
+        inside = self.lut >= 0
+        lut = np.where(inside, self.lut, 0)
+        return ma.array(values[lut], mask=~inside | mask[lut])
+
+    # Grid cell (j, i) shown at a point of the map, None if there is none
+    def locate(self, lat, lon):
+        south, west, north, east = self.bounds
+        height, width = self.lut.shape
+        for lon_shift in (0, 360, -360):
+            x = (lon + lon_shift - west) / (east - west) * width
+            y = (mercator_y(north) - mercator_y(np.clip(lat, -89.9, 89.9))) / (mercator_y(north) - mercator_y(south)) * height
+            if 0 <= x < width and 0 <= y < height:
+                cell = self.lut[int(y), int(x)]
+                if cell >= 0:
+                    return divmod(int(cell), self.geolocation.shape[1])
+        return None
+
+    def get_cell_latlon(self, j, i):
+        lon, lat = self.geolocation.to_lonlat(np.array([j]), np.array([i]))
+        return float(lat[0]), float(lon[0])
+
+
+# Longitudes and latitudes of the pixel centers of an overlay covering bounds, rows are evenly spaced in mercator y
+def get_pixel_lonlat(bounds, shape):
+    south, west, north, east = bounds
+    height, width = shape
+    lon = west + (np.arange(width) + 0.5) / width * (east - west)
+    y = mercator_y(north) - (np.arange(height) + 0.5) / height * (mercator_y(north) - mercator_y(south))
+    return np.meshgrid(lon, mercator_lat(y))
+
+
+# Size of the overlay, about OVERSAMPLING pixels per cell along the longer side of the grid
+def get_overlay_shape(bounds, grid_shape):
+    south, west, north, east = bounds
+    map_width = np.radians(east - west)
+    map_height = mercator_y(north) - mercator_y(south)
+    longest = int(min(MAX_PIXELS, max(grid_shape) * OVERSAMPLING))
+    if map_width >= map_height:
+        return max(1, int(round(longest * map_height / map_width))), longest
+    return longest, max(1, int(round(longest * map_width / map_height)))
+
+
+def get_file_state(file_path):
+    return list(datautils.get_file_state(file_path) or (None, None))  # None for virtual files, e.g. derived variables
+
+
+def make_key(var_props, geolocation):
+    file_path = os.path.abspath(var_props["file_path"])
+    key = [WARP_FORMAT_VERSION, file_path] + get_file_state(file_path) + [list(geolocation.shape), geolocation.description, MAX_PIXELS, OVERSAMPLING]
+    return hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()
+
+
+def get_cache_dir():
+    cache_dir = os.path.join(get_cache_root(), "warpmaps")
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def load(key):
+    path = os.path.join(get_cache_dir(), key + ".npz")
+    try:
+        with np.load(path) as contents:
+            lut, bounds = contents["lut"], tuple(float(b) for b in contents["bounds"])
+        os.utime(path)  # mark as recently used
+        return lut, bounds
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def store(key, lut, bounds):
+    cache_dir = get_cache_dir()
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, lut=lut, bounds=np.array(bounds))
+            os.replace(tmp_path, os.path.join(cache_dir, key + ".npz"))
+        except Exception:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+        entries = sorted((os.stat(os.path.join(cache_dir, name)).st_mtime, name) for name in os.listdir(cache_dir) if name.endswith(".npz"))
+        for _, name in entries[:-MAX_DISK_ENTRIES]:
+            os.remove(os.path.join(cache_dir, name))
+    except OSError:
+        pass
+
+
+# Returns the warp map of the grid of a variable, from the memory or disk cache or computed. Raises ValueError if the
+# grid cannot be located.
+def get_warp_map(var_props):
+    with perf.operation("get_warp_map", variable=var_props["variable_name"]):
+        variable_key = (os.path.abspath(var_props["file_path"]), tuple(get_file_state(var_props["file_path"])),
+                        var_props["variable_name"], var_props["x_dim"], var_props["y_dim"])
+        warp_map = _warp_maps.get(_warp_keys.get(variable_key))
+        if warp_map is not None:
+            perf.count("warp_map_memory_hit")
+            return warp_map
+
+        with perf.span("geolocation"):
+            ncfile = datautils.open_dataset(var_props["file_path"])
+            try:
+                geolocation = get_geolocation(ncfile, var_props)
+            finally:
+                ncfile.close()
+        if geolocation is None:
+            raise ValueError("The grid of " + var_props["variable_name"] + " has no grid mapping or 2D latitude and longitude")
+
+        key = make_key(var_props, geolocation)
+        _warp_keys[variable_key] = key
+        warp_map = _warp_maps.get(key)
+        if warp_map is not None:
+            perf.count("warp_map_memory_hit")
+            return warp_map
+
+        start = time.perf_counter()
+        with perf.span("disk cache"):
+            cached = load(key)
+        if cached is not None:
+            perf.count("warp_map_disk_hit")
+            lut, bounds = cached
+        else:
+            with perf.span("compute"):
+                bounds = geolocation.get_bounds()
+                lon, lat = get_pixel_lonlat(bounds, get_overlay_shape(bounds, geolocation.shape))
+                lut = geolocation.compute_lut(lon, lat)
+                lut = lut.astype(np.int32 if np.prod(geolocation.shape) < 2 ** 31 else np.int64)
+            with perf.span("store"):
+                store(key, lut, bounds)
+
+        warp_map = WarpMap(key, lut, bounds, geolocation)
+        _warp_keys[variable_key] = key
+        _warp_maps.put(key, warp_map, lut.nbytes, time.perf_counter() - start)
+        return warp_map
@@ -0,0 +1,152 @@
+import numpy as np
+import numpy.ma as ma
+
+import datautils
+import perf
+
+# Temporal resampling: the time dim of a variable is grouped by calendar period (day, month, season or year) of its
+# decoded dates, in the calendar of the file, and every group is reduced to one slice by a statistic (mean, sum,
+# minimum or maximum). A group is a run of consecutive time steps in the same period, so the time axis is expected to
+# be sorted. Seasons are DJF, MAM, JJA and SON, December counts to the winter of the following year.
+#
+# The slice of a group is computed in one pass over its time steps, in blocks which are whole multiples of the chunks
+# of the time dim and hold about BLOCK_BYTES, so besides one block only the running sums (or minimums, maximums) and
+# counts of the grid are held. Masked cells do not count, a cell without any value in the group is masked. The
+# aggregated slices are kept by the datastore (see datastore.get_resampled_data), time series of a grid point are
+# reduced in memory (see aggregate_series).
+
+PERIODS = ("day", "month", "season", "year")
+PERIOD_NAMES = {"day": "daily", "month": "monthly", "season": "seasonal", "year": "yearly"}
+STATISTICS = ("mean", "sum", "min", "max")
+SEASONS = ("DJF", "MAM", "JJA", "SON")
+BLOCK_BYTES = 64 * 1024 * 1024
+
+
+# e.g. "monthly mean", for labels and file names
+def describe(period, statistic):
+    return PERIOD_NAMES[period] + " " + statistic
+
+
+# Period of every date as an integer which grows with time, dates are datetime or cftime objects
+def get_period_codes(dates, period):
+    years = np.array([d.year for d in dates], dtype=np.int64)
+    if period == "year":
+        return years
+    months = np.array([d.month for d in dates], dtype=np.int64)
+    if period == "month":
+        return years * 12 + months - 1
+    if period == "season":
+        return (years * 12 + months) // 3  # season code % 4, year of its January code // 4
+    days = np.array([d.day for d in dates], dtype=np.int64)
+    return (years * 12 + months - 1) * 31 + days - 1
+
+
+def get_label(date, period):
+    if period == "year":
+        return "{:04d}".format(date.year)
+    if period == "month":
+        return "{:04d}-{:02d}".format(date.year, date.month)
+    if period == "season":
+        code = (date.year * 12 + date.month) // 3
+        return SEASONS[code % 4] + " {:04d}".format(code // 4)
+    return "{:04d}-{:02d}-{:02d}".format(date.year, date.month, date.day)
+
+
+# Groups of the time steps with their decoded dates. Returns the bounds of the groups (group i are the time steps
+# bounds[i] to bounds[i + 1] - 1) and a label of every group.
+def get_groups(dates, period):
+    with perf.span("groups"):
+        codes = get_period_codes(dates, period)
+        starts = np.concatenate([[0], np.nonzero(np.diff(codes))[0] + 1]).astype(np.int64)
+        labels = [get_label(dates[start], period) for start in starts]
+    return np.append(starts, len(codes)), labels
+
+
+# Index of the group which contains a time step
+def find_group(bounds, index):
+    return int(min(max(np.searchsorted(bounds, index, side="right") - 1, 0), len(bounds) - 2))
+
+
+def finish(totals, counts, statistic):
+    if statistic == "mean":
+        with np.errstate(invalid="ignore", divide="ignore"):
+            totals = totals / np.maximum(counts, 1)
+    return ma.masked_where(counts == 0, totals)
+
+
+# Slice of the time steps t_range (start, stop) reduced by the statistic, with the other sliceable dims at
+# slice_indices. The slice is laid out like datautils.get_sliced_data and limited to the region of the variable.
+# Run as a job (see jobs), the progress is reported after every block.
+def aggregate_slice(var_props, slice_indices, t_range, statistic, job=None):
+    start, stop = t_range
+    with perf.operation("aggregate_slice", variable=var_props["variable_name"], steps=stop - start, statistic=statistic):
+        t_dim, y_dim, x_dim = var_props["t_dim"], var_props["y_dim"], var_props["x_dim"]
+        dims = list(var_props["all_dims"])
+
+        shape, itemsize, chunk_shape = datautils.get_variable_layout(var_props)
+
+        x_slice, y_slice = datautils.region_index(var_props, "x", None), datautils.region_index(var_props, "y", None)
+        cells = len(range(*x_slice.indices(shape[dims.index(x_dim)]))) * len(range(*y_slice.indices(shape[dims.index(y_dim)])))
+
+        # blocks end at whole multiples of the chunk size along time and hold about BLOCK_BYTES
+        t_axis = dims.index(t_dim)
+        pieces = datautils.get_series_pieces(shape, itemsize, chunk_shape, t_axis, cells, start, BLOCK_BYTES)
+        blocks = [(piece_start, min(piece_stop, stop)) for piece_start, piece_stop in pieces if piece_start < stop]
+
+        totals, counts = None, None
+        for block_start, block_stop in blocks:
+            key = []
+            for d in dims:
+                if d == t_dim:
+                    key.append(slice(block_start, block_stop))
+                elif d == x_dim:
+                    key.append(x_slice)
+                elif d == y_dim:
+                    key.append(y_slice)
+                elif d in var_props["drop_dims"]:
+                    key.append(0)
+                else:
+                    key.append(int(slice_indices[var_props["sliceable_dims"].index(d)]))
+
+            with perf.span("read"):
+                block = datautils.read_block(var_props, tuple(key))
+            perf.count("bytes_read", block.nbytes)
+
+            with perf.span("reduce"):
+                axis = [d for d in dims if d in (t_dim, y_dim, x_dim)].index(t_dim)
+                block = ma.masked_invalid(ma.masked_equal(block, var_props["fill_value"]))
+                valid = ~ma.getmaskarray(block)
+                values = ma.getdata(block)
+                if statistic in ("mean", "sum"):
+                    reduced = np.where(valid, values, 0).sum(axis=axis, dtype=np.float64)
+                    totals = reduced if totals is None else totals + reduced
+                elif statistic == "min":
+                    reduced = np.where(valid, values, np.inf).min(axis=axis).astype(np.float64)
+                    totals = reduced if totals is None else np.fmin(totals, reduced)
+                else:
+                    reduced = np.where(valid, values, -np.inf).max(axis=axis).astype(np.float64)
+                    totals = reduced if totals is None else np.fmax(totals, reduced)
+                block_counts = valid.sum(axis=axis)
+                counts = block_counts if counts is None else counts + block_counts
+
+            if job is not None:
+                job.set_progress((block_stop - start) / (stop - start))
+
+        return finish(totals, counts, statistic)
+
+
+# Time series (e.g. of a grid point) reduced by the statistic for every group of bounds (see get_groups). Groups
+# beyond the end of a shorter series are left out.
+def aggregate_series(series, bounds, statistic):
+    series = ma.masked_invalid(ma.asarray(series, dtype=np.float64))[:bounds[-1]]
+    valid = ~ma.getmaskarray(series)
+    values = ma.getdata(series)
+    starts = bounds[:-1][bounds[:-1] < len(series)]
+    counts = np.add.reduceat(valid.astype(np.int64), starts)
+    if statistic in ("mean", "sum"):
+        totals = np.add.reduceat(np.where(valid, values, 0), starts)
+    elif statistic == "min":
+        totals = np.minimum.reduceat(np.where(valid, values, np.inf), starts)
+    else:
+        totals = np.maximum.reduceat(np.where(valid, values, -np.inf), starts)
+    return finish(totals, counts, statistic)
@@ -0,0 +1,244 @@
+import re
+import time
+from array import array
+
+import numpy as np
+
+import datautils
+import perf
+
+# Index of the variables of all open files for the search box of the main window. Every variable is indexed with its
+# name, long_name, standard_name, description, units and dimensions. A query matches variables which contain all of
+# its words as substrings (found through a trigram index) and, if there are not enough of those,
+# variables which contain most of its trigrams (fuzzy matching, e.g. "temprature" or "2m temperature").
+#
+# Entries are added file by file as files are opened, a file is scanned in a job (see prepare_file) and its entries
+# are added in the GUI thread, the search structures are rebuilt on the next query. Results
+# are limited, the search tells when a query matched more variables than it returns (e.g. very short queries).
+
+MIN_FUZZY_SCORE = 0.6  # fraction of the trigrams of the query found in a variable
+MAX_SUBSTRING_HITS = 20000  # stop collecting substring matches of very short queries
+SCAN_BATCH_SECONDS = 0.1  # the file is closed in between, so that other threads can read while a large file is scanned
+SEPARATOR = "\n"
+
+
+class SearchEntry:
+    def __init__(self, file_path, path, name, description, shape, text):
+        self.file_path = file_path
+        self.path = path  # variable path, see datautils.split_variable_path
+        self.name = name
+        self.description = description
+        self.shape = shape
+        self.text = text  # lowercase text which is searched
+
+
+def get_trigrams(text):
+    text = " " + " ".join(text.split()) + " "
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def get_attribute_text(var, attr):
+    try:
+        return str(var.getncattr(attr))
+    except Exception:
+        return ""
+
+
+# Lists all variables of a file, in all groups, as search entries. The groups are scanned in batches with the file
+# open, a batch takes SCAN_BATCH_SECONDS or as long as opening the file took (files with many groups open slowly), so
+# that not most of the time goes into opening the file again. In a job (see jobs) the progress is reported after
+# every batch.
+def scan_file(file_path, job=None):
+    entries = []
+    group_paths = [""]
+    scanned = 0
+    while group_paths:
+        start = time.perf_counter()
+        ncfile = datautils.open_dataset(file_path)
+        try:
+            opened = time.perf_counter()
+            batch_seconds = max(SCAN_BATCH_SECONDS, opened - start)
+            while group_paths and time.perf_counter() - opened < batch_seconds:
+                group_path = group_paths.pop(0)
+                for kind, name, path, description, shape in datautils.scan_group(ncfile, group_path):
+                    if kind == "group":
+                        group_paths.append(path)
+                        continue
+                    var = datautils.get_variable(ncfile, path)
+                    fields = [path, get_attribute_text(var, "long_name"), get_attribute_text(var, "standard_name"),
+                              get_attribute_text(var, "description"), get_attribute_text(var, "units"), " ".join(var.dimensions)]
+                    entries.append(SearchEntry(file_path, path, name, description, shape, " ".join(f for f in fields if f).lower()))
+                scanned += 1
+        finally:
+            ncfile.close()
+        if job is not None:
+            job.set_progress(scanned / (scanned + len(group_paths)), "{} variables".format(len(entries)))
+    return entries
+
+
+# Scans a file and computes the trigrams of its entries, run as a job. The result is added with SearchIndex.add_entries.
+def prepare_file(file_path, job=None):
+    with perf.operation("scan_file"):
+        with perf.span("scan"):
+            entries = scan_file(file_path, job)
+        with perf.span("trigrams"):
+            trigrams = [get_trigrams(entry.text) for entry in entries]
+        perf.count("scanned_variables", len(entries))
+    return entries, trigrams
+
+
+class SearchIndex:
+    def __init__(self):
+        self.entries = []
+        self.postings = {}  # trigram -> array of entry ids
+        self.trigram_counts = []
+        self.text = None  # all entry texts joined by SEPARATOR, None when it has to be rebuilt
+        self.offsets = None  # start of every entry in text
+        self.posting_arrays = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Adds the entries of a file with the trigrams of their texts (see prepare_file)
+    def add_entries(self, entries, trigrams):
+        with perf.operation("index_file", entries=len(self.entries)):
+            for entry, entry_trigrams in zip(entries, trigrams):
+                entry_id = len(self.entries)
+                self.entries.append(entry)
+                self.trigram_counts.append(len(entry_trigrams))
+                for trigram in entry_trigrams:
+                    self.postings.setdefault(trigram, array("q")).append(entry_id)
+            perf.count("indexed_variables", len(entries))
+        self.text = None
+        self.posting_arrays = {}
+        return len(entries)
+
+    def add_file(self, file_path):
+        return self.add_entries(*prepare_file(file_path))
+
+    def build(self):
+        texts = [entry.text for entry in self.entries]
+        self.text = SEPARATOR.join(texts)
+        lengths = np.array([len(t) + len(SEPARATOR) for t in texts], dtype=np.int64)
+        self.offsets = np.concatenate(([0], np.cumsum(lengths)[:-1])) if len(texts) else np.zeros(0, dtype=np.int64)
+        self.trigram_counts_array = np.array(self.trigram_counts, dtype=np.int64)
+        self.names = np.array([entry.name.lower() for entry in self.entries], dtype=str)
+        self.name_lengths = np.char.str_len(self.names).astype(np.int64)
+        self.text_lengths = lengths - len(SEPARATOR)
+
+    def get_postings(self, trigram):
+        postings = self.posting_arrays.get(trigram)
+        if postings is None:
+            postings = np.array(self.postings.get(trigram, array("q")), dtype=np.int64)
+            self.posting_arrays[trigram] = postings
+        return postings
+
+    # Entry ids of variables containing a word, searched in the joined text up to MAX_SUBSTRING_HITS occurrences.
+    # Returns the ids and whether the search stopped there.
+    def find_in_text(self, word):
+        hits = []
+        for match in re.finditer(re.escape(word), self.text):
+            hits.append(match.start())
+            if len(hits) >= MAX_SUBSTRING_HITS:
+                break
+        if not hits:
+            return np.zeros(0, dtype=np.int64), False
+        return np.unique(np.searchsorted(self.offsets, np.array(hits), side="right") - 1), len(hits) >= MAX_SUBSTRING_HITS
+
+    # Entry ids of variables which may contain all words of the query, to be verified (see search). Words of three or
+    # more characters are looked up in the trigram index, which finds all variables containing them and some which
+    # only contain their trigrams. Shorter words narrow many candidates down if they are rare enough to be found
+    # completely in the joined text, queries of only short words are searched there by their longest word. Returns
+    # the ids and whether the search stopped at MAX_SUBSTRING_HITS.
+    def find_candidates(self, query):
+        words = sorted(set(query.split()), key=len, reverse=True)
+        if len(words[0]) < 3:
+            return self.find_in_text(words[0])
+
+        ids = None
+        for trigram in {word[i:i + 3] for word in words for i in range(len(word) - 2)}:
+            postings = self.get_postings(trigram)
+            ids = postings if ids is None else np.intersect1d(ids, postings, assume_unique=True)
+            if len(ids) == 0:
+                return ids, False
+        for word in words:
+            if len(word) < 3 and len(ids) >= 1000:
+                found, stopped = self.find_in_text(word)
+                if not stopped:
+                    ids = np.intersect1d(ids, found, assume_unique=True)
+        return ids, False
+
+    # Orders entry ids by rank: exact names, names starting with the query, names containing it (shorter names first)
+    # and other fields containing it (shorter texts first), ties in order of the ids
+    def rank(self, ids, query):
+        names = self.names[ids]
+        ranks = np.full(len(ids), 3, dtype=np.int64)
+        ranks[np.char.find(names, query) >= 0] = 2
+        ranks[np.char.startswith(names, query)] = 1
+        ranks[names == query] = 0
+        lengths = np.where(ranks < 3, self.name_lengths[ids], self.text_lengths[ids])
+        keys = (ranks * (int(lengths.max(initial=0)) + 1) + lengths) * len(self.entries) + ids
+        return ids[np.argsort(keys)]
+
+    # Entry ids of variables containing at least MIN_FUZZY_SCORE of the trigrams of the query, best first (and
+    # shorter texts first for equal scores)
+    def find_fuzzy(self, query, limit):
+        query_trigrams = get_trigrams(query)
+        if not query_trigrams:
+            return np.zeros(0, dtype=np.int64)
+        postings = [self.get_postings(t) for t in query_trigrams]
+        postings = [p for p in postings if len(p)]
+        if not postings:
+            return np.zeros(0, dtype=np.int64)
+        shared = np.bincount(np.concatenate(postings), minlength=len(self.entries))
+        candidates = np.nonzero(shared)[0]
+        scores = shared[candidates] / len(query_trigrams)
+        good = scores >= MIN_FUZZY_SCORE
+        candidates, scores = candidates[good], scores[good]
+        order = np.lexsort((self.trigram_counts_array[candidates], -scores))[:limit]
+        return candidates[order]
+
+    # Returns the matching entries, best matches first: exact names, names starting with the query, names containing
+    # it, other fields containing it and finally fuzzy matches, and whether more variables than these match the query
+    # (the results are cut at the limit, or the substring search stopped at MAX_SUBSTRING_HITS)
+    def search(self, query, limit=500):
+        query = " ".join(query.lower().split())
+        if not query or not self.entries:
+            return [], False
+
+        with perf.operation("search", query=query, entries=len(self.entries)):
+            if self.text is None:
+                with perf.span("build"):
+                    self.build()
+
+            with perf.span("substring"):
+                ids, truncated = self.find_candidates(query)
+
+            # the candidates are verified in order of rank, until there is one more match than the limit
+            with perf.span("rank"):
+                words = query.split()
+                ranked = self.rank(ids, query)
+                results = []
+                for start in range(0, len(ranked), limit):
+                    for entry_id in ranked[start:start + limit].tolist():
+                        text = self.entries[entry_id].text
+                        if all(word in text for word in words):
+                            if len(results) >= limit:
+                                truncated = True
+                                break
+                            results.append(entry_id)
+                    if truncated:
+                        break
+
+            if len(results) < limit and len(query) >= 3:
+                with perf.span("fuzzy"):
+                    found = set(results)
+                    for entry_id in self.find_fuzzy(query, limit + 1).tolist():
+                        if entry_id not in found:
+                            if len(results) >= limit:
+                                truncated = True
+                                break
+                            results.append(entry_id)
+
+            perf.count("search_results", len(results))
+            return [self.entries[i] for i in results], truncated
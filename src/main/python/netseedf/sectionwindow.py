@@ -0,0 +1,225 @@
+import numpy as np
+from PySide6.QtCore import Qt
+from PySide6.QtGui import QPixmap, QImage
+from PySide6.QtWidgets import QVBoxLayout, QWidget, QHBoxLayout, QLabel, QSpinBox, QSizePolicy, QCheckBox, QComboBox, \
+    QPushButton, QMessageBox
+
+from plotutils import render_section, render_colorbar
+import datautils
+import jobs
+import perf
+
+COLORMAP = "inferno"
+MAX_SECTION_PIXELS = 4096  # larger sections are shown with every n-th cell, hovering reads the value of every cell
+
+
+# Heatmap of a section scaled to the size of the widget, reports the position of the mouse as fractions of the size
+class SectionImage(QLabel):
+    def __init__(self, on_hover):
+        super().__init__()
+        self.on_hover = on_hover
+        self.setMouseTracking(True)
+        self.setScaledContents(True)
+        self.setMinimumSize(300, 200)
+        self.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Expanding)
+
+    def mouseMoveEvent(self, event):
+        if self.width() > 0 and self.height() > 0:
+            self.on_hover(event.position().x() / self.width(), event.position().y() / self.height())
+        super().mouseMoveEvent(event)
+
+
+# Window which shows a section of a variable along any two of its dims (e.g. a Hovmöller diagram of time and
+# longitude), with the other dims fixed at an index or averaged. Displayed when 'Show section' button is clicked.
+class SectionWindow(QWidget):
+    def __init__(self, var_props):
+        super().__init__()
+
+        self.var_props = var_props
+        self.dims = [d for d in var_props["all_dims"] if d not in var_props["drop_dims"]]
+        self.section = None
+        self.section_dims = None
+        self.labels = {}  # dim -> labels of its indices, read when the dim is first shown
+        self.job = None  # job reading the section, while it runs
+
+        ncfile = datautils.open_dataset(var_props["file_path"])
+        try:
+            self.variable_units = getattr(datautils.get_variable(ncfile, var_props["variable_name"]), "units", None)
+        finally:
+            ncfile.close()
+
+        self.setWindowTitle(var_props["file_path"] + " - NetSeeDF")
+        self.setMinimumSize(700, 600)
+
+        # GUI setup
+        layout = QVBoxLayout()
+        file_label = QLabel("File: \t\t" + var_props["file_path"], wordWrap=True)
+        layout.addWidget(file_label)
+        var_label = QLabel("Variable: \t" + var_props["variable_name"], wordWrap=True)
+        layout.addWidget(var_label)
+        if self.variable_units is not None:
+            unit_label = QLabel("Units: \t\t" + str(self.variable_units), wordWrap=True)
+            layout.addWidget(unit_label)
+
+        # dims of the section, by default time (or the first dim) along the rows and longitude along the columns
+        axes_widget = QWidget()
+        axes_layout = QHBoxLayout()
+        axes_layout.setAlignment(Qt.AlignmentFlag.AlignLeft)
+        axes_widget.setLayout(axes_layout)
+        self.row_combo = QComboBox()
+        self.col_combo = QComboBox()
+        self.row_combo.addItems(self.dims)
+        self.col_combo.addItems(self.dims)
+        row_dim = var_props["t_dim"] if var_props["t_dim"] in self.dims else self.dims[0]
+        col_candidates = [d for d in [var_props["x_dim"]] + self.dims if d in self.dims and d != row_dim]
+        self.row_combo.setCurrentText(row_dim)
+        self.col_combo.setCurrentText(col_candidates[0] if col_candidates else row_dim)
+        self.row_combo.currentTextChanged.connect(self.on_axes_changed)
+        self.col_combo.currentTextChanged.connect(self.on_axes_changed)
+        axes_layout.addWidget(QLabel("Rows: "))
+        axes_layout.addWidget(self.row_combo)
+        axes_layout.addWidget(QLabel("Columns: "))
+        axes_layout.addWidget(self.col_combo)
+        layout.addWidget(axes_widget)
+
+        # other dims, fixed at an index or averaged
+        self.dim_widgets = {}
+        for dim in self.dims:
+            dim_widget = QWidget()
+            dim_layout = QHBoxLayout()
+            dim_layout.setAlignment(Qt.AlignmentFlag.AlignLeft)
+            dim_widget.setLayout(dim_layout)
+            dim_layout.addWidget(QLabel(dim + ": "))
+            dim_spinner = QSpinBox()
+            dim_spinner.setMinimum(1)
+            dim_spinner.setMaximum(var_props["sizes"][dim])
+            dim_spinner.setValue(1)
+            dim_layout.addWidget(dim_spinner)
+            dim_layout.addWidget(QLabel(" of " + str(var_props["sizes"][dim])))
+            mean_checkbox = QCheckBox()
+            mean_checkbox.checkStateChanged.connect(lambda state, spinner=dim_spinner: spinner.setEnabled(state != Qt.CheckState.Checked))
+            dim_layout.addWidget(mean_checkbox)
+            dim_layout.addWidget(QLabel("average"))
+            self.dim_widgets[dim] = (dim_widget, dim_spinner, mean_checkbox)
+            layout.addWidget(dim_widget)
+
+        self.show_button = QPushButton("Show section")
+        self.show_button.clicked.connect(self.update_section)
+        layout.addWidget(self.show_button)
+
+        image_widget = QWidget()
+        image_layout = QHBoxLayout()
+        image_widget.setLayout(image_layout)
+        self.image = SectionImage(self.on_hover)
+        image_layout.addWidget(self.image)
+        self.cbar = QLabel()
+        image_layout.addWidget(self.cbar)
+        layout.addWidget(image_widget)
+
+        self.axes_label = QLabel(wordWrap=True)
+        layout.addWidget(self.axes_label)
+        self.hover_label = QLabel()
+        layout.addWidget(self.hover_label)
+
+        self.setLayout(layout)
+        self.on_axes_changed()
+        jobs.add_listener(self.on_job_changed)
+
+    def get_section_dims(self):
+        return self.row_combo.currentText(), self.col_combo.currentText()
+
+    def on_axes_changed(self):
+        row_dim, col_dim = self.get_section_dims()
+        for dim, (dim_widget, _, _) in self.dim_widgets.items():
+            dim_widget.setVisible(dim not in (row_dim, col_dim))
+        self.show_button.setEnabled(row_dim != col_dim and self.job is None)
+
+    def get_labels(self, dim):
+        if dim not in self.labels:
+            self.labels[dim] = datautils.get_dimension_labels(self.var_props, dim)
+        return self.labels[dim]
+
+    def update_section(self):
+        row_dim, col_dim = self.get_section_dims()
+        fixed_indices = {}
+        mean_dims = []
+        for dim, (_, dim_spinner, mean_checkbox) in self.dim_widgets.items():
+            if dim in (row_dim, col_dim):
+                continue
+            if mean_checkbox.isChecked():
+                mean_dims.append(dim)
+            else:
+                fixed_indices[dim] = dim_spinner.value() - 1
+
+        # the section is read as a background job, the window is updated when it is done (see on_section_done)
+        def read_section(job):
+            with perf.operation("update_section", variable=self.var_props["variable_name"], rows=row_dim, columns=col_dim):
+                section = datautils.get_section(self.var_props, row_dim, col_dim, fixed_indices, mean_dims, job)
+
+                if section.count() == 0:
+                    raise ValueError("The section does not contain any values.")
+                with perf.span("min/max"):
+                    max_value = np.nanmax(section)
+                    min_value = np.nanmin(section)
+            return section, (row_dim, col_dim), min_value, max_value
+
+        self.show_button.setEnabled(False)
+        self.show_button.setText("Reading section...")
+        self.job = jobs.submit("Section of " + self.var_props["variable_name"] + " (" + row_dim + ", " + col_dim + ")",
+                               read_section, self.var_props["file_path"], jobs.PRIORITY_HIGH, self.on_section_done)
+
+    def on_job_changed(self, job):
+        if job is self.job and job.state == jobs.RUNNING:
+            self.show_button.setText("Reading section... {:.0f} %".format(job.progress * 100))
+
+    def on_section_done(self, job):
+        self.job = None
+        self.show_button.setText("Show section")
+        self.on_axes_changed()
+
+        if job.state == jobs.FAILED:
+            dlg = QMessageBox(self)
+            dlg.setWindowTitle("NetSeeDF message")
+            dlg.setText("There was an error while reading the section!\n" + job.error)
+            dlg.exec()
+            return
+
+        section, (row_dim, col_dim), min_value, max_value = job.result
+        with perf.operation("render_section", variable=self.var_props["variable_name"]):
+            row_step = int(np.ceil(section.shape[0] / MAX_SECTION_PIXELS))
+            col_step = int(np.ceil(section.shape[1] / MAX_SECTION_PIXELS))
+            image = render_section(section[::row_step, ::col_step], min_value, max_value, COLORMAP)
+            colorbar = render_colorbar(min_value, max_value, min_value, max_value, COLORMAP, self.variable_units)
+
+        self.section = section
+        self.section_dims = (row_dim, col_dim)
+        self.image.setPixmap(QPixmap.fromImage(QImage.fromData(image)))
+        self.cbar.setPixmap(QPixmap.fromImage(QImage.fromData(colorbar)))
+
+        row_labels, col_labels = self.get_labels(row_dim), self.get_labels(col_dim)
+        self.axes_label.setText("Rows (bottom to top): " + row_dim + " " + row_labels[0] + " to " + row_labels[-1] +
+                                "\nColumns (left to right): " + col_dim + " " + col_labels[0] + " to " + col_labels[-1])
+        self.hover_label.setText("")
+
+    def closeEvent(self, event):
+        jobs.remove_listener(self.on_job_changed)
+        if self.job is not None:
+            jobs.cancel(self.job)
+            self.job = None
+        event.accept()
+
+    # Shows the coordinates and the value of the cell under the mouse
+    def on_hover(self, x_fraction, y_fraction):
+        if self.section is None:
+            return
+        rows, cols = self.section.shape
+        row = min(rows - 1, max(0, int((1 - y_fraction) * rows)))
+        col = min(cols - 1, max(0, int(x_fraction * cols)))
+        row_dim, col_dim = self.section_dims
+        value = self.section[row, col]
+        value_string = "no data" if value is np.ma.masked else "{0:g}".format(value)
+        if value is not np.ma.masked and self.variable_units is not None:
+            value_string += " " + str(self.variable_units)
+        self.hover_label.setText(row_dim + " = " + self.get_labels(row_dim)[row] + ", " +
+                                 col_dim + " = " + self.get_labels(col_dim)[col] + ": " + value_string)
+
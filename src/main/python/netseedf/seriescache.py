@@ -0,0 +1,127 @@
+import os
+import time
+
+import numpy as np
+import numpy.ma as ma
+
+import datautils
+import membudget
+import perf
+
+# Cache of decoded chunk columns for time series of grid points. Reading the series of one point decompresses every
+# chunk along the time axis which contains the point, so the whole column of chunks (all times, the chunk's rows and
+# columns of the grid) is kept in memory and the series of the neighbouring points are served from it. Clicking or
+# hovering over the points of a region costs one read per chunk column.
+#
+# Columns are limited to MAX_COLUMN_BYTES, for chunks which are large in x and y (e.g. one chunk per time step) the
+# column is a smaller block of the grid around the point. Contiguous variables are read in blocks of
+# CONTIGUOUS_BLOCK x CONTIGUOUS_BLOCK points. The columns are kept as long as the memory budget has room for them
+# (see membudget).
+#
+# When the time axis of a file which is still being written has grown, only the appended records of a cached column
+# are read (together with the last record before, which may have been incomplete).
+
+MAX_COLUMN_BYTES = 32 * 1024 * 1024
+CONTIGUOUS_BLOCK = 16
+
+_columns = membudget.BudgetedCache("time series columns")  # key -> (file state, data (t, y, x))
+
+
+def clear():
+    _columns.clear()
+
+
+def get_cached_bytes():
+    return _columns.nbytes
+
+
+# Block size (y, x) of the columns of a variable, aligned to its chunks where they fit into MAX_COLUMN_BYTES
+def get_block_shape(var_props, itemsize, chunk_shape, t_dim):
+    dims = list(var_props["all_dims"])
+    x_axis, y_axis = dims.index(var_props["x_dim"]), dims.index(var_props["y_dim"])
+    if chunk_shape is None:
+        block_y, block_x = CONTIGUOUS_BLOCK, CONTIGUOUS_BLOCK
+    else:
+        block_y, block_x = chunk_shape[y_axis], chunk_shape[x_axis]
+
+    column_bytes_per_point = var_props["sizes"][t_dim] * itemsize
+    while block_y * block_x * column_bytes_per_point > MAX_COLUMN_BYTES and (block_y > 1 or block_x > 1):
+        if block_y >= block_x:
+            block_y = max(1, block_y // 2)
+        else:
+            block_x = max(1, block_x // 2)
+    return block_y, block_x
+
+
+# Reads a column (t, y, x) in pieces along t_dim (see datautils.get_series_pieces), each with the file opened only for
+# the piece, so other threads can read between the pieces
+def read_column(var_props, slice_indices, t_dim, y_slice, x_slice, pieces, job=None):
+    dims = list(var_props["all_dims"])
+    key = []
+    for d in dims:
+        if d in var_props["drop_dims"]:
+            key.append(0)
+        elif d == var_props["x_dim"]:
+            key.append(x_slice)
+        elif d == var_props["y_dim"]:
+            key.append(y_slice)
+        elif d == t_dim:
+            key.append(None)  # set for every piece
+        else:
+            key.append(slice_indices[var_props["sliceable_dims"].index(d)])
+
+    t_axis = dims.index(t_dim)
+    kept = [d for d, k in zip(dims, key) if not isinstance(k, (int, np.integer))]
+    column = []
+    for piece_start, piece_stop in pieces:
+        key[t_axis] = slice(piece_start, piece_stop)
+        with perf.span("read"):
+            column.append(datautils.read_block(var_props, tuple(key)))
+        perf.count("bytes_read", column[-1].nbytes)
+        if job is not None:
+            job.set_progress((piece_stop - pieces[0][0]) / max(1, pieces[-1][1] - pieces[0][0]))
+    column = ma.concatenate(column, axis=kept.index(t_dim))
+
+    # order the remaining axes as (t, y, x)
+    column = np.ma.transpose(column, [kept.index(t_dim), kept.index(var_props["y_dim"]), kept.index(var_props["x_dim"])])
+    return ma.masked_equal(column, var_props["fill_value"])
+
+
+# Time series (along t_dim) of the grid point x_index, y_index (relative to the region of the variable, see
+# datautils.region_index) with the other dims at slice_indices. In a job (see jobs) the progress of reading a column is
+# reported to the job.
+def get_timeseries(var_props, slice_indices, x_index, y_index, t_dim, job=None):
+    with perf.operation("get_timeseries", variable=var_props["variable_name"]):
+        x = datautils.region_index(var_props, "x", int(x_index))
+        y = datautils.region_index(var_props, "y", int(y_index))
+        file_path = os.path.abspath(var_props["file_path"])
+        file_state = datautils.get_file_state(file_path)
+
+        shape, itemsize, chunk_shape = datautils.get_variable_layout(var_props)
+        block_y, block_x = get_block_shape(var_props, itemsize, chunk_shape, t_dim)
+
+        y_start, x_start = y // block_y * block_y, x // block_x * block_x
+        other_indices = tuple(int(slice_indices[i]) for i, d in enumerate(var_props["sliceable_dims"]) if d != t_dim)
+        key = (file_path, var_props["variable_name"], t_dim, other_indices, y_start, x_start, block_y, block_x)
+        y_slice, x_slice = slice(y_start, y_start + block_y), slice(x_start, x_start + block_x)
+        t_axis = list(var_props["all_dims"]).index(t_dim)
+        t_size = shape[t_axis]
+
+        cached_state, column = _columns.get(key, (None, None))
+        if column is not None and cached_state == file_state:
+            perf.count("series_cache_hits")
+        elif column is not None and 0 < column.shape[0] < t_size:
+            perf.count("series_cache_appends")
+            start = time.perf_counter()
+            pieces = datautils.get_series_pieces(shape, itemsize, chunk_shape, t_axis, block_y * block_x, column.shape[0] - 1)
+            appended = read_column(var_props, slice_indices, t_dim, y_slice, x_slice, pieces, job)
+            column = ma.concatenate([column[:-1], appended])
+            _columns.put(key, (file_state, column), cost=time.perf_counter() - start)
+        else:
+            perf.count("series_cache_misses")
+            start = time.perf_counter()
+            pieces = datautils.get_series_pieces(shape, itemsize, chunk_shape, t_axis, block_y * block_x)
+            column = read_column(var_props, slice_indices, t_dim, y_slice, x_slice, pieces, job)
+            _columns.put(key, (file_state, column), cost=time.perf_counter() - start)
+
+        return column[:, y - y_start, x - x_start]
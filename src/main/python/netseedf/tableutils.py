@@ -1,6 +1,41 @@
+import numpy as np
+import numpy.ma as ma
 from PySide6.QtCore import QAbstractTableModel
 from PySide6.QtGui import Qt
 
+FORMAT_BLOCK_ROWS = 1000  # rows converted to text at once when copying or exporting
+MASKED_TEXT = "--"  # text of masked cells, as they are shown in the table
+
+
+# Data as a 2D table: a single value is one cell, a 1D array is one column
+def as_table(data):
+    if data.ndim == 0:
+        return data.reshape((1, 1))
+    if data.ndim == 1:
+        return data.reshape((data.shape[0], 1))
+    return data
+
+
+# Formats blocks of table data (e.g. the selected ranges of a table) as lines of delimited text, the blocks separated by
+# an empty line. FORMAT_BLOCK_ROWS rows at a time are converted to strings by numpy and joined, so large blocks are
+# neither formatted cell by cell nor held as strings all at once. Yields pieces of the text and the fraction of the
+# rows done, the text of the cells is the same as in the table.
+def format_blocks(blocks, delimiter):
+    blocks = [as_table(block) for block in blocks]
+    total_rows = max(1, sum(block.shape[0] for block in blocks))
+    done_rows = 0
+    for i, block in enumerate(blocks):
+        if i:
+            yield "\n", done_rows / total_rows
+        for start in range(0, block.shape[0], FORMAT_BLOCK_ROWS):
+            rows = block[start:start + FORMAT_BLOCK_ROWS]
+            text = np.asarray(rows).astype(str)
+            mask = ma.getmaskarray(rows) if ma.isMaskedArray(rows) else None
+            if mask is not None and mask.any():
+                text = np.where(mask, MASKED_TEXT, text)
+            done_rows += rows.shape[0]
+            yield "\n".join(map(delimiter.join, text.tolist())) + "\n", done_rows / total_rows
+
 
 def get_max_width(data_table, labels):
     metrics = data_table.fontMetrics()
@@ -15,6 +50,8 @@ def get_max_width(data_table, labels):
     return max_width
 
 
+# Model of the data of a table window. The data is kept as numbers (or dates) and formatted when a cell is shown, so
+# large slices are not converted to strings and the values of selected ranges can be copied from the numbers.
 class TableModel(QAbstractTableModel):
     def __init__(self, current_data, xlabels, ylabels):
         super().__init__()
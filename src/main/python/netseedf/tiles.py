@@ -0,0 +1,162 @@
+import os
+import sqlite3
+from collections import deque
+
+from PySide6.QtCore import QTimer
+
+import membudget
+import perf
+
+# Basemap tiles from a local source, so that the map background works without an internet connection (and without
+# its latency). The source is an MBTiles file (SQLite, raster tiles) or a directory of {z}/{x}/{y}.png (or .jpg,
+# .webp) tiles. The tiles are served to the map page from the netseedf:// scheme (see mappage) at TILE_URL_PATH.
+#
+# Served tiles are kept in memory as long as the memory budget has room for them (see membudget). After a tile has
+# been served, its neighbours at the same zoom level and the tiles covering it at the neighbouring zoom levels are
+# read into memory while the application is idle (PREFETCH_BATCH tiles at a time), so panning and zooming is served
+# from memory. Without a source, the map shows OpenStreetMap tiles from the internet.
+#
+# NETSEEDF_TILES   path of an MBTiles file or a tile directory
+
+TILE_URL_PATH = "tiles/{z}/{x}/{y}"
+PREFETCH_BATCH = 16  # tiles read per idle round
+MAX_PREFETCH_QUEUE = 512  # the oldest queued tiles are dropped, the view has moved on
+DEFAULT_MAX_ZOOM = 18  # zoom levels beyond those of the source show its tiles scaled up
+IMAGE_TYPES = {"png": b"image/png", "jpg": b"image/jpeg", "jpeg": b"image/jpeg", "webp": b"image/webp"}
+
+_source = None
+_source_checked = False
+_tiles = membudget.BudgetedCache("basemap tiles")  # (z, x, y) -> image bytes, b"" for missing tiles
+_prefetch_queue = deque(maxlen=MAX_PREFETCH_QUEUE)
+_prefetch_timer = None
+
+
+# Raster tiles of an MBTiles file, rows are numbered from the south (TMS) in the file
+class MBTilesSource:
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect("file:" + path + "?mode=ro", uri=True)
+        metadata = dict(self.connection.execute("SELECT name, value FROM metadata").fetchall())
+        tile_format = metadata.get("format", "png").lower()
+        if tile_format not in IMAGE_TYPES:
+            raise ValueError("Tiles of format '" + tile_format + "' are not supported, only raster tiles (png, jpg, webp).")
+        self.content_type = IMAGE_TYPES[tile_format]
+        self.attribution = metadata.get("attribution") or os.path.basename(path)
+        zooms = self.connection.execute("SELECT MIN(zoom_level), MAX(zoom_level) FROM tiles").fetchone()
+        self.min_zoom = int(metadata.get("minzoom", zooms[0] or 0))
+        self.max_zoom = int(metadata.get("maxzoom", zooms[1] or 0))
+
+    def read(self, z, x, y):
+        row = self.connection.execute("SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                                      (z, x, (1 << z) - 1 - y)).fetchone()
+        return bytes(row[0]) if row is not None else None
+
+
+# Tiles stored as files {z}/{x}/{y}.<extension> in a directory, the extension is that of the first tile found
+class DirectorySource:
+    def __init__(self, path):
+        self.path = path
+        zooms = sorted(int(name) for name in os.listdir(path) if name.isdigit())
+        if not zooms:
+            raise ValueError("The directory does not contain any zoom levels ({z}/{x}/{y} tiles).")
+        self.min_zoom, self.max_zoom = zooms[0], zooms[-1]
+        self.extension = self.find_extension(os.path.join(path, str(zooms[0])))
+        self.content_type = IMAGE_TYPES[self.extension]
+        self.attribution = os.path.basename(os.path.normpath(path))
+
+    def find_extension(self, zoom_dir):
+        for x_name in os.listdir(zoom_dir):
+            x_dir = os.path.join(zoom_dir, x_name)
+            if os.path.isdir(x_dir):
+                for name in os.listdir(x_dir):
+                    extension = os.path.splitext(name)[1].lstrip(".").lower()
+                    if extension in IMAGE_TYPES:
+                        return extension
+        raise ValueError("The directory does not contain any png, jpg or webp tiles.")
+
+    def read(self, z, x, y):
+        try:
+            with open(os.path.join(self.path, str(z), str(x), str(y) + "." + self.extension), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+
+def open_source(path):
+    if os.path.isdir(path):
+        return DirectorySource(path)
+    if not os.path.isfile(path):
+        raise ValueError("There is no file or directory at " + path)
+    return MBTilesSource(path)
+
+
+# The tile source of NETSEEDF_TILES, None if it is not set or cannot be read
+def get_source():
+    global _source, _source_checked
+    if not _source_checked:
+        _source_checked = True
+        path = os.environ.get("NETSEEDF_TILES")
+        if path:
+            try:
+                _source = open_source(path)
+            except (ValueError, OSError, sqlite3.Error) as e:
+                print("NetSeeDF: the basemap tiles in " + path + " cannot be used, showing online tiles: " + str(e))
+    return _source
+
+
+def is_valid_tile(z, x, y):
+    return 0 <= z <= 30 and 0 <= x < (1 << z) and 0 <= y < (1 << z)
+
+
+def read_tile(source, key):
+    data = _tiles.get(key)
+    if data is None:
+        data = source.read(*key) or b""
+        _tiles.put(key, data)
+        perf.count("tiles_read")
+    return data
+
+
+# Image bytes and content type of a tile, None if the source has no such tile. Called from the scheme handler of the
+# map page (in the GUI thread).
+def get_tile(z, x, y):
+    source = get_source()
+    if source is None or not is_valid_tile(z, x, y):
+        return None
+    key = (z, x, y)
+    perf.count("tile_cache_hits" if key in _tiles else "tile_cache_misses")
+    data = read_tile(source, key)
+    queue_prefetch(source, z, x, y)
+    return (data, source.content_type) if data else None
+
+
+# Queues the neighbours of a served tile, its parent and its children, which are read when the application is idle
+def queue_prefetch(source, z, x, y):
+    global _prefetch_timer
+    n = 1 << z
+    candidates = [(z, (x + dx) % n, y + dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1) if dx or dy]
+    if z > source.min_zoom:
+        candidates.append((z - 1, x // 2, y // 2))
+    if z < source.max_zoom:
+        candidates += [(z + 1, 2 * x + dx, 2 * y + dy) for dx in (0, 1) for dy in (0, 1)]
+    for key in candidates:
+        if is_valid_tile(*key) and key not in _tiles:
+            _prefetch_queue.append(key)
+
+    if _prefetch_timer is None:
+        _prefetch_timer = QTimer()
+        _prefetch_timer.setSingleShot(True)
+        _prefetch_timer.timeout.connect(prefetch)
+    if not _prefetch_timer.isActive():
+        _prefetch_timer.start(0)
+
+
+def prefetch():
+    source = get_source()
+    for _ in range(min(PREFETCH_BATCH, len(_prefetch_queue))):
+        key = _prefetch_queue.pop()  # the most recently queued tiles are the closest to the view
+        if key not in _tiles:
+            read_tile(source, key)
+            perf.count("tiles_prefetched")
+    if _prefetch_queue:
+        _prefetch_timer.start(0)
@@ -0,0 +1,199 @@
+import os
+
+from PySide6.QtCore import QAbstractItemModel, QModelIndex, QPersistentModelIndex, Qt, QTimer
+
+import datautils
+import perf
+
+# Model of the tree of open files, their groups and variables. The contents of a file or group are only scanned when
+# it is expanded (fetchMore), and the rows are inserted in batches, so files with deep group hierarchies or thousands
+# of variables show their top level immediately.
+#
+# While a search is active the model shows a separate tree with only the matching variables (and the files and groups
+# containing them), built from the search results, the full tree is kept and shown again when the search is cleared.
+
+COLUMNS = ["Name", "Description", "Shape"]
+FETCH_BATCH = 500  # rows inserted at once, the rest is inserted when the event loop is idle
+
+
+class TreeNode:
+    def __init__(self, kind, name, file_path, path, description="", shape="", parent=None):
+        self.kind = kind  # "root", "file", "group" or "variable"
+        self.name = name
+        self.file_path = file_path
+        self.path = path  # group or variable path inside the file, see datautils.split_variable_path
+        self.description = description
+        self.shape = shape
+        self.parent = parent
+        self.row = 0
+        self.children = []
+        self.pending = None  # scanned entries which have not been inserted yet, None until the node is scanned
+
+    def is_container(self):
+        return self.kind in ("root", "file", "group")
+
+    def add_child(self, child):
+        child.parent = self
+        child.row = len(self.children)
+        self.children.append(child)
+
+
+class VariableTreeModel(QAbstractItemModel):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.root = TreeNode("root", "", None, "")
+        self.root.pending = []
+        self.full_root = self.root
+
+    def node(self, index):
+        if index is not None and index.isValid():
+            return index.internalPointer()
+        return self.root
+
+    def index_of(self, node, column=0):
+        if node is self.root:
+            return QModelIndex()
+        return self.createIndex(node.row, column, node)
+
+    def index(self, row, column, parent=QModelIndex()):
+        parent_node = self.node(parent)
+        if 0 <= row < len(parent_node.children) and 0 <= column < len(COLUMNS):
+            return self.createIndex(row, column, parent_node.children[row])
+        return QModelIndex()
+
+    def parent(self, index=QModelIndex()):
+        if not index.isValid():
+            return QModelIndex()
+        return self.index_of(self.node(index).parent)
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid() and parent.column() != 0:
+            return 0
+        return len(self.node(parent).children)
+
+    def columnCount(self, parent=QModelIndex()):
+        return len(COLUMNS)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        node = self.node(index)
+        if role == Qt.ItemDataRole.DisplayRole:
+            return (node.name, node.description, node.shape)[index.column()]
+        if role == Qt.ItemDataRole.ToolTipRole and index.column() == 0:
+            return node.file_path if node.kind == "file" else node.path
+        return None
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if orientation == Qt.Orientation.Horizontal and role == Qt.ItemDataRole.DisplayRole:
+            return COLUMNS[section]
+        return None
+
+    def hasChildren(self, parent=QModelIndex()):
+        node = self.node(parent)
+        if not node.is_container():
+            return False
+        return node.pending is None or bool(node.pending) or bool(node.children)
+
+    def canFetchMore(self, parent):
+        node = self.node(parent)
+        return node.is_container() and (node.pending is None or bool(node.pending))
+
+    def fetchMore(self, parent):
+        node = self.node(parent)
+        if not node.is_container():
+            return
+
+        if node.pending is None:
+            node.pending = self.scan(node)
+
+        batch = node.pending[:FETCH_BATCH]
+        node.pending = node.pending[FETCH_BATCH:]
+        if batch:
+            first = len(node.children)
+            self.beginInsertRows(parent, first, first + len(batch) - 1)
+            for kind, name, path, description, shape in batch:
+                node.add_child(TreeNode(kind, name, node.file_path, path, description, shape))
+            self.endInsertRows()
+
+        if node.pending:
+            persistent = QPersistentModelIndex(parent)
+            QTimer.singleShot(0, lambda: persistent.isValid() and self.fetchMore(QModelIndex(persistent)))
+
+    # Lists the subgroups and variables of a file or group
+    def scan(self, node):
+        with perf.operation("scan_group", file=os.path.basename(node.file_path), group=node.path or "/"):
+            with perf.span("open"):
+                ncfile = datautils.open_dataset(node.file_path)
+            try:
+                with perf.span("scan"):
+                    return datautils.scan_group(ncfile, node.path)
+            finally:
+                ncfile.close()
+
+    def is_filtered(self):
+        return self.root is not self.full_root
+
+    # Shows only the variables of the search results (searchindex.SearchEntry), None shows the full tree again
+    def set_filter(self, entries):
+        self.beginResetModel()
+        if entries is None:
+            self.root = self.full_root
+        else:
+            self.root = TreeNode("root", "", None, "")
+            self.root.pending = []
+            containers = {}  # (file path, group path) -> node
+
+            def get_container(file_path, group_path):
+                key = (file_path, group_path)
+                if key not in containers:
+                    if group_path:
+                        parent_path, name = datautils.split_variable_path(group_path)
+                        node = TreeNode("group", name, file_path, group_path)
+                        get_container(file_path, parent_path).add_child(node)
+                    else:
+                        node = TreeNode("file", os.path.basename(file_path), file_path, "")
+                        self.root.add_child(node)
+                    node.pending = []
+                    containers[key] = node
+                return containers[key]
+
+            for entry in entries:
+                group_path, _ = datautils.split_variable_path(entry.path)
+                get_container(entry.file_path, group_path).add_child(
+                    TreeNode("variable", entry.name, entry.file_path, entry.path, entry.description, entry.shape))
+        self.endResetModel()
+
+    # Adds a file and lists its root group, returns the index of the file. name is shown instead of the file name.
+    def add_file(self, file_path, name=None):
+        file_node = TreeNode("file", name or os.path.basename(file_path), file_path, "")
+        file_node.pending = self.scan(file_node)  # scanned before inserting, so a file which cannot be read is not added
+
+        if self.is_filtered():
+            self.set_filter(None)
+
+        row = len(self.root.children)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.root.add_child(file_node)
+        self.endInsertRows()
+
+        index = self.index_of(file_node)
+        self.fetchMore(index)
+        return index
+
+    # Lists the root group of a file again, e.g. the virtual file of derived variables after a variable was added.
+    # Returns the index of the file.
+    def reload_file(self, file_path):
+        if self.is_filtered():
+            self.set_filter(None)
+        for file_node in self.root.children:
+            if file_node.file_path == file_path:
+                index = self.index_of(file_node)
+                if file_node.children:
+                    self.beginRemoveRows(index, 0, len(file_node.children) - 1)
+                    file_node.children = []
+                    self.endRemoveRows()
+                file_node.pending = self.scan(file_node)
+                self.fetchMore(index)
+                return index
+        return QModelIndex()
@@ -1,9 +1,27 @@
+import os
+
 import numpy as np
+from PySide6.QtCore import Qt
 from PySide6.QtGui import QCursor
 from PySide6.QtWidgets import QMenu, QApplication, QFileDialog, QMessageBox
 from netCDF4 import num2date, Dataset
 from math import floor, log10, ceil, copysign
 
+import jobs
+import perf
+import tableutils
+
+open_windows = []  # windows shown with keep_window which have not been closed yet
+
+
+# Shows a top level window and keeps a reference to it while it is open. The window is deleted when it is closed, which
+# releases its data (and the memory it counts against the budget, see membudget).
+def keep_window(window):
+    window.setAttribute(Qt.WidgetAttribute.WA_DeleteOnClose)
+    open_windows.append(window)
+    window.destroyed.connect(lambda: open_windows.remove(window) if window in open_windows else None)
+    window.show()
+
 
 def getorder(x):
     return floor(log10(abs(x)))
@@ -86,7 +104,10 @@ def grid_boundaries_from_centers(x_centers, y_centers):
 
     return x_bounds, y_bounds
 
-def show_dialog_and_save(self, selected_data, suggested_filename, use_last_dir=True):
+# Asks for a file and exports the data to it in the background (see jobs). selected_data is an array, a list of arrays
+# (e.g. the selected ranges of a table) or a function which reads it in the job, source_path is then the file it reads
+# from.
+def show_dialog_and_save(self, selected_data, suggested_filename, use_last_dir=True, source_path=None):
     dialog = QFileDialog(self, "Save File")
     dialog.setAcceptMode(QFileDialog.AcceptMode.AcceptSave)
     dialog.setNameFilters(["CSV File (*.csv)", "Tab-separated File (*.tsv)",  "Text File (*.txt)"])
@@ -122,9 +143,37 @@ def show_dialog_and_save(self, selected_data, suggested_filename, use_last_dir=T
             # Update last directory
             if use_last_dir: self.last_directory = str(QFileDialog.directory(dialog).absolutePath())
 
-            if ext == ".txt":
-                np.savetxt(file_path, selected_data, delimiter=" ", fmt='%s')
-            elif ext == ".csv":
-                np.savetxt(file_path, selected_data, delimiter=",", fmt='%s')
-            elif ext == ".tsv":
-                np.savetxt(file_path, selected_data, delimiter="\t", fmt='%s')
+            delimiter = {".txt": " ", ".csv": ",", ".tsv": "\t"}[ext]
+            jobs.submit("Export " + os.path.basename(file_path), lambda job: export_data(job, selected_data, file_path, delimiter),
+                        source_path, jobs.PRIORITY_LOW, show_job_error)
+
+
+# Writes the data (or the data returned by selected_data(job)) to a text file, runs as a job. The values are written
+# as they are shown in the tables (see tableutils.format_blocks).
+def export_data(job, selected_data, file_path, delimiter):
+    with perf.operation("export", file=file_path):
+        if callable(selected_data):
+            job.set_progress(0, "reading")
+            selected_data = selected_data(job)
+        blocks = selected_data if isinstance(selected_data, list) else [selected_data]
+        blocks = [np.asanyarray(block) for block in blocks]
+
+        with perf.span("write"):
+            try:
+                with open(file_path, "w", encoding="utf-8") as f:
+                    for text, progress in tableutils.format_blocks(blocks, delimiter):
+                        f.write(text)
+                        job.set_progress(progress, "writing")
+            except jobs.JobCancelled:
+                os.remove(file_path)  # do not leave a partial export
+                raise
+    return file_path
+
+
+# Tells the user about a job which has failed, used as the on_done callback of jobs
+def show_job_error(job):
+    if job.state == jobs.FAILED:
+        dlg = QMessageBox()
+        dlg.setWindowTitle("NetSeeDF message")
+        dlg.setText(job.name + " has failed!\n" + str(job.error))
+        dlg.exec()
@@ -0,0 +1,275 @@
+import itertools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from classicnc import mask_and_scale
+
+# Reader for local Zarr stores (format 2 and 3). ZarrDataset and ZarrVariable implement the parts of the
+# netCDF4.Dataset and netCDF4.Variable interface that NetSeeDF uses, so a store can be browsed, tabulated and plotted
+# like a NetCDF file. Dimension names are taken from the _ARRAY_DIMENSIONS attribute (written by xarray) or from
+# the dimension_names of format 3 arrays.
+#
+# Reads which touch several chunks are split along the chunk grid and the chunks are decoded in parallel on a thread
+# pool (the compressors release the GIL while decoding).
+
+STORE_MARKERS = (".zgroup", ".zarray", ".zmetadata", "zarr.json")
+MAX_WORKERS = min(8, os.cpu_count() or 1)
+STATE_MAX_AGE = 2.0  # seconds the state of a store is reused before its files are listed again
+
+_executor = None
+_store_states = {}  # store path -> (time of the listing, state)
+
+
+def is_zarr(file_path):
+    return os.path.isdir(file_path) and any(os.path.exists(os.path.join(file_path, m)) for m in STORE_MARKERS)
+
+
+# Total size and newest modification time of the files of a store. Writing chunks into a store changes neither the size
+# nor the modification time of its directory, so the state of the store is that of its metadata and chunk files. Large
+# stores have many files, a listing is reused for STATE_MAX_AGE seconds.
+def get_store_state(store_path):
+    store_path = os.path.abspath(store_path)
+    listed = _store_states.get(store_path)
+    if listed is not None and time.monotonic() - listed[0] < STATE_MAX_AGE:
+        return listed[1]
+
+    size, mtime = 0, 0
+    directories = [store_path]
+    while directories:
+        with os.scandir(directories.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                    continue
+                stat = entry.stat()
+                size += stat.st_size
+                mtime = max(mtime, stat.st_mtime_ns)
+    _store_states[store_path] = (time.monotonic(), (size, mtime))
+    return size, mtime
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="netseedf-zarr")
+    return _executor
+
+
+def get_dimension_names(array, name):
+    names = array.attrs.get("_ARRAY_DIMENSIONS")
+    if names is None:
+        try:
+            names = array.metadata.dimension_names
+        except AttributeError:
+            names = None
+    if names is None or len(names) != len(array.shape) or any(n is None for n in names):
+        names = [name + "_dim" + str(i) for i in range(len(array.shape))]
+    return [str(n) for n in names]
+
+
+# Splits one index of a selection along the chunk grid of its dimension.
+# Returns a list of (index into the array, index into the output or None if the dimension is dropped).
+def split_index(index, size, chunk):
+    if isinstance(index, (int, np.integer)):
+        return [(int(index), None)]
+
+    start, stop, step = index.indices(size)
+    n = len(range(start, stop, step))
+    if n == 0 or step < 0:  # reversed selections are not split
+        return [(index, slice(0, n))]
+
+    last = start + step * (n - 1)
+    parts = []
+    for c in range(start // chunk, last // chunk + 1):
+        k_lo = max(0, -(-(c * chunk - start) // step))
+        k_hi = min(n, -(-((c + 1) * chunk - start) // step))
+        if k_lo < k_hi:
+            parts.append((slice(start + step * k_lo, start + step * (k_hi - 1) + 1, step), slice(k_lo, k_hi)))
+    return parts
+
+
+def normalize_key(key, ndim):
+    if not isinstance(key, tuple):
+        key = (key,)
+    if any(k is Ellipsis for k in key):
+        i = key.index(Ellipsis)
+        key = key[:i] + (slice(None),) * (ndim - len(key) + 1) + key[i + 1:]
+    key = key + (slice(None),) * (ndim - len(key))
+    if len(key) != ndim or not all(isinstance(k, (int, np.integer, slice)) for k in key):
+        return None
+    return key
+
+
+class ZarrDimension:
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+
+    def isunlimited(self):
+        return False
+
+    def __len__(self):
+        return self.size
+
+    def __repr__(self):
+        return "<class 'zarrstore.ZarrDimension'>: name = '{}', size = {}".format(self.name, self.size)
+
+
+class ZarrAttributes:
+    def ncattrs(self):
+        return [k for k in self._attributes.keys() if k != "_ARRAY_DIMENSIONS"]
+
+    def getncattr(self, name):
+        return self._attributes[name]
+
+    def __getattr__(self, name):
+        if name.startswith("_") and name not in ("_FillValue",):
+            raise AttributeError(name)
+        try:
+            return self._attributes[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class ZarrVariable(ZarrAttributes):
+    def __init__(self, name, array, group):
+        self.name = name
+        self._array = array
+        self._group = group
+        self._attributes = dict(array.attrs)
+        self.dimensions = tuple(get_dimension_names(array, name))
+        self.shape = tuple(array.shape)
+        self.ndim = len(self.shape)
+        self.size = int(np.prod(self.shape, dtype=np.int64))
+        self.dtype = np.dtype(array.dtype)
+        self.datatype = self.dtype
+
+    def group(self):
+        return self._group
+
+    def chunking(self):
+        return list(self._array.chunks)
+
+    def filters(self):
+        try:
+            return {"compressors": [str(c) for c in self._array.compressors]}
+        except AttributeError:
+            return {"compressor": str(getattr(self._array, "compressor", None))}
+
+    # Fill value of the _FillValue or missing_value attribute, else the fill_value of a format 2 array (where xarray
+    # stores _FillValue), None without one. The fill_value of a format 3 array is not a missing value, those arrays
+    # always have one (0 by default).
+    def get_fill_value(self):
+        if "_FillValue" in self._attributes:
+            return self._attributes["_FillValue"]
+        if "missing_value" in self._attributes:
+            return np.atleast_1d(self._attributes["missing_value"])[0]
+        if getattr(getattr(self._array, "metadata", None), "zarr_format", 2) == 2:
+            return self._array.fill_value
+        return None
+
+    # Reads the selection, decoding the chunks it touches in parallel
+    def read(self, key):
+        key = normalize_key(key, self.ndim)
+        if key is None or self.ndim == 0:  # fancy indexing or a scalar, let zarr handle it
+            return np.asarray(self._array[key if key is not None else ()])
+
+        parts_per_dim = [split_index(k, size, chunk) for k, size, chunk in zip(key, self.shape, self._array.chunks)]
+        n_parts = int(np.prod([len(p) for p in parts_per_dim], dtype=np.int64))
+        if n_parts <= 1:
+            return np.asarray(self._array[key])
+
+        out_shape = []
+        for k, size in zip(key, self.shape):
+            if isinstance(k, slice):
+                out_shape.append(len(range(*k.indices(size))))
+        out = np.empty(out_shape, dtype=self.dtype)
+
+        def read_part(part):
+            src = tuple(p[0] for p in part)
+            dst = tuple(p[1] for p in part if p[1] is not None)
+            out[dst] = self._array[src]
+
+        list(get_executor().map(read_part, itertools.product(*parts_per_dim)))
+        return out
+
+    def __getitem__(self, key):
+        data = self.read(key)
+        if self.dtype.kind in ("S", "U", "O", "b"):
+            return data
+        return mask_and_scale(data, self._attributes, self.get_fill_value())
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        lines = ["<class 'zarrstore.ZarrVariable'>",
+                 "{} {}({})".format(self.dtype, self.name, ", ".join(self.dimensions))]
+        for key in self.ncattrs():
+            lines.append("    {}: {}".format(key, self._attributes[key]))
+        lines.append("current shape = {}".format(self.shape))
+        lines.append("chunks = {}".format(tuple(self._array.chunks)))
+        lines.append("filters = {}".format(self.filters()))
+        return "\n".join(lines)
+
+
+class ZarrGroup(ZarrAttributes):
+    def __init__(self, group, name, parent):
+        self.name = name
+        self.parent = parent
+        self.path = "/" if parent is None else (parent.path.rstrip("/") + "/" + name)
+        self._group = group
+        self._attributes = dict(group.attrs)
+
+        self.variables = {}
+        self.dimensions = {}
+        for array_name in sorted(group.array_keys()):
+            var = ZarrVariable(array_name, group[array_name], self)
+            self.variables[array_name] = var
+            for dim, size in zip(var.dimensions, var.shape):
+                if dim not in self.dimensions:
+                    self.dimensions[dim] = ZarrDimension(dim, size)
+
+        self.groups = {}
+        for group_name in sorted(group.group_keys()):
+            self.groups[group_name] = ZarrGroup(group[group_name], group_name, self)
+
+    def __repr__(self):
+        lines = ["<class 'zarrstore.ZarrGroup'>", "group {}:".format(self.path)]
+        for key in self.ncattrs():
+            lines.append("    {}: {}".format(key, self._attributes[key]))
+        lines.append("    dimensions(sizes): " + ", ".join("{}({})".format(d.name, d.size) for d in self.dimensions.values()))
+        lines.append("    variables(dimensions): " + ", ".join("{} {}({})".format(v.dtype, v.name, ", ".join(v.dimensions)) for v in self.variables.values()))
+        lines.append("    groups: " + ", ".join(self.groups.keys()))
+        return "\n".join(lines)
+
+
+class ZarrDataset(ZarrGroup):
+    def __init__(self, file_path):
+        try:
+            import zarr  # imported here, so that zarr is only loaded when a store is opened
+        except ImportError:
+            raise OSError("The zarr package is required to open Zarr stores")
+
+        self.filepath_ = file_path
+        self.data_model = "ZARR"
+        self.file_format = "ZARR"
+        super().__init__(zarr.open_group(file_path, mode="r"), "/", None)
+
+    def filepath(self):
+        return self.filepath_
+
+    def isopen(self):
+        return True
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()